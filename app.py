@@ -1,167 +1,242 @@
-# app.py
-# -*- coding: utf-8 -*-
-import os
-import re
-import base64
-import mimetypes
-import pathlib
-import sqlite3
-from datetime import datetime, date, timedelta
-from io import BytesIO
-from typing import Dict, Any, Optional, List, Tuple
-import unicodedata
-
-import altair as alt
-import pandas as pd
-import streamlit as st
-
-# ======================
-# Cấu hình chung
-# ======================
+# app.py
+# -*- coding: utf-8 -*-
+import os
+import re
+import base64
+import calendar
+import contextlib
+import shutil
+import functools
+import hashlib
+import logging
+import mimetypes
+import pathlib
+import queue
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, date, timedelta
+from io import BytesIO
+from typing import Dict, Any, Optional, List, Tuple, Union
+import unicodedata
+
+import altair as alt
+import pandas as pd
+import streamlit as st
+
+# ======================
+# Cấu hình chung
+# ======================
 DB_PATH = "ward_tracker.db"
 DUTY_DIR = "uploads/duty"
 PATIENT_UPLOAD_DIR = "uploads/patients"
 DATE_FMT = "%Y-%m-%d"
+PREVIEW_ROWS = 500  # số dòng xem trước tối đa cho CSV/XLSX lịch trực
 APP_PASSWORD = os.getenv("APP_PASSWORD", "")  # để trống thì tắt password
-st.set_page_config(page_title="Bác sĩ Trực tuyến - Theo dõi bệnh nhân", layout="wide", page_icon="🩺")
-
-# ======================
-# CSS tinh gọn giao diện
-# ======================
-CUSTOM_CSS = """
-<style>
-:root{--accent:#0d9488;--muted:#6b7280;--card:#ffffff;--bg:#f8fafc}
-body{background:var(--bg)}
-.kpi{display:flex;align-items:center;gap:12px;padding:14px;border-radius:12px;background:linear-gradient(180deg, rgba(255,255,255,0.9), rgba(250,250,250,0.9));box-shadow:0 6px 20px rgba(13, 20, 25, 0.06);border:1px solid rgba(0,0,0,0.04)}
-.kpi .icon{width:44px;height:44px;border-radius:10px;background:var(--accent);display:flex;align-items:center;justify-content:center;color:white;font-weight:700}
-.kpi h3{margin:0;font-size:0.85rem;color:var(--muted)}
-.kpi .v{font-weight:700;font-size:1.45rem;margin-top:2px}
-.header-card{padding:16px;border-radius:12px;background:linear-gradient(90deg,#f1f5f9,#ffffff);box-shadow:0 6px 18px rgba(13,20,25,0.04);margin-bottom:12px}
-.quick-actions{display:flex;gap:10px;flex-wrap:wrap}
-.quick-btn{background:var(--card);border-radius:10px;padding:10px 12px;border:1px solid rgba(0,0,0,0.06);cursor:pointer}
-.small{font-size:0.9rem;color:var(--muted)}
-.badge{display:inline-block;padding:4px 10px;border-radius:999px;font-size:0.75rem;border:1px solid rgba(0,0,0,0.08)}
-.badge.ok{background:#e8f5e9}
-.badge.warn{background:#fff8e1}
+QUERY_CACHE_ENTRIES = 256  # số kết quả SELECT giữ trong cache (kết quả của phiên bản bảng cũ bị đẩy ra trước khi hết ttl)
+log = logging.getLogger("ward_tracker")
+st.set_page_config(page_title="Bác sĩ Trực tuyến - Theo dõi bệnh nhân", layout="wide", page_icon="🩺")
+
+# ======================
+# CSS tinh gọn giao diện
+# ======================
+CUSTOM_CSS = """
+<style>
+:root{--accent:#0d9488;--muted:#6b7280;--card:#ffffff;--bg:#f8fafc}
+body{background:var(--bg)}
+.kpi{display:flex;align-items:center;gap:12px;padding:14px;border-radius:12px;background:linear-gradient(180deg, rgba(255,255,255,0.9), rgba(250,250,250,0.9));box-shadow:0 6px 20px rgba(13, 20, 25, 0.06);border:1px solid rgba(0,0,0,0.04)}
+.kpi .icon{width:44px;height:44px;border-radius:10px;background:var(--accent);display:flex;align-items:center;justify-content:center;color:white;font-weight:700}
+.kpi h3{margin:0;font-size:0.85rem;color:var(--muted)}
+.kpi .v{font-weight:700;font-size:1.45rem;margin-top:2px}
+.header-card{padding:16px;border-radius:12px;background:linear-gradient(90deg,#f1f5f9,#ffffff);box-shadow:0 6px 18px rgba(13,20,25,0.04);margin-bottom:12px}
+.quick-actions{display:flex;gap:10px;flex-wrap:wrap}
+.quick-btn{background:var(--card);border-radius:10px;padding:10px 12px;border:1px solid rgba(0,0,0,0.06);cursor:pointer}
+.small{font-size:0.9rem;color:var(--muted)}
+.badge{display:inline-block;padding:4px 10px;border-radius:999px;font-size:0.75rem;border:1px solid rgba(0,0,0,0.08)}
+.badge.ok{background:#e8f5e9}
+.badge.warn{background:#fff8e1}
 .badge.danger{background:#ffebee}
 .embed{width:100%;height:720px;border:1px solid rgba(0,0,0,0.08);border-radius:12px;overflow:hidden}
 .morning-row{padding:10px 0;border-bottom:1px solid rgba(0,0,0,0.06)}
 .patient-chip{display:inline-block;padding:3px 8px;border-radius:999px;background:#eef2ff;color:#3730a3;font-size:0.78rem;margin-right:6px}
 .muted-line{color:var(--muted);font-size:0.9rem}
-
-/* Responsive: tối ưu cho điện thoại */
-@media (max-width: 800px) {
-    .kpi{flex-direction:row;gap:10px;padding:10px}
-    .kpi .icon{width:36px;height:36px;font-size:14px}
-    .kpi h3{font-size:0.75rem}
-    .kpi .v{font-size:1.05rem}
-    .header-card{padding:10px}
-    .quick-actions{flex-direction:column}
-    .quick-btn{width:100%;text-align:left;padding:10px;border-radius:8px}
-    .embed{height:360px}
-    /* Dataframe and charts: make them take full width and be scrollable */
-    .stDataFrame, .stTable, .element-container{width:100% !important}
-    .streamlit-expanderHeader{font-size:0.95rem}
-}
-
-@media (max-width: 420px) {
-    /* Further reduction for small phones */
-    .kpi{flex-direction:column;align-items:flex-start}
-    .kpi .icon{width:34px;height:34px}
-    .kpi .v{font-size:1rem}
-    .header-card{padding:8px}
-    .small{font-size:0.85rem}
-    .embed{height:300px}
-}
-</style>
-"""
-st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
-
-# ======================
-# Danh mục cận lâm sàng thường dùng
-# ======================
-COMMON_TESTS: List[Tuple[str, str]] = [
-    ("XN máu", "Tổng phân tích tế bào máu"),
-    ("XN máu", "Sinh hoá cơ bản"),
-    ("XN máu", "Đông máu"),
-    ("XN máu", "Đường huyết"),
-    ("XN máu", "HbA1c"),
-    ("X-quang", "X-quang ngực thẳng"),
-    ("Siêu âm", "Siêu âm ổ bụng"),
-    ("CT", "CT sọ não không cản quang"),
-    ("Khác", "Điện tim"),
-]
-
-# ======================
-# Helpers DB
-# ======================
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
-    cur = conn.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    return col in cols
-
-def init_db() -> None:
+
+/* Responsive: tối ưu cho điện thoại */
+@media (max-width: 800px) {
+    .kpi{flex-direction:row;gap:10px;padding:10px}
+    .kpi .icon{width:36px;height:36px;font-size:14px}
+    .kpi h3{font-size:0.75rem}
+    .kpi .v{font-size:1.05rem}
+    .header-card{padding:10px}
+    .quick-actions{flex-direction:column}
+    .quick-btn{width:100%;text-align:left;padding:10px;border-radius:8px}
+    .embed{height:360px}
+    /* Dataframe and charts: make them take full width and be scrollable */
+    .stDataFrame, .stTable, .element-container{width:100% !important}
+    .streamlit-expanderHeader{font-size:0.95rem}
+}
+
+@media (max-width: 420px) {
+    /* Further reduction for small phones */
+    .kpi{flex-direction:column;align-items:flex-start}
+    .kpi .icon{width:34px;height:34px}
+    .kpi .v{font-size:1rem}
+    .header-card{padding:8px}
+    .small{font-size:0.85rem}
+    .embed{height:300px}
+}
+</style>
+"""
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# ======================
+# Danh mục cận lâm sàng thường dùng
+# ======================
+COMMON_TESTS: List[Tuple[str, str]] = [
+    ("XN máu", "Tổng phân tích tế bào máu"),
+    ("XN máu", "Sinh hoá cơ bản"),
+    ("XN máu", "Đông máu"),
+    ("XN máu", "Đường huyết"),
+    ("XN máu", "HbA1c"),
+    ("X-quang", "X-quang ngực thẳng"),
+    ("Siêu âm", "Siêu âm ổ bụng"),
+    ("CT", "CT sọ não không cản quang"),
+    ("Khác", "Điện tim"),
+]
+# Nhãn hiển thị trong các multiselect CLS và tra ngược nhãn -> (loại, nội dung); dựng ở mức module
+# (Streamlit chạy lại module mỗi rerun nên vẫn dựng lại mỗi lượt, nhưng không lặp lại trong từng form / lần lưu)
+COMMON_TESTS_LABELS: List[str] = [f"{t[0]} — {t[1]}" for t in COMMON_TESTS]
+COMMON_TESTS_BY_LABEL: Dict[str, Tuple[str, str]] = dict(zip(COMMON_TESTS_LABELS, COMMON_TESTS))
+ORDER_TYPES: List[str] = sorted({"XN máu", "X-quang", "CT", "Siêu âm", "Khác"} | {t[0] for t in COMMON_TESTS})
+
+# ======================
+# Helpers DB
+# ======================
+def _open_conn() -> sqlite3.Connection:
+    # Kết nối sống suốt tiến trình -> statement cache của sqlite3 giữ câu lệnh đã prepare; nới rộng cho các câu IN(...) / lọc động
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    # unaccent(): bỏ dấu + chữ thường, dùng cho cột name_ascii (tìm tên không dấu trong SQL)
+    conn.create_function("unaccent", 1, _strip_accents, deterministic=True)
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def get_conn() -> sqlite3.Connection:
+    """Kết nối GHI dùng chung cho cả tiến trình (không mở lại mỗi lần); chỉ dùng khi giữ get_write_lock()."""
+    conn = _open_conn()
+    # WAL: đọc không bị chặn khi đang ghi; synchronous=NORMAL là đủ an toàn khi dùng WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def _read_pool() -> "queue.SimpleQueue[sqlite3.Connection]":
+    return queue.SimpleQueue()
+
+@contextlib.contextmanager
+def read_conn():
+    """Mượn 1 kết nối chỉ-đọc từ pool (mở thêm khi các phiên đọc cùng lúc), trả lại khi xong.
+    Kết nối riêng với kết nối ghi -> nhờ WAL chỉ thấy dữ liệu đã commit và không phải chờ luồng đang ghi."""
+    pool = _read_pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_conn()
+        conn.execute("PRAGMA query_only=ON")
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock() -> threading.Lock:
+    """Các phiên dùng chung 1 kết nối ghi -> ghi phải tuần tự để transaction không xen nhau."""
+    return threading.Lock()
+
+# Phiên bản dữ liệu theo bảng: ghi vào bảng nào thì chỉ cache của truy vấn đọc bảng đó bị bỏ
+_READ_TABLES_RE = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)", re.IGNORECASE)
+_WRITE_TABLE_RE = re.compile(r"^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|UPDATE|DELETE\s+FROM)\s+([A-Za-z_]\w*)", re.IGNORECASE)
+
+@st.cache_resource(show_spinner=False)
+def _table_versions() -> Dict[str, int]:
+    return {}
+
+def table_version(table: str) -> int:
+    return _table_versions().get(table, 0)
+
+def bump_tables(*tables: str) -> None:
+    versions = _table_versions()
+    for t in tables:
+        versions[t] = versions.get(t, 0) + 1
+
+def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
+    cur = conn.execute(f"PRAGMA table_info({table})")
+    cols = [r[1] for r in cur.fetchall()]
+    return col in cols
+
+# Cùng vòng đời với kết nối dùng chung: tạo bảng/migration 1 lần mỗi tiến trình, không khóa ghi + PRAGMA table_info mỗi rerun
+@st.cache_resource(show_spinner=False)
+def init_db() -> bool:
+    """Tạo bảng/migration; trả về True nếu có bảng FTS5 patients_fts (xem fts_match)."""
     os.makedirs(DUTY_DIR, exist_ok=True)
     os.makedirs(PATIENT_UPLOAD_DIR, exist_ok=True)
-    with get_conn() as conn:
+    with get_write_lock(), get_conn() as conn:
         c = conn.cursor()
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            medical_id TEXT,
-            name TEXT,
-            dob TEXT,
-            ward TEXT,
-            bed TEXT,
-            admission_date TEXT,
-            discharge_date TEXT,
-            severity INTEGER,
-            surgery_needed INTEGER,
-            planned_treatment_days INTEGER,
-            meds TEXT,
-            notes TEXT,
-            active INTEGER DEFAULT 1,
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medical_id TEXT,
+            name TEXT,
+            dob TEXT,
+            ward TEXT,
+            bed TEXT,
+            admission_date TEXT,
+            discharge_date TEXT,
+            severity INTEGER,
+            surgery_needed INTEGER,
+            planned_treatment_days INTEGER,
+            meds TEXT,
+            notes TEXT,
+            active INTEGER DEFAULT 1,
             diagnosis TEXT,
             operated INTEGER DEFAULT 0
         )""")
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER,
-            order_type TEXT,
-            description TEXT,
-            date_ordered TEXT,
-            scheduled_date TEXT,
-            status TEXT,
-            result TEXT,
-            result_date TEXT,
-            FOREIGN KEY(patient_id) REFERENCES patients(id)
-        )""")
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS ward_rounds (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER,
-            visit_date TEXT,
-            general_status TEXT,
-            system_exam TEXT,
-            plan TEXT,
-            extra_tests TEXT,
-            extra_tests_note TEXT,
-            created_at TEXT,
-            FOREIGN KEY(patient_id) REFERENCES patients(id)
-        )""")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            order_type TEXT,
+            description TEXT,
+            date_ordered TEXT,
+            scheduled_date TEXT,
+            status TEXT,
+            result TEXT,
+            result_date TEXT,
+            FOREIGN KEY(patient_id) REFERENCES patients(id)
+        )""")
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS ward_rounds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            visit_date TEXT,
+            general_status TEXT,
+            system_exam TEXT,
+            plan TEXT,
+            extra_tests TEXT,
+            extra_tests_note TEXT,
+            created_at TEXT,
+            FOREIGN KEY(patient_id) REFERENCES patients(id)
+        )""")
         c.execute("""
         CREATE TABLE IF NOT EXISTS duty_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            scope TEXT,           -- 'hospital' | 'department'
-            filename TEXT,
-            mime TEXT,
-            path TEXT,
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT,           -- 'hospital' | 'department'
+            filename TEXT,
+            mime TEXT,
+            path TEXT,
             uploaded_at TEXT
         )""")
         c.execute("""
@@ -176,12 +251,12 @@ def init_db() -> None:
             FOREIGN KEY(patient_id) REFERENCES patients(id)
         )""")
         conn.commit()
-
-        # Migration an toàn (nếu thiếu cột)
-        if not _column_exists(conn, "patients", "diagnosis"):
-            try:
-                conn.execute("ALTER TABLE patients ADD COLUMN diagnosis TEXT"); conn.commit()
-            except Exception: pass
+
+        # Migration an toàn (nếu thiếu cột)
+        if not _column_exists(conn, "patients", "diagnosis"):
+            try:
+                conn.execute("ALTER TABLE patients ADD COLUMN diagnosis TEXT"); conn.commit()
+            except Exception: pass
         if not _column_exists(conn, "patients", "operated"):
             try:
                 conn.execute("ALTER TABLE patients ADD COLUMN operated INTEGER DEFAULT 0"); conn.commit()
@@ -198,70 +273,312 @@ def init_db() -> None:
             try:
                 conn.execute("ALTER TABLE patients ADD COLUMN discharge_advice TEXT"); conn.commit()
             except Exception: pass
-
-        # Clean nhẹ
-        try:
-            conn.execute("UPDATE patients SET severity=0 WHERE severity IS NULL"); conn.commit()
-        except Exception: pass
-
-def _exec(query: str, params: tuple = ()) -> None:
-    with get_conn() as conn:
-        conn.execute(query, params)
-        conn.commit()
-
-def add_patient(patient: Dict[str, Any]) -> int:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO patients
-            (medical_id, name, dob, ward, bed, admission_date, severity, surgery_needed,
-             planned_treatment_days, meds, notes, active, diagnosis, operated)
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,1,?,?)
-        """, (
-            patient.get("medical_id"),
-            patient.get("name"),
-            patient.get("dob"),
-            patient.get("ward"),
-            patient.get("bed"),
-            patient.get("admission_date"),
-            patient.get("severity"),
-            1 if patient.get("surgery_needed") else 0,
-            patient.get("planned_treatment_days"),
-            patient.get("meds"),
-            patient.get("notes"),
-            patient.get("diagnosis"),
-            1 if patient.get("operated") else 0,
-        ))
-        conn.commit()
-        return int(cur.lastrowid)
-
-def update_patient_operated(patient_id: int, operated: bool) -> None:
-    _exec("UPDATE patients SET operated=? WHERE id=?", (1 if operated else 0, patient_id))
-
-def add_order(order: Dict[str, Any]) -> None:
-    _exec("""
-    INSERT INTO orders
-    (patient_id, order_type, description, date_ordered, scheduled_date, status)
-    VALUES (?,?,?,?,?,?)
-    """, (order["patient_id"], order["order_type"], order.get("description", ""),
-          order.get("date_ordered"), order.get("scheduled_date"), order.get("status", "pending")))
-
-def add_ward_round(rec: Dict[str, Any]) -> None:
-    _exec("""
-    INSERT INTO ward_rounds
-    (patient_id, visit_date, general_status, system_exam, plan, extra_tests, extra_tests_note, created_at)
-    VALUES (?,?,?,?,?,?,?,?)
-    """, (
-        rec["patient_id"], rec["visit_date"], rec.get("general_status",""),
-        rec.get("system_exam",""), rec.get("plan",""),
-        rec.get("extra_tests",""), rec.get("extra_tests_note",""),
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    ))
-
-def mark_order_done(order_id: int, result_text: Optional[str] = None) -> None:
-    now = date.today().strftime(DATE_FMT)
-    _exec("UPDATE orders SET status='done', result=?, result_date=? WHERE id=?", (result_text, now, order_id))
-
+        if not _column_exists(conn, "patients", "name_ascii"):
+            try:
+                conn.execute("ALTER TABLE patients ADD COLUMN name_ascii TEXT"); conn.commit()
+            except Exception: pass
+        if not _column_exists(conn, "duty_files", "sha256"):
+            try:
+                conn.execute("ALTER TABLE duty_files ADD COLUMN sha256 TEXT"); conn.commit()
+            except Exception: pass
+        if not _column_exists(conn, "orders", "scheduled_julian"):
+            try:
+                conn.execute("ALTER TABLE orders ADD COLUMN scheduled_julian INTEGER")
+                conn.execute("UPDATE orders SET scheduled_julian = CAST(julianday(scheduled_date) AS INTEGER) WHERE scheduled_date IS NOT NULL")
+                conn.commit()
+            except Exception: pass
+        if not _column_exists(conn, "patients", "admission_julian"):
+            try:
+                conn.execute("ALTER TABLE patients ADD COLUMN admission_julian INTEGER")
+                conn.execute("UPDATE patients SET admission_julian = CAST(julianday(admission_date) AS INTEGER) WHERE admission_date IS NOT NULL")
+                conn.commit()
+            except Exception: pass
+        if not _column_exists(conn, "patients", "discharge_julian"):
+            try:
+                conn.execute("ALTER TABLE patients ADD COLUMN discharge_julian INTEGER")
+                conn.execute("UPDATE patients SET discharge_julian = CAST(julianday(discharge_date) AS INTEGER) WHERE discharge_date IS NOT NULL")
+                conn.commit()
+            except Exception: pass
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS patients_julian_ai AFTER INSERT ON patients BEGIN
+            UPDATE patients SET admission_julian = CAST(julianday(new.admission_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS patients_julian_au AFTER UPDATE OF admission_date ON patients BEGIN
+            UPDATE patients SET admission_julian = CAST(julianday(new.admission_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        # discharge_julian: NULL khi chưa ra viện hoặc ngày ra lỗi -> lọc khoảng ngày xuất viện bằng so sánh số nguyên trên index
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS patients_discharge_julian_ai AFTER INSERT ON patients WHEN new.discharge_date IS NOT NULL BEGIN
+            UPDATE patients SET discharge_julian = CAST(julianday(new.discharge_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS patients_discharge_julian_au AFTER UPDATE OF discharge_date ON patients BEGIN
+            UPDATE patients SET discharge_julian = CAST(julianday(new.discharge_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        # scheduled_julian (số ngày, INTEGER) luôn đi theo scheduled_date: trigger giữ đồng bộ cho mọi chỗ ghi
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS orders_julian_ai AFTER INSERT ON orders BEGIN
+            UPDATE orders SET scheduled_julian = CAST(julianday(new.scheduled_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS orders_julian_au AFTER UPDATE OF scheduled_date ON orders BEGIN
+            UPDATE orders SET scheduled_julian = CAST(julianday(new.scheduled_date) AS INTEGER) WHERE id = new.id;
+        END""")
+        # Backfill tên không dấu cho dữ liệu cũ (chỉ các dòng còn thiếu)
+        try:
+            conn.execute("UPDATE patients SET name_ascii=unaccent(name) WHERE name_ascii IS NULL AND name IS NOT NULL"); conn.commit()
+        except Exception: pass
+
+        # Index cho các truy vấn lọc theo ngày / BN
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_name_ascii ON patients(name_ascii)")
+        # (discharge_date, ward, name): danh sách xuất viện theo ngày đọc đúng thứ tự ORDER BY ward, name, không sắp lại
+        conn.execute("DROP INDEX IF EXISTS idx_patients_discharge")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_discharge_ward ON patients(discharge_date, ward, name)")
+        # Phủ (covering) cho bảng xem trước báo cáo ngày: đọc hết từ index, không chạm bảng orders.
+        # Cột đầu vẫn là scheduled_date nên thay luôn idx_orders_sched (lọc theo ngày / khoảng ngày)
+        conn.execute("DROP INDEX IF EXISTS idx_orders_sched")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_sched_cov ON orders(scheduled_date, patient_id, order_type, description, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ward_rounds_pid_date ON ward_rounds(patient_id, visit_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_active_ward ON patients(active, ward, name)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_admission ON patients(admission_date DESC)")
+        # medical_id đã có UNIQUE idx_patients_medical_id trong DB gốc -> bỏ index trùng (chỉ tốn thêm khi ghi)
+        conn.execute("DROP INDEX IF EXISTS idx_patients_medid")
+        # DB gốc có idx_orders_patient(patient_id) 1 cột: đặt tên mới cho index (patient_id, scheduled_date)
+        # để không bị IF NOT EXISTS bỏ qua, và bỏ index cũ vì nó chỉ là tiền tố của index mới
+        conn.execute("DROP INDEX IF EXISTS idx_orders_patient")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_patient_sched ON orders(patient_id, scheduled_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_sched ON orders(status, scheduled_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_duty_scope_time ON duty_files(scope, uploaded_at DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_duty_sha256 ON duty_files(sha256)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_julian ON orders(scheduled_julian)")
+        # Partial index chỉ chứa chỉ định chưa xong (covering cho KPI order): đọc index nhỏ thay vì quét cả lịch sử orders
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_open ON orders(patient_id, scheduled_julian, status) WHERE status IS NOT 'done'")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_admission_julian ON patients(admission_julian)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_discharge_julian ON patients(discharge_julian)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_date_ordered ON orders(date_ordered)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ward_rounds_date ON ward_rounds(visit_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_files_pid ON patient_files(patient_id, uploaded_at)")
+        conn.commit()
+
+        # FTS5 (trigram) cho trang Tìm kiếm: LIKE '%q%' không dùng được B-tree, MATCH thì dùng index
+        # Bỏ qua nếu SQLite không có FTS5/trigram (< 3.34) -> tìm kiếm tự lùi về LIKE
+        try:
+            fts_new = not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='patients_fts'").fetchone()
+            conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+                medical_id, name, ward, content='patients', content_rowid='id', tokenize='trigram'
+            )""")
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+                INSERT INTO patients_fts(rowid, medical_id, name, ward) VALUES (new.id, new.medical_id, new.name, new.ward);
+            END""")
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, medical_id, name, ward) VALUES ('delete', old.id, old.medical_id, old.name, old.ward);
+            END""")
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE OF medical_id, name, ward ON patients BEGIN
+                INSERT INTO patients_fts(patients_fts, rowid, medical_id, name, ward) VALUES ('delete', old.id, old.medical_id, old.name, old.ward);
+                INSERT INTO patients_fts(rowid, medical_id, name, ward) VALUES (new.id, new.medical_id, new.name, new.ward);
+            END""")
+            if fts_new:
+                conn.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()
+        has_fts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='patients_fts'").fetchone() is not None
+
+        # ward_counts: số BN theo phòng do trigger duy trì -> ô chọn phòng đọc vài dòng thay vì DISTINCT trên cả patients
+        wc_new = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='ward_counts'").fetchone()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS ward_counts (
+            ward TEXT PRIMARY KEY,
+            n_total INTEGER NOT NULL DEFAULT 0,
+            n_active INTEGER NOT NULL DEFAULT 0
+        )""")
+        # patients.active cho phép NULL: (active=1) khi đó là NULL -> IFNULL(..., 0) / TOTAL để n_active không thành NULL
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ward_counts_ai AFTER INSERT ON patients
+        WHEN new.ward IS NOT NULL AND new.ward<>'' BEGIN
+            INSERT OR IGNORE INTO ward_counts(ward) VALUES (new.ward);
+            UPDATE ward_counts SET n_total=n_total+1, n_active=n_active+IFNULL(new.active=1, 0) WHERE ward=new.ward;
+        END""")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ward_counts_ad AFTER DELETE ON patients
+        WHEN old.ward IS NOT NULL AND old.ward<>'' BEGIN
+            UPDATE ward_counts SET n_total=n_total-1, n_active=n_active-IFNULL(old.active=1, 0) WHERE ward=old.ward;
+        END""")
+        conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS ward_counts_au AFTER UPDATE OF ward, active ON patients BEGIN
+            UPDATE ward_counts SET n_total=n_total-1, n_active=n_active-IFNULL(old.active=1, 0) WHERE ward=old.ward;
+            INSERT OR IGNORE INTO ward_counts(ward)
+                SELECT new.ward WHERE new.ward IS NOT NULL AND new.ward<>'';
+            UPDATE ward_counts SET n_total=n_total+1, n_active=n_active+IFNULL(new.active=1, 0) WHERE ward=new.ward;
+        END""")
+        if wc_new:
+            conn.execute("""
+            INSERT INTO ward_counts(ward, n_total, n_active)
+            SELECT ward, COUNT(*), TOTAL(active=1) FROM patients
+            WHERE ward IS NOT NULL AND ward<>'' GROUP BY ward""")
+        conn.commit()
+
+        # Clean nhẹ
+        try:
+            conn.execute("UPDATE patients SET severity=0 WHERE severity IS NULL"); conn.commit()
+        except Exception: pass
+
+        # Kết nối sống suốt tiến trình nên optimize lúc mở (1 lần): cập nhật thống kê cho các index mới/cũ
+        # để planner chọn đúng index phủ; analysis_limit giữ ANALYZE nhanh trên DB lớn
+        conn.execute("PRAGMA analysis_limit=400")
+        conn.execute("PRAGMA optimize=0x10002")
+    return has_fts
+
+def _exec(query: str, params: Union[tuple, Dict[str, Any]] = ()) -> None:
+    with get_write_lock(), get_conn() as conn:
+        conn.execute(query, params)
+        conn.commit()
+    m = _WRITE_TABLE_RE.match(query)
+    if m:
+        bump_tables(m.group(1).lower())
+
+_INSERT_PATIENT_SQL = """
+    INSERT INTO patients
+    (medical_id, name, dob, ward, bed, admission_date, severity, surgery_needed,
+     planned_treatment_days, meds, notes, active, diagnosis, operated, name_ascii)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,1,?,?,?)
+"""
+
+def _patient_row(patient: Dict[str, Any]) -> tuple:
+    return (
+        patient.get("medical_id"),
+        patient.get("name"),
+        patient.get("dob"),
+        patient.get("ward"),
+        patient.get("bed"),
+        patient.get("admission_date"),
+        patient.get("severity"),
+        1 if patient.get("surgery_needed") else 0,
+        patient.get("planned_treatment_days"),
+        patient.get("meds"),
+        patient.get("notes"),
+        patient.get("diagnosis"),
+        1 if patient.get("operated") else 0,
+        _strip_accents(patient.get("name")),
+    )
+
+# Chuỗi SQL cố định, tham số đặt tên -> statement cache của kết nối dùng lại câu đã prepare cho mọi lần lưu
+_UPDATE_PATIENT_SQL = """
+    UPDATE patients
+    SET medical_id=:medical_id, name=:name, name_ascii=:name_ascii, ward=:ward, bed=:bed,
+        admission_date=:admission_date, discharge_date=:discharge_date,
+        surgery_needed=:surgery_needed, operated=:operated,
+        diagnosis=:diagnosis, notes=:notes
+    WHERE id=:id
+"""
+
+def update_patient(patient_id: int, fields: Dict[str, Any]) -> None:
+    """Lưu form Chỉnh sửa BN (các cột trong _UPDATE_PATIENT_SQL)."""
+    _exec(_UPDATE_PATIENT_SQL, {
+        **fields,
+        "name_ascii": _strip_accents(fields.get("name")),
+        "surgery_needed": 1 if fields.get("surgery_needed") else 0,
+        "operated": 1 if fields.get("operated") else 0,
+        "id": patient_id,
+    })
+
+def add_patient(patient: Dict[str, Any], orders: List[Dict[str, Any]] = ()) -> int:
+    """Thêm 1 BN, kèm các chỉ định ban đầu (không cần patient_id) trong cùng transaction -> 1 lần commit."""
+    if not orders:
+        return add_patients_bulk([patient])[0]
+    with get_write_lock(), get_conn() as conn:
+        new_id = int(conn.execute(_INSERT_PATIENT_SQL, _patient_row(patient)).lastrowid)
+        conn.executemany(_INSERT_ORDER_SQL, [_order_row({**o, "patient_id": new_id}) for o in orders])
+        conn.commit()
+    bump_tables("patients", "orders")
+    return new_id
+
+def add_patients_bulk(patients: List[Dict[str, Any]]) -> List[int]:
+    """Thêm nhiều BN trong 1 transaction, trả về id theo đúng thứ tự đầu vào."""
+    ids: List[int] = []
+    with get_write_lock(), get_conn() as conn:
+        cur = conn.cursor()
+        for patient in patients:
+            cur.execute(_INSERT_PATIENT_SQL, _patient_row(patient))
+            ids.append(int(cur.lastrowid))
+        conn.commit()
+    bump_tables("patients")
+    return ids
+
+_INSERT_ORDER_SQL = """
+    INSERT INTO orders
+    (patient_id, order_type, description, date_ordered, scheduled_date, status)
+    VALUES (?,?,?,?,?,?)
+"""
+
+def _order_row(order: Dict[str, Any]) -> tuple:
+    return (order["patient_id"], order["order_type"], order.get("description", ""),
+            order.get("date_ordered"), order.get("scheduled_date"), order.get("status", "pending"))
+
+_INSERT_ROUND_SQL = """
+    INSERT INTO ward_rounds
+    (patient_id, visit_date, general_status, system_exam, plan, extra_tests, extra_tests_note, created_at)
+    VALUES (?,?,?,?,?,?,?,?)
+"""
+
+def _round_row(rec: Dict[str, Any]) -> tuple:
+    return (
+        rec["patient_id"], rec["visit_date"], rec.get("general_status",""),
+        rec.get("system_exam",""), rec.get("plan",""),
+        rec.get("extra_tests",""), rec.get("extra_tests_note",""),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+
+def add_order(order: Dict[str, Any]) -> None:
+    _exec(_INSERT_ORDER_SQL, _order_row(order))
+
+def add_orders_bulk(orders: List[Dict[str, Any]]) -> None:
+    """Thêm nhiều chỉ định trong 1 transaction (1 lần commit thay vì k lần)."""
+    if not orders:
+        return
+    with get_write_lock(), get_conn() as conn:
+        conn.executemany(_INSERT_ORDER_SQL, [_order_row(o) for o in orders])
+        conn.commit()
+    bump_tables("orders")
+
+def save_ward_round(rec: Dict[str, Any], operated: bool, orders: List[Dict[str, Any]]) -> None:
+    """Lưu 1 lần khám: cờ đã PT + bản ghi đi buồng + các CLS kèm theo trong cùng 1 transaction."""
+    with get_write_lock(), get_conn() as conn:
+        conn.execute("UPDATE patients SET operated=? WHERE id=?", (1 if operated else 0, rec["patient_id"]))
+        conn.execute(_INSERT_ROUND_SQL, _round_row(rec))
+        if orders:
+            conn.executemany(_INSERT_ORDER_SQL, [_order_row(o) for o in orders])
+        conn.commit()
+    bump_tables("patients", "ward_rounds", "orders")
+
+ORDER_STATUSES = ["pending", "scheduled", "done"]
+
+def mark_order_done(order_id: int, result_text: Optional[str] = None) -> None:
+    set_orders_status([(order_id, "done", result_text)])
+
+def set_orders_status(changes: List[Tuple[int, str, Optional[str]]]) -> None:
+    """Cập nhật (id, trạng thái, kết quả) cho nhiều chỉ định trong 1 transaction.
+    Chuyển sang 'done' ghi ngày kết quả là hôm nay; đã 'done' từ trước thì giữ ngày cũ (sửa kết quả không đổi ngày)."""
+    if not changes:
+        return
+    now = date.today().strftime(DATE_FMT)
+    rows = [(status, result, status, now, order_id) for order_id, status, result in changes]
+    with get_write_lock(), get_conn() as conn:
+        conn.executemany("""
+            UPDATE orders SET status=?, result=?,
+                   result_date=CASE WHEN ?='done' THEN COALESCE(result_date, ?) END
+            WHERE id=?""", rows)
+        conn.commit()
+    bump_tables("orders")
+
 def discharge_patient(patient_id: int, prescription: str = "", advice: str = "") -> None:
     now_day = date.today().strftime(DATE_FMT)
     now_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -277,11 +594,107 @@ def undo_discharge(patient_id: int) -> None:
         SET discharge_date=NULL, discharge_time=NULL, discharge_prescription=NULL, discharge_advice=NULL, active=1
         WHERE id=?
     """, (patient_id,))
-
-@st.cache_data(ttl=30, show_spinner=False)
+
+def fts_match(q: str, cols: str = "") -> Optional[str]:
+    """Biểu thức MATCH (chuỗi con, trigram) cho patients_fts; None nếu không có FTS5 hoặc q < 3 ký tự -> dùng LIKE.
+    cols: giới hạn cột kiểu "medical_id name"."""
+    q = q.strip()
+    # HAS_FTS kiểm tra 1 lần trong init_db (cache_resource), không truy vấn sqlite_master mỗi lần gõ phím
+    if len(q) < 3 or not HAS_FTS:
+        return None
+    phrase = '"' + q.replace('"', '""') + '"'
+    return f"{{{cols}}} : {phrase}" if cols else phrase
+
+def search_patients(q: str) -> pd.DataFrame:
+    """Tìm BN theo mã BA / tên / phòng (chuỗi con). Dùng FTS5 khi có và q đủ 3 ký tự, ngược lại LIKE."""
+    q = q.strip()
+    phrase = fts_match(q)
+    if phrase is not None:
+        return query_df("""
+            SELECT p.id, p.medical_id, p.name, p.ward, p.bed, p.admission_date, p.diagnosis, p.notes,
+                   p.surgery_needed, p.operated, p.active
+            FROM patients_fts f JOIN patients p ON p.id = f.rowid
+            WHERE patients_fts MATCH ?
+            ORDER BY p.admission_date DESC
+        """, (phrase,))
+    q_like = f"%{q}%"
+    return query_df("""
+        SELECT id, medical_id, name, ward, bed, admission_date, diagnosis, notes, surgery_needed, operated, active
+        FROM patients
+        WHERE medical_id LIKE ? OR name LIKE ? OR ward LIKE ?
+        ORDER BY admission_date DESC
+    """, (q_like, q_like, q_like))
+
+def edit_candidates(q: str, active_only: bool) -> List[Dict[str, Any]]:
+    """Danh sách BN cho ô chọn ở trang Chỉnh sửa: 1 truy vấn gồm cả lọc active và từ khóa (mã BA / tên)."""
+    where, params = ["1=1"], []
+    if active_only:
+        where.append("active=1")
+    name_match = fts_match(q, "medical_id name")
+    if name_match is not None:
+        where.append("id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)")
+        params.append(name_match)
+    elif q.strip():
+        q_like = f"%{q.strip()}%"
+        where.append("(medical_id LIKE ? OR name LIKE ?)")
+        params += [q_like, q_like]
+    order_by = "ward, name" if active_only else "active DESC, ward, name"
+    return query_rows(
+        f"SELECT id, medical_id, name, ward FROM patients WHERE {' AND '.join(where)} ORDER BY {order_by}",
+        tuple(params)
+    )
+
+# Bảng do trigger ghi theo bảng gốc -> dùng phiên bản của bảng gốc làm khóa cache
+_DERIVED_TABLES = {"patients_fts": "patients", "ward_counts": "patients"}
+
+def _read_versions(sql: str) -> tuple:
+    tables = sorted({_DERIVED_TABLES.get(t.lower(), t.lower()) for t in _READ_TABLES_RE.findall(sql)})
+    return tuple((t, table_version(t)) for t in tables)
+
+def _downcast_ints(df: pd.DataFrame) -> pd.DataFrame:
+    """Thu nhỏ cột số nguyên (id, cờ 0/1, julian...) về int8/16/32 theo giá trị thực tế.
+    Cột int64 từ read_sql_query chắc chắn không có NULL nên downcast không đổi ngữ nghĩa;
+    cột chuỗi giữ object để None vẫn là None (category sẽ biến None thành NaN)."""
+    int_cols = df.select_dtypes(include="int64").columns
+    if len(int_cols):
+        df[int_cols] = df[int_cols].apply(pd.to_numeric, downcast="integer")
+    return df
+
+@st.cache_data(ttl=300, max_entries=QUERY_CACHE_ENTRIES, show_spinner=False)
+def _query_df_cached(sql: str, params: tuple, versions: tuple) -> pd.DataFrame:
+    # Thân hàm chỉ chạy khi cache miss -> bật log DEBUG "ward_tracker" để kiểm tra tỉ lệ trúng cache
+    log.debug("query_df miss %s %s", versions, " ".join(sql.split())[:80])
+    with read_conn() as conn:
+        return _downcast_ints(pd.read_sql_query(sql, conn, params=params))
+
 def query_df(sql: str, params: tuple = ()) -> pd.DataFrame:
-    with get_conn() as conn:
-        return pd.read_sql_query(sql, conn, params=params)
+    """SELECT -> DataFrame, cache theo (sql, params, phiên bản các bảng được đọc)."""
+    return _query_df_cached(sql, params, _read_versions(sql))
+
+@st.cache_data(ttl=300, max_entries=QUERY_CACHE_ENTRIES, show_spinner=False)
+def _query_rows_cached(sql: str, params: tuple, versions: tuple) -> List[Dict[str, Any]]:
+    log.debug("query_rows miss %s %s", versions, " ".join(sql.split())[:80])
+    with read_conn() as conn:
+        return [dict(r) for r in conn.execute(sql, params)]
+
+def query_rows(sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+    """Như query_df nhưng trả list[dict], không qua pandas — dùng khi chỉ lặp để hiển thị."""
+    return _query_rows_cached(sql, params, _read_versions(sql))
+
+def query_scalar(sql: str, params: tuple = ()) -> Any:
+    """Giá trị cột đầu của dòng đầu (COUNT, SUM...) qua cùng cache của query_rows; không có dòng -> None."""
+    rows = query_rows(sql, params)
+    return next(iter(rows[0].values())) if rows else None
+
+def query_one(sql: str, params: tuple = ()) -> Optional[Dict[str, Any]]:
+    """Dòng đầu dạng dict (đọc 1 BN...) qua cache của query_rows, không dựng DataFrame; không có dòng -> None."""
+    rows = query_rows(sql, params)
+    return rows[0] if rows else None
+
+def list_wards(active_only: bool = False) -> List[str]:
+    """Danh sách phòng cho các ô lọc: đọc ward_counts (vài dòng), cache qua query_rows theo phiên bản bảng patients."""
+    count_col = "n_active" if active_only else "n_total"
+    return [r["ward"] for r in query_rows(f"SELECT ward FROM ward_counts WHERE {count_col} > 0 ORDER BY ward")]
 
 def sanitize_filename(name: str) -> str:
     base = pathlib.Path(name).name
@@ -293,8 +706,9 @@ def save_patient_file(patient_id: int, uploaded_file, note: str = "") -> None:
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     final_name = f"patient_{patient_id}_{ts}_{raw_name}"
     full_path = os.path.join(PATIENT_UPLOAD_DIR, final_name)
+    uploaded_file.seek(0)
     with open(full_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+        shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
     mime = uploaded_file.type or mimetypes.guess_type(raw_name)[0] or "application/octet-stream"
     _exec("""
         INSERT INTO patient_files(patient_id, filename, mime, path, note, uploaded_at)
@@ -302,295 +716,454 @@ def save_patient_file(patient_id: int, uploaded_file, note: str = "") -> None:
     """, (patient_id, raw_name, mime, full_path, note.strip(), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
 def reset_clinical_data() -> None:
-    with get_conn() as conn:
+    with get_write_lock(), get_conn() as conn:
         conn.execute("DELETE FROM patient_files")
         conn.execute("DELETE FROM ward_rounds")
         conn.execute("DELETE FROM orders")
         conn.execute("DELETE FROM patients")
         conn.execute("DELETE FROM sqlite_sequence WHERE name IN ('patient_files','ward_rounds','orders','patients')")
         conn.commit()
-
-# ======================
-# Utilities
-# ======================
-def days_between(d1: Optional[str], d2: Optional[str] = None) -> Optional[int]:
-    if not d1:
-        return None
-    d1d = datetime.strptime(d1, DATE_FMT).date()
-    d2d = datetime.strptime(d2, DATE_FMT).date() if d2 else date.today()
-    return (d2d - d1d).days
-
-def calc_age(dob_str: Optional[str]) -> Optional[int]:
-    if not dob_str:
-        return None
-    try:
-        d = datetime.strptime(dob_str, DATE_FMT).date()
-        today = date.today()
-        return today.year - d.year - ((today.month, today.day) < (d.month, d.day))
-    except Exception:
-        return None
-
-def export_excel(sheets: Dict[str, pd.DataFrame]) -> BytesIO:
-    buffer = BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        for name, df in sheets.items():
-            df.to_excel(writer, sheet_name=name[:30], index=False)
-    buffer.seek(0)
-    return buffer
-
-def safe_rerun():
-    try:
-        st.rerun()
-    except Exception:
-        st.rerun()
-
-def load_sample_data():
-    p1 = {"medical_id":"BN001","name":"Nguyễn A","dob":"1975-02-10","ward":"304","bed":"01",
-          "admission_date":date.today().strftime(DATE_FMT),"severity":4,"surgery_needed":1,
-          "planned_treatment_days":7,"meds":"Thuốc A","notes":"Theo dõi huyết áp","diagnosis":"Tăng huyết áp","operated":0}
-    p2 = {"medical_id":"BN002","name":"Trần B","dob":"1965-06-15","ward":"305","bed":"02",
-          "admission_date":(date.today()-timedelta(days=2)).strftime(DATE_FMT),"severity":2,
-          "surgery_needed":0,"planned_treatment_days":3,"meds":"Thuốc B","notes":"","diagnosis":"ĐTĐ typ 2","operated":1}
-    p3 = {"medical_id":"BN003","name":"Lê C","dob":"1988-11-22","ward":"306","bed":"05",
-          "admission_date":(date.today()-timedelta(days=6)).strftime(DATE_FMT),"severity":5,
-          "surgery_needed":1,"planned_treatment_days":10,"meds":"Thuốc C","notes":"Theo dõi sau mổ","diagnosis":"Chấn thương sọ não","operated":0}
-    id1 = add_patient(p1); id2 = add_patient(p2); id3 = add_patient(p3)
-
-    add_order({"patient_id":id1,"order_type":"CT","description":"CT não",
-               "date_ordered":date.today().strftime(DATE_FMT),
-               "scheduled_date":(date.today()+timedelta(days=1)).strftime(DATE_FMT),
-               "status":"scheduled"})
-    add_order({"patient_id":id2,"order_type":"XN máu","description":"Tổng phân tích",
-               "date_ordered":(date.today()-timedelta(days=1)).strftime(DATE_FMT),
-               "scheduled_date":date.today().strftime(DATE_FMT),
-               "status":"pending"})
-    add_order({"patient_id":id3,"order_type":"Siêu âm","description":"Ổ bụng",
-               "date_ordered":date.today().strftime(DATE_FMT),
-               "scheduled_date":(date.today()+timedelta(days=2)).strftime(DATE_FMT),
-               "status":"scheduled"})
-
-# ======================
-# Điều hướng: PAGES + helper
-# ======================
+    bump_tables("patient_files", "ward_rounds", "orders", "patients")
+
+# ======================
+# Utilities
+# ======================
+# Streamlit chạy lại cả module mỗi rerun -> lru_cache chỉ sống trong 1 lượt chạy (tên lặp lại trong cùng lượt);
+# riêng hàm unaccent đăng ký trên kết nối cache_resource thì giữ bản (và cache) của lần mở kết nối
+@functools.lru_cache(maxsize=4096)
+def _strip_accents(s: str) -> str:
+    if not isinstance(s, str):
+        return ""
+    s = s.lower().strip()
+    return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
+
+@functools.lru_cache(maxsize=4096)
+def _to_date(s: Optional[str]) -> Optional[date]:
+    """Chuỗi ngày -> date, lỗi/trống -> None. DATE_FMT là ISO nên dùng date.fromisoformat (parser C);
+    lru_cache chỉ dùng lại kết quả trong cùng 1 lượt chạy (module được chạy lại mỗi rerun nên cache cũng tạo lại)."""
+    if not s: return None
+    try:
+        return date.fromisoformat(s)
+    except Exception:
+        return None
+
+def days_between(d1: Optional[str], d2: Optional[str] = None) -> Optional[int]:
+    d1d = _to_date(d1)
+    d2d = _to_date(d2) if d2 else date.today()
+    if d1d is None or d2d is None:
+        return None
+    return (d2d - d1d).days
+
+def julian_day(d: date) -> int:
+    """Bằng CAST(julianday('YYYY-MM-DD') AS INTEGER) của SQLite cho cùng ngày."""
+    return d.toordinal() + 1721424
+
+def days_since(julian: pd.Series, until: Optional[date] = None) -> pd.Series:
+    """Bản vector của days_between trên cột *_julian (đã tính sẵn khi ghi): chỉ là 1 phép trừ số nguyên; ngày lỗi -> NaN."""
+    return julian_day(until or date.today()) - julian
+
+def ages_from_dob(dob: pd.Series, today: Optional[date] = None) -> pd.Series:
+    """Bản vector của calc_age cho cả cột ngày sinh; ngày lỗi/trống -> <NA>.
+    Tuổi = (YYYYMMDD hôm nay - YYYYMMDD ngày sinh) // 10000: 1 phép trừ + 1 phép chia nguyên, không cần so tháng/ngày."""
+    t = today or date.today()
+    d = pd.to_datetime(dob, format=DATE_FMT, errors="coerce", cache=True)
+    dob_key = d.dt.year * 10000 + d.dt.month * 100 + d.dt.day
+    return ((t.year * 10000 + t.month * 100 + t.day - dob_key) // 10000).astype("Int64")
+
+def calc_age(dob_str: Optional[str]) -> Optional[int]:
+    d = _to_date(dob_str)
+    if d is None:
+        return None
+    today = date.today()
+    return today.year - d.year - ((today.month, today.day) < (d.month, d.day))
+
+def _excel_rows(df: pd.DataFrame, chunk_rows: int = 5000):
+    yield [str(c) for c in df.columns]
+    # Đổi sang object (NaN -> None) theo từng khúc: bản sao tạm chỉ chunk_rows dòng, không nhân đôi cả bảng
+    for start in range(0, len(df), chunk_rows):
+        part = df.iloc[start:start + chunk_rows]
+        yield from part.astype(object).where(part.notna(), None).itertuples(index=False, name=None)
+
+def export_excel(sheets: Dict[str, pd.DataFrame]) -> BytesIO:
+    buffer = BytesIO()
+    try:
+        import xlsxwriter
+    except ImportError:
+        xlsxwriter = None
+    if xlsxwriter is not None:
+        # xlsxwriter constant_memory: mỗi dòng được ghi xuống file tạm ngay, bộ nhớ không tăng theo số ô
+        wb = xlsxwriter.Workbook(buffer, {"constant_memory": True, "strings_to_urls": False})
+        for name, df in sheets.items():
+            ws = wb.add_worksheet(name[:30])
+            for r, row in enumerate(_excel_rows(df)):
+                ws.write_row(r, 0, row)
+        wb.close()
+    else:
+        # Không có xlsxwriter: openpyxl write_only, cũng ghi từng dòng thay vì giữ đối tượng ô trong RAM
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        for name, df in sheets.items():
+            ws = wb.create_sheet(title=name[:30])
+            for row in _excel_rows(df):
+                ws.append(row)
+        wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+# Các file Excel/tệp đọc sẵn là bytes/str bất biến -> cache_resource trả lại đúng object đã dựng cho mọi lần tải,
+# không unpickle 1 bản sao mới mỗi lần như cache_data (file lớn không bị nhân đôi bộ nhớ khi tải)
+@st.cache_resource(ttl=600, max_entries=16, show_spinner=False)
+def build_discharge_xls(sheet_name: str, date_str: str, ids_tuple: tuple, patients_ver: int, _df: pd.DataFrame) -> bytes:
+    """File Excel xuất viện theo ngày; khóa cache là (sheet, ngày, danh sách id, phiên bản bảng patients), _df không được băm."""
+    return export_excel({sheet_name: _df}).getvalue()
+
+def _julian_range(first: str, last: str) -> Tuple[int, int]:
+    """Khoảng ngày ISO [first, last] -> (julian đầu, julian cuối) để so sánh số nguyên trên cột *_julian."""
+    return julian_day(date.fromisoformat(first)), julian_day(date.fromisoformat(last))
+
+def count_patients_month(first: str, last: str) -> int:
+    """Số BN nhập viện trong khoảng [first, last] — chỉ COUNT, không kéo các dòng về."""
+    return int(query_scalar("SELECT COUNT(*) FROM patients WHERE admission_julian BETWEEN ? AND ?",
+                            _julian_range(first, last)))
+
+def fetch_patients_month(first: str, last: str) -> pd.DataFrame:
+    """Toàn bộ BN nhập viện trong tháng; chỉ gọi khi xuất file."""
+    return query_df("SELECT * FROM patients WHERE admission_julian BETWEEN ? AND ?", _julian_range(first, last))
+
+PATIENTS_ON_DAY_WHERE = "admission_date <= ? AND (discharge_date IS NULL OR discharge_date >= ?)"
+
+@st.cache_resource(ttl=600, max_entries=16, show_spinner="Đang tạo Excel...")
+def build_day_report(dstr: str, patients_ver: int, orders_ver: int) -> bytes:
+    """File Excel báo cáo ngày (BN có mặt + chỉ định trong ngày); khóa cache (ngày, phiên bản patients/orders)."""
+    patients_on_day = query_df(f"SELECT * FROM patients WHERE {PATIENTS_ON_DAY_WHERE}", (dstr, dstr))
+    return export_excel({"patients_on_day": patients_on_day, "orders_day": orders_on_day(dstr)}).getvalue()
+
+@st.cache_resource(ttl=600, max_entries=16, show_spinner="Đang tạo Excel...")
+def build_month_report(first: str, last: str, patients_ver: int) -> bytes:
+    """File Excel báo cáo tháng; khóa cache (first, last, phiên bản bảng patients) nên bấm tải lại không phải dựng lại."""
+    return export_excel({"patients_month": fetch_patients_month(first, last)}).getvalue()
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _read_file_bytes(path: str, mtime: float) -> bytes:
+    """Đọc nội dung tệp; khóa (path, mtime) nên tệp không đổi thì không đọc lại đĩa mỗi lần rerun."""
+    with open(path, "rb") as f:
+        return f.read()
+
+def _db_backup_bytes() -> bytes:
+    """Nội dung file DB để tải backup; chỉ đọc khi người dùng bấm tải (không giữ trong bộ nhớ/cache)."""
+    # Backup API chép từ 1 snapshot đọc (gồm cả dữ liệu còn trong WAL) -> bản sao nhất quán dù đang có phiên ghi,
+    # không như đọc thẳng file .db (có thể bị ghi xen giữa lúc đọc)
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, "backup.db")
+        out = sqlite3.connect(out_path)
+        try:
+            with read_conn() as conn:
+                conn.backup(out)
+        finally:
+            out.close()
+        return pathlib.Path(out_path).read_bytes()
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _pdf_b64(path: str, mtime: float) -> str:
+    """Base64 của PDF để nhúng; cache theo (path, mtime) để mở lại expander không phải mã hóa lại."""
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+def safe_rerun():
+    # st.rerun() báo hiệu bằng ngoại lệ BaseException nên không cần try/except. Không xóa cache nào ở đây:
+    # lệnh ghi đã tăng phiên bản đúng bảng bị sửa -> lần chạy lại chỉ đọc lại truy vấn trên bảng đó
+    st.rerun()
+
+def load_sample_data():
+    p1 = {"medical_id":"BN001","name":"Nguyễn A","dob":"1975-02-10","ward":"304","bed":"01",
+          "admission_date":date.today().strftime(DATE_FMT),"severity":4,"surgery_needed":1,
+          "planned_treatment_days":7,"meds":"Thuốc A","notes":"Theo dõi huyết áp","diagnosis":"Tăng huyết áp","operated":0}
+    p2 = {"medical_id":"BN002","name":"Trần B","dob":"1965-06-15","ward":"305","bed":"02",
+          "admission_date":(date.today()-timedelta(days=2)).strftime(DATE_FMT),"severity":2,
+          "surgery_needed":0,"planned_treatment_days":3,"meds":"Thuốc B","notes":"","diagnosis":"ĐTĐ typ 2","operated":1}
+    p3 = {"medical_id":"BN003","name":"Lê C","dob":"1988-11-22","ward":"306","bed":"05",
+          "admission_date":(date.today()-timedelta(days=6)).strftime(DATE_FMT),"severity":5,
+          "surgery_needed":1,"planned_treatment_days":10,"meds":"Thuốc C","notes":"Theo dõi sau mổ","diagnosis":"Chấn thương sọ não","operated":0}
+    id1, id2, id3 = add_patients_bulk([p1, p2, p3])
+
+    add_orders_bulk([
+        {"patient_id":id1,"order_type":"CT","description":"CT não",
+         "date_ordered":date.today().strftime(DATE_FMT),
+         "scheduled_date":(date.today()+timedelta(days=1)).strftime(DATE_FMT),
+         "status":"scheduled"},
+        {"patient_id":id2,"order_type":"XN máu","description":"Tổng phân tích",
+         "date_ordered":(date.today()-timedelta(days=1)).strftime(DATE_FMT),
+         "scheduled_date":date.today().strftime(DATE_FMT),
+         "status":"pending"},
+        {"patient_id":id3,"order_type":"Siêu âm","description":"Ổ bụng",
+         "date_ordered":date.today().strftime(DATE_FMT),
+         "scheduled_date":(date.today()+timedelta(days=2)).strftime(DATE_FMT),
+         "status":"scheduled"},
+    ])
+
+# ======================
+# Điều hướng: PAGES + helper
+# ======================
 PAGES = [
     "Buổi sáng",
     "Trang chủ",
     "Tổng quan",
-    "Nhập viện mới",
-    "Đi buồng",
-    "Lịch XN/Chụp",
-    "Xuất viện",
-    "Lịch trực",
-    "Tìm kiếm & Lịch sử",
-    "Chỉnh sửa BN",
-    "Báo cáo",
-    "Cài đặt / Demo",
-]
-
-def go_edit(pid: int):
-    st.session_state.active_page = "Chỉnh sửa BN"
-    st.session_state.edit_patient_id = int(pid)
-    safe_rerun()
-
-# ======================
-# Khởi tạo
-# ======================
-init_db()
-
-# ======================
-# Bảo vệ đơn giản bằng mật khẩu
-# ======================
-if APP_PASSWORD:
-    pw = st.sidebar.text_input("🔐 Mật khẩu ứng dụng", type="password")
-    if pw != APP_PASSWORD:
-        st.sidebar.warning("Nhập mật khẩu để truy cập ứng dụng")
-        st.stop()
-
-# ======================
-# Sidebar
-# ======================
-st.sidebar.title("🩺 Menu")
+    "Nhập viện mới",
+    "Đi buồng",
+    "Lịch XN/Chụp",
+    "Xuất viện",
+    "Lịch trực",
+    "Tìm kiếm & Lịch sử",
+    "Chỉnh sửa BN",
+    "Báo cáo",
+    "Cài đặt / Demo",
+]
+
+def go_edit(pid: int):
+    st.session_state.active_page = "Chỉnh sửa BN"
+    st.session_state.edit_patient_id = int(pid)
+    safe_rerun()
+
+# ======================
+# Khởi tạo
+# ======================
+HAS_FTS = init_db()
+
+# ======================
+# Bảo vệ đơn giản bằng mật khẩu
+# ======================
+if APP_PASSWORD:
+    pw = st.sidebar.text_input("🔐 Mật khẩu ứng dụng", type="password")
+    if pw != APP_PASSWORD:
+        st.sidebar.warning("Nhập mật khẩu để truy cập ứng dụng")
+        st.stop()
+
+# ======================
+# Sidebar
+# ======================
+st.sidebar.title("🩺 Menu")
 if "active_page" not in st.session_state:
     st.session_state.active_page = "Buổi sáng"
-default_index = PAGES.index(st.session_state.active_page) if st.session_state.active_page in PAGES else 0
-selected_page = st.sidebar.radio("Chọn trang", PAGES, index=default_index)
-st.session_state.active_page = selected_page
-page = selected_page
-
-# ======================
-# Helper cho Tổng quan (tuần)
-# ======================
-def _to_date(s: Optional[str]) -> Optional[date]:
-    if not s: return None
-    try:
-        return datetime.strptime(s, DATE_FMT).date()
-    except Exception:
-        return None
-
-def week_range(today: date, offset_weeks: int = 0) -> Tuple[date, date]:
-    monday = today - timedelta(days=today.weekday())
-    monday = monday + timedelta(weeks=offset_weeks)
-    sunday = monday + timedelta(days=6)
-    return monday, sunday
-
-def patients_active_between(dstart: date, dend: date) -> pd.DataFrame:
-    df = query_df("SELECT * FROM patients")
-    if df.empty: return df
-    df = df.copy()
-    df["ad"] = df["admission_date"].apply(_to_date)
-    df["dd"] = df["discharge_date"].apply(_to_date)
-    mask = (df["ad"].notna()) & (df["ad"] <= dend) & ((df["dd"].isna()) | (df["dd"] >= dstart))
-    return df[mask]
-
-def count_discharges_between(dstart: date, dend: date) -> int:
-    df = query_df("SELECT discharge_date FROM patients WHERE discharge_date IS NOT NULL")
-    if df.empty: return 0
-    df["dd"] = df["discharge_date"].apply(_to_date)
-    return int(((df["dd"] >= dstart) & (df["dd"] <= dend)).sum())
-
-def count_orders_between(dstart: date, dend: date) -> int:
-    df = query_df("SELECT scheduled_date FROM orders")
-    if df.empty: return 0
-    df["sd"] = df["scheduled_date"].apply(_to_date)
-    return int(((df["sd"] >= dstart) & (df["sd"] <= dend)).sum())
-
-def avg_days_treated_in_week(dstart: date, dend: date) -> float:
-    df = patients_active_between(dstart, dend)
-    if df.empty: return 0.0
-    def overlap_days(ad: Optional[date], dd: Optional[date]) -> int:
-        start = max(ad or dstart, dstart)
-        end   = min((dd or dend), dend)
-        return max(0, (end - start).days + 1)
-    ov = df.apply(lambda r: overlap_days(_to_date(r["admission_date"]), _to_date(r["discharge_date"])), axis=1)
-    return round(float(ov.mean()), 1)
-
-# ======================
-# Các helper cho "Đi buồng": truy vấn phương án điều trị mới nhất
-# ======================
-def latest_plan_map_all_patients() -> Dict[int, str]:
-    """
-    Lấy phương án điều trị mới nhất (bất kể ngày) cho mỗi BN.
-    Trả về dict: patient_id -> plan (string)
-    """
-    df = query_df("""
-        SELECT w.patient_id, w.plan
-        FROM ward_rounds w
-        JOIN (
-            SELECT patient_id, MAX(id) AS max_id
-            FROM ward_rounds
-            GROUP BY patient_id
-        ) t ON w.id = t.max_id
-    """)
-    if df.empty: return {}
-    out = {}
-    for r in df.to_dict(orient="records"):
-        out[int(r["patient_id"])] = r.get("plan") or ""
-    return out
-
-def rounds_latest_today_with_plan() -> pd.DataFrame:
-    """
-    Lấy lần khám mới nhất trong NGÀY HÔM NAY cho mỗi BN (active),
-    kèm thông tin BN và cột w.plan (Phương án điều trị tiếp).
-    """
-    today_str = date.today().strftime(DATE_FMT)
-    df = query_df("""
-        SELECT p.id as pid, p.name, p.dob, p.diagnosis, p.notes, p.ward, w.plan
-        FROM ward_rounds w
-        JOIN (
-            SELECT patient_id, MAX(id) AS max_id
-            FROM ward_rounds
-            WHERE visit_date = ?
-            GROUP BY patient_id
-        ) t ON w.id = t.max_id
-        JOIN patients p ON p.id = w.patient_id
-        WHERE p.active = 1
-        ORDER BY p.name
-    """, (today_str,))
-    return df
-
-def get_patient_info(pid: int) -> Optional[Dict[str, Any]]:
-    df = query_df("SELECT * FROM patients WHERE id=?", (pid,))
-    if df.empty: return None
-    return df.iloc[0].to_dict()
-
-# ======================
-# Dashboard helpers (Trang chủ)
-# ======================
-def dashboard_stats(filters: Dict[str, Any]) -> Dict[str, Any]:
-    base_active = "SELECT * FROM patients WHERE active=1"
-    params = []
-    if filters.get("ward") and filters["ward"] != "Tất cả":
-        base_active += " AND ward=?"; params.append(filters["ward"])
-    df_active = query_df(base_active, tuple(params))
-    total_active = len(df_active)
-    patients_per_ward = (
-        df_active.groupby("ward").size().reset_index(name="Số BN").sort_values("Số BN", ascending=False)
-        if total_active > 0 else pd.DataFrame(columns=["ward","Số BN"])
-    )
-    if total_active > 0:
-        df_active = df_active.copy()
-        df_active["days_in_hospital"] = df_active["admission_date"].apply(lambda d: days_between(d))
-        avg_days = round(df_active["days_in_hospital"].mean(), 1)
-    else:
-        avg_days = 0
-    df_orders = query_df("""
-        SELECT o.*, p.name, p.ward FROM orders o
-        LEFT JOIN patients p ON o.patient_id=p.id
-    """)
-    pending_patients = df_orders[df_orders["status"]!="done"]["patient_id"].nunique() if not df_orders.empty else 0
-    today_str = date.today().strftime(DATE_FMT)
-    scheduled_not_done = 0
-    if not df_orders.empty:
-        mask = (df_orders["status"]!="done") & (df_orders["scheduled_date"].notna()) & (df_orders["scheduled_date"]<=today_str)
-        scheduled_not_done = int(mask.sum())
-    return {
-        "total_active": total_active,
-        "patients_per_ward": patients_per_ward,
-        "avg_days": avg_days,
-        "count_wait_surg": int(query_df("SELECT COUNT(*) as c FROM patients WHERE active=1 AND surgery_needed=1")["c"][0]) if total_active>=0 else 0,
-        "pending_patients": pending_patients,
-        "scheduled_not_done": scheduled_not_done,
-        "df_active": df_active,
-        "df_orders": df_orders,
-    }
-
-def kpi(title: str, value: Any, icon: Optional[str] = None):
-    icon_html = f"<div class='icon'>{icon}</div>" if icon else ""
-    st.markdown(f"""
-        <div class='kpi'>
-            {icon_html}
-            <div>
-                <h3>{title}</h3>
-                <div class='v'>{value}</div>
-            </div>
-        </div>
-    """, unsafe_allow_html=True)
-
-def ward_pie_chart(df: pd.DataFrame):
-    if df.empty:
-        st.info("Chưa có dữ liệu BN theo phòng."); return
-    chart = (
-        alt.Chart(df.rename(columns={"ward":"Phòng"}))
-        .mark_arc()
-        .encode(theta="Số BN:Q", color="Phòng:N",
-                tooltip=["Phòng:N","Số BN:Q"])
-        .properties(height=300)
-    )
-    st.altair_chart(chart, use_container_width=True)
-
-def orders_status_pie_chart(df_orders: pd.DataFrame):
-    if df_orders.empty:
-        st.info("Chưa có dữ liệu chỉ định."); return
-    stat = df_orders.groupby("status").size().reset_index(name="Số lượng")
-    stat.rename(columns={"status":"Trạng thái"}, inplace=True)
-    chart = (
-        alt.Chart(stat)
-        .mark_arc()
-        .encode(theta="Số lượng:Q", color="Trạng thái:N",
-                tooltip=["Trạng thái:N","Số lượng:Q"])
-        .properties(height=300)
+default_index = PAGES.index(st.session_state.active_page) if st.session_state.active_page in PAGES else 0
+selected_page = st.sidebar.radio("Chọn trang", PAGES, index=default_index)
+st.session_state.active_page = selected_page
+page = selected_page
+
+# ======================
+# Helper cho Tổng quan (tuần)
+# ======================
+def week_range(today: date, offset_weeks: int = 0) -> Tuple[date, date]:
+    monday = today - timedelta(days=today.weekday() - 7 * offset_weeks)
+    sunday = monday + timedelta(days=6)
+    return monday, sunday
+
+# BN có mặt trong [?1=start, ?2=end] (số ngày julian): nhập viện trước end và chưa ra viện / ra viện sau start (ngày ra lỗi coi như chưa ra)
+_ACTIVE_BETWEEN_WHERE = """
+    admission_julian <= ?2
+    AND (discharge_julian IS NULL OR discharge_julian >= ?1)
+"""
+
+def patients_active_between(dstart: date, dend: date, limit: Optional[int] = None) -> pd.DataFrame:
+    sql = "SELECT * FROM patients WHERE" + _ACTIVE_BETWEEN_WHERE
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return query_df(sql, (julian_day(dstart), julian_day(dend)))
+
+def treatment_stats_between(dstart: date, dend: date) -> Tuple[int, float]:
+    """(số lượt điều trị, số ngày điều trị TB/BN trong khoảng) — gộp sẵn bằng 1 truy vấn SQL cho biểu đồ Tổng quan."""
+    rows = query_rows("""
+        SELECT COUNT(*) AS n,
+               AVG(MAX(0, MIN(IFNULL(discharge_julian, ?2), ?2)
+                          - MAX(admission_julian, ?1) + 1)) AS avg_days
+        FROM patients WHERE""" + _ACTIVE_BETWEEN_WHERE, (julian_day(dstart), julian_day(dend)))
+    n, avg_days = rows[0]["n"], rows[0]["avg_days"]
+    return int(n), round(float(avg_days), 1) if n else 0.0
+
+def count_discharges_between(dstart: date, dend: date) -> int:
+    # Quét khoảng trên idx_patients_discharge_julian (ngày lỗi -> NULL, không được đếm) thay vì kéo cả cột về parse
+    return int(query_scalar(
+        "SELECT COUNT(*) FROM patients WHERE discharge_julian BETWEEN ? AND ?",
+        (julian_day(dstart), julian_day(dend))))
+
+def count_orders_between(dstart: date, dend: date) -> int:
+    # So sánh số nguyên trên idx_orders_julian thay vì kéo cả cột ngày về parse trong pandas
+    return int(query_scalar(
+        "SELECT COUNT(*) FROM orders WHERE scheduled_julian BETWEEN ? AND ?",
+        (julian_day(dstart), julian_day(dend))))
+
+# ======================
+# Các helper cho "Đi buồng": truy vấn phương án điều trị mới nhất
+# ======================
+def latest_plan_map_all_patients() -> Dict[int, str]:
+    """
+    Lấy phương án điều trị mới nhất (bất kể ngày) cho mỗi BN.
+    Trả về dict: patient_id -> plan (string)
+    """
+    df = query_df("""
+        SELECT w.patient_id, w.plan
+        FROM ward_rounds w
+        JOIN (
+            SELECT patient_id, MAX(id) AS max_id
+            FROM ward_rounds
+            GROUP BY patient_id
+        ) t ON w.id = t.max_id
+    """)
+    return {int(pid): plan or "" for pid, plan in df[["patient_id", "plan"]].itertuples(index=False, name=None)}
+
+def rounds_latest_today_with_plan() -> pd.DataFrame:
+    """
+    Lấy lần khám mới nhất trong NGÀY HÔM NAY cho mỗi BN (active),
+    kèm thông tin BN và cột w.plan (Phương án điều trị tiếp).
+    """
+    today_str = date.today().strftime(DATE_FMT)
+    df = query_df("""
+        SELECT p.id as pid, p.name, p.dob, p.diagnosis, p.notes, p.ward, w.plan
+        FROM ward_rounds w
+        JOIN (
+            SELECT patient_id, MAX(id) AS max_id
+            FROM ward_rounds
+            WHERE visit_date = ?
+            GROUP BY patient_id
+        ) t ON w.id = t.max_id
+        JOIN patients p ON p.id = w.patient_id
+        WHERE p.active = 1
+        ORDER BY p.name
+    """, (today_str,))
+    return df
+
+def get_patient_info(pid: int) -> Optional[Dict[str, Any]]:
+    return query_one("SELECT * FROM patients WHERE id=?", (pid,))
+
+# Một câu JOIN chuẩn cho danh sách chỉ định: Lịch XN/Chụp và Báo cáo ngày dùng chung -> cùng khóa cache của query_df
+ORDERS_JOIN_SQL = """
+    SELECT o.id, o.patient_id, p.name AS patient_name, p.ward, o.order_type, o.description,
+           o.date_ordered, o.scheduled_date, o.status, o.result, o.result_date
+    FROM orders o LEFT JOIN patients p ON o.patient_id=p.id
+"""
+# Ngày trống xếp cuối
+ORDERS_ORDER_BY = " ORDER BY o.scheduled_date IS NULL, o.scheduled_date"
+
+# Danh sách trong 1 ngày: xếp theo đúng thứ tự cột của idx_orders_sched_cov (gom chỉ định theo BN) -> không sắp lại
+ORDERS_DAY_ORDER_BY = " ORDER BY o.patient_id, o.order_type, o.description, o.status, o.id"
+
+def orders_on_day(dstr: str) -> pd.DataFrame:
+    return query_df(ORDERS_JOIN_SQL + " WHERE o.scheduled_date = ?" + ORDERS_DAY_ORDER_BY, (dstr,))
+
+# ======================
+# Dashboard helpers (Trang chủ)
+# ======================
+# Chỉ các cột mà bảng "Danh sách BN" ở Trang chủ thực sự dùng (không kéo meds, dob, đơn ra viện...)
+ACTIVE_LIST_COLS = ["id", "medical_id", "name", "ward", "bed", "surgery_needed",
+                    "admission_date", "diagnosis", "notes", "operated"]
+
+# Truy vấn Trang chủ chỉ có 2 dạng (mọi phòng / 1 phòng): dựng cả 2 chuỗi SQL ở mức module (dựng lại mỗi rerun
+# vì module chạy lại), nơi gọi chỉ tra dict; chuỗi luôn giống hệt nhau nên statement cache của sqlite3 vẫn trúng
+def _with_ward_variants(sql: str) -> Dict[bool, str]:
+    return {False: sql.format(ward_and=""), True: sql.format(ward_and=" AND ward=?")}
+
+SQL_DASHBOARD_AGG = _with_ward_variants("""
+    SELECT ward, COUNT(*) AS n,
+           IFNULL(SUM(? - admission_julian), 0) AS days_sum,
+           COUNT(admission_julian) AS days_n,
+           IFNULL(SUM(surgery_needed = 1), 0) AS wait_surg
+    FROM patients WHERE active=1{ward_and}
+    GROUP BY ward
+""")
+SQL_ACTIVE_LIST = _with_ward_variants(
+    "SELECT " + ", ".join(ACTIVE_LIST_COLS) + " FROM patients WHERE active=1{ward_and}")
+SQL_ORDER_KPIS = """
+    SELECT COUNT(DISTINCT patient_id) AS pending,
+           IFNULL(SUM(scheduled_julian <= ?), 0) AS overdue
+    FROM orders WHERE status IS NOT 'done'
+"""
+SQL_WAIT_SURG = "SELECT COUNT(*) FROM patients WHERE active=1 AND surgery_needed=1"
+SQL_ORDERS_BY_STATUS = "SELECT status, COUNT(*) AS n FROM orders WHERE status IS NOT NULL GROUP BY status"
+
+def dashboard_agg_sql(ward: Optional[str], today_julian: int) -> pd.DataFrame:
+    """Gộp BN đang nằm theo phòng ngay trong SQLite: số BN, tổng/số ngày điều trị hợp lệ, số BN cần mổ."""
+    return query_df(SQL_DASHBOARD_AGG[ward is not None], (today_julian,) + ((ward,) if ward is not None else ()))
+
+def active_patients_table(ward: str) -> pd.DataFrame:
+    """Bảng "Danh sách BN" của Trang chủ; cache qua query_df theo phiên bản bảng patients."""
+    ward_filter = ward if ward and ward != "Tất cả" else None
+    return query_df(SQL_ACTIVE_LIST[ward_filter is not None], (ward_filter,) if ward_filter is not None else ())
+
+def dashboard_stats(ward: str) -> Dict[str, Any]:
+    # Khóa cache gồm phiên bản bảng patients/orders và ngày hôm nay -> tự làm mới khi có ghi hoặc qua ngày
+    return _dashboard_stats_cached(ward, (table_version("patients"), table_version("orders")),
+                                   date.today().strftime(DATE_FMT))
+
+# cache_resource: mỗi rerun trả lại đúng object đã tính, không pickle/unpickle như cache_data.
+# Các DataFrame trả về dùng chung giữa các phiên -> chỉ đọc, nơi gọi không được sửa tại chỗ.
+@st.cache_resource(ttl=300, max_entries=32, show_spinner=False)
+def _dashboard_stats_cached(ward: str, versions: tuple, today_str: str) -> Dict[str, Any]:
+    ward_filter = ward if ward and ward != "Tất cả" else None
+    today_julian = julian_day(date.fromisoformat(today_str))
+    per_ward = dashboard_agg_sql(ward_filter, today_julian)
+    total_active = int(per_ward["n"].sum())
+    # Chỉ số lấy từ truy vấn gộp; bảng BN tách riêng (active_patients_table), chỉ đọc khi mở "Danh sách BN"
+    days_n = per_ward["days_n"].sum()
+    avg_days = round(float(per_ward["days_sum"].sum() / days_n), 1) if days_n else 0
+    patients_per_ward = (per_ward[per_ward["ward"].notna()][["ward", "n"]]
+                         .sort_values("n", ascending=False, kind="stable")
+                         .rename(columns={"n": "Số BN"}).reset_index(drop=True))
+    # KPI "Chờ mổ" luôn tính toàn khoa (như các KPI order), không theo phòng đang lọc:
+    # không lọc thì cộng từ truy vấn gộp, có lọc phòng thì đếm riêng 1 câu COUNT
+    if ward_filter is None:
+        count_wait_surg = int(per_ward["wait_surg"].sum())
+    else:
+        count_wait_surg = int(query_scalar(SQL_WAIT_SURG))
+    # Chỉ cần các con số: để SQLite đếm, không kéo cả bảng orders về pandas
+    order_counts = query_df(SQL_ORDER_KPIS, (today_julian,)).iloc[0]
+    pending_patients = int(order_counts["pending"])
+    scheduled_not_done = int(order_counts["overdue"])
+    orders_by_status = query_df(SQL_ORDERS_BY_STATUS)
+    return {
+        "total_active": total_active,
+        "patients_per_ward": patients_per_ward,
+        "avg_days": avg_days,
+        "count_wait_surg": count_wait_surg,
+        "pending_patients": pending_patients,
+        "scheduled_not_done": scheduled_not_done,
+        "orders_by_status": orders_by_status,
+    }
+
+def kpi(title: str, value: Any, icon: Optional[str] = None):
+    icon_html = f"<div class='icon'>{icon}</div>" if icon else ""
+    st.markdown(f"""
+        <div class='kpi'>
+            {icon_html}
+            <div>
+                <h3>{title}</h3>
+                <div class='v'>{value}</div>
+            </div>
+        </div>
+    """, unsafe_allow_html=True)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _pie_spec(records: tuple, cat: str, val: str) -> Dict[str, Any]:
+    """Vega-Lite spec của biểu đồ tròn, cache theo dữ liệu đã gộp: rerun không phải dựng + validate lại Altair."""
+    df = pd.DataFrame(list(records), columns=[cat, val])
+    return (
+        alt.Chart(df)
+        .mark_arc()
+        .encode(theta=f"{val}:Q", color=f"{cat}:N",
+                tooltip=[f"{cat}:N", f"{val}:Q"])
+        .properties(height=300)
+        .to_dict()
     )
-    st.altair_chart(chart, use_container_width=True)
+
+def ward_pie_chart(df: pd.DataFrame):
+    if df.empty:
+        st.info("Chưa có dữ liệu BN theo phòng."); return
+    records = tuple(df[["ward", "Số BN"]].itertuples(index=False, name=None))
+    st.vega_lite_chart(_pie_spec(records, "Phòng", "Số BN"), use_container_width=True)
+
+def orders_status_pie_chart(orders_by_status: pd.DataFrame):
+    if orders_by_status.empty:
+        st.info("Chưa có dữ liệu chỉ định."); return
+    records = tuple(orders_by_status[["status", "n"]].itertuples(index=False, name=None))
+    st.vega_lite_chart(_pie_spec(records, "Trạng thái", "Số lượng"), use_container_width=True)
 
 QUICK_STATUS = ["Ổn", "Theo dõi sát", "Đau", "Sốt", "Nặng hơn", "Có biến cố"]
 QUICK_NEURO = ["Không đổi", "Tốt hơn", "Xấu hơn", "Không ghi nhận thiếu sót mới", "Yếu/liệt mới", "Đau lan/tê bì"]
@@ -599,16 +1172,17 @@ QUICK_DRAIN = ["Không dẫn lưu", "<50 ml/24h", "50-100 ml/24h", ">100 ml/24h"
 QUICK_DECISIONS = ["Nằm tiếp", "Có thể ra viện", "Chuẩn bị mổ", "Sau mổ theo dõi", "Cần CLS", "Cần hội chẩn", "Chuyển ICU"]
 QUICK_TASKS = ["Thay băng", "Rút dẫn lưu", "Tập PHCN", "Theo dõi sốt", "Theo dõi đau", "Kê đơn ra viện", "Hẹn tái khám", "Báo mổ", "Hội chẩn"]
 
-def priority_label(row: Dict[str, Any], done_today: bool) -> str:
-    if not done_today:
-        return "Chưa khám"
-    if row.get("surgery_needed") == 1 and row.get("operated") != 1:
-        return "Chờ mổ"
-    if row.get("operated") == 1:
-        return "Sau mổ"
-    if row.get("over_planned"):
-        return "Nằm lâu"
-    return "Theo dõi"
+def priority_labels(df: pd.DataFrame, done_today: pd.Series) -> pd.Series:
+    """Nhóm ưu tiên cho cả bảng; gán từ nhóm ưu tiên thấp lên cao để nhóm cao hơn ghi đè."""
+    labels = pd.Series("Theo dõi", index=df.index)
+    labels = labels.mask(df["over_planned"].fillna(False).astype(bool), "Nằm lâu")
+    labels = labels.mask(df["operated"] == 1, "Sau mổ")
+    labels = labels.mask((df["surgery_needed"] == 1) & (df["operated"] != 1), "Chờ mổ")
+    return labels.mask(~done_today, "Chưa khám")
+
+def _or_dash(col: pd.Series, dash: str = "—") -> pd.Series:
+    """Bản vector của `x or '—'` cho cột chuỗi."""
+    return col.fillna("").astype(str).replace("", dash)
 
 def build_quick_round_text(
     patient: Dict[str, Any],
@@ -639,19 +1213,22 @@ def quick_order_suggestions(decision: str, tasks: List[str]) -> List[str]:
     if decision == "Sau mổ theo dõi":
         suggestions.append("XN máu — Tổng phân tích tế bào máu")
     return suggestions
-
+
+# ======================
+# Ngày hiện tại: tính 1 lần cho mỗi lượt chạy lại script
+# ======================
+TODAY = date.today()
+TODAY_STR = TODAY.strftime(DATE_FMT)
+
 # ======================
 # Buổi sáng trước đi buồng
 # ======================
 if page == "Buổi sáng":
     st.title("🌅 Buổi sáng trước đi buồng")
-    today = date.today()
-    yesterday = today - timedelta(days=1)
-    today_str = today.strftime(DATE_FMT)
+    yesterday = TODAY - timedelta(days=1)
     yday_str = yesterday.strftime(DATE_FMT)
 
-    df_wards = query_df("SELECT DISTINCT ward FROM patients WHERE active=1 AND ward IS NOT NULL AND ward<>'' ORDER BY ward")
-    ward_options = ["Tất cả"] + (df_wards["ward"].tolist() if not df_wards.empty else [])
+    ward_options = ["Tất cả"] + list_wards(active_only=True)
     selected_ward = st.selectbox("Phạm vi xem", ward_options, index=0, key="morning_ward")
 
     active_sql = "SELECT * FROM patients WHERE active=1"
@@ -666,12 +1243,12 @@ if page == "Buổi sáng":
         st.info("Hiện không có bệnh nhân đang nằm trong phạm vi đã chọn.")
         st.stop()
 
-    df_active = df_active.copy()
-    df_active["days_in_hospital"] = df_active["admission_date"].apply(lambda d: days_between(d) or 0)
-    df_active["diagnosis_group"] = df_active["diagnosis"].fillna("").apply(lambda x: x.strip() or "Chưa ghi chẩn đoán")
-    df_active["over_planned"] = df_active.apply(
-        lambda r: bool(r.get("planned_treatment_days") and r["days_in_hospital"] > int(r.get("planned_treatment_days") or 0)),
-        axis=1
+    # 1 lần assign thay cho copy() + gán từng cột
+    planned_days = pd.to_numeric(df_active["planned_treatment_days"], errors="coerce").fillna(0)
+    df_active = df_active.assign(
+        days_in_hospital=days_since(df_active["admission_julian"], TODAY).fillna(0).astype("int32"),
+        diagnosis_group=df_active["diagnosis"].fillna("").str.strip().replace("", "Chưa ghi chẩn đoán"),
+        over_planned=lambda d: (planned_days > 0) & (d["days_in_hospital"] > planned_days),
     )
 
     total_active = len(df_active)
@@ -699,12 +1276,7 @@ if page == "Buổi sáng":
     left, right = st.columns([1, 1])
     with left:
         st.subheader("Tỷ lệ mặt bệnh")
-        disease_df = (
-            df_active.groupby("diagnosis_group")
-            .size()
-            .reset_index(name="Số BN")
-            .sort_values("Số BN", ascending=False)
-        )
+        disease_df = df_active["diagnosis_group"].value_counts().rename_axis("diagnosis_group").reset_index(name="Số BN")
         disease_df["Tỷ lệ %"] = (disease_df["Số BN"] / total_active * 100).round(1)
         st.altair_chart(
             alt.Chart(disease_df.head(12))
@@ -725,7 +1297,7 @@ if page == "Buổi sáng":
 
     with right:
         st.subheader("Việc cần xem sáng nay")
-        rounds_today = query_df("SELECT DISTINCT patient_id FROM ward_rounds WHERE visit_date=?", (today_str,))
+        rounds_today = query_df("SELECT DISTINCT patient_id FROM ward_rounds WHERE visit_date=?", (TODAY_STR,))
         done_ids = set(rounds_today["patient_id"].astype(int).tolist()) if not rounds_today.empty else set()
         df_need_round = df_active[~df_active["id"].astype(int).isin(done_ids)].copy()
         st.write(f"BN chưa có khám hôm nay: **{len(df_need_round)}**")
@@ -741,7 +1313,7 @@ if page == "Buổi sáng":
         )
 
         y_orders = query_df("""
-            SELECT o.*, p.name, p.medical_id, p.ward, p.bed, p.diagnosis
+            SELECT p.medical_id, p.name, p.ward, p.bed, o.order_type, o.description, o.scheduled_date, o.status
             FROM orders o
             JOIN patients p ON p.id=o.patient_id
             WHERE o.date_ordered=? AND (?='Tất cả' OR p.ward=?)
@@ -752,7 +1324,7 @@ if page == "Buổi sáng":
             st.caption("Không có CLS nào được ghi nhận là yêu cầu hôm qua.")
         else:
             st.dataframe(
-                y_orders[["medical_id", "name", "ward", "bed", "order_type", "description", "scheduled_date", "status"]].rename(columns={
+                y_orders.rename(columns={
                     "medical_id": "Mã BA", "name": "Họ tên", "ward": "Phòng", "bed": "Giường",
                     "order_type": "Loại", "description": "Nội dung", "scheduled_date": "Ngày làm",
                     "status": "Trạng thái"
@@ -765,10 +1337,10 @@ if page == "Buổi sáng":
     st.subheader("Đi buồng nhanh")
     quick_df = df_active.copy()
     quick_df["Đã khám hôm nay"] = quick_df["id"].astype(int).isin(done_ids)
-    quick_df["Nhóm"] = quick_df.apply(lambda r: priority_label(r.to_dict(), bool(r["Đã khám hôm nay"])), axis=1)
-    quick_df["Một dòng"] = quick_df.apply(
-        lambda r: f"{r.get('ward') or '—'}/{r.get('bed') or '—'} - {r.get('name') or ''} - {r.get('diagnosis') or 'Chưa ghi chẩn đoán'}",
-        axis=1
+    quick_df["Nhóm"] = priority_labels(quick_df, quick_df["Đã khám hôm nay"])
+    quick_df["Một dòng"] = (
+        _or_dash(quick_df["ward"]) + "/" + _or_dash(quick_df["bed"]) + " - "
+        + quick_df["name"].fillna("").astype(str) + " - " + _or_dash(quick_df["diagnosis"], "Chưa ghi chẩn đoán")
     )
 
     group_order = ["Chưa khám", "Chờ mổ", "Sau mổ", "Nằm lâu", "Theo dõi"]
@@ -791,11 +1363,12 @@ if page == "Buổi sáng":
     if "quick_patient_id" in st.session_state and int(st.session_state.quick_patient_id) in quick_options:
         quick_default = int(st.session_state.quick_patient_id)
 
+    quick_labels = dict(zip(quick_options, quick_df["Một dòng"]))
     quick_pid = st.selectbox(
         "Chọn BN để ghi nhanh",
         options=quick_options,
         index=quick_options.index(quick_default),
-        format_func=lambda x: quick_df[quick_df["id"] == x]["Một dòng"].values[0],
+        format_func=quick_labels.get,
         key="quick_patient_id",
     )
     quick_patient = get_patient_info(int(quick_pid))
@@ -818,13 +1391,12 @@ if page == "Buổi sáng":
             note = st.text_area("Ghi chú đặc biệt", height=80, placeholder="Chỉ nhập nếu có điểm khác thường")
 
         suggested = quick_order_suggestions(decision, tasks)
-        all_test_opts = [f"{t[0]} — {t[1]}" for t in COMMON_TESTS]
-        default_tests = [x for x in suggested if x in all_test_opts]
-        quick_tests = st.multiselect("CLS thêm hôm nay", all_test_opts, default=default_tests)
+        default_tests = [x for x in suggested if x in COMMON_TESTS_BY_LABEL]
+        quick_tests = st.multiselect("CLS thêm hôm nay", COMMON_TESTS_LABELS, default=default_tests)
         try:
-            quick_test_date = st.date_input("Ngày làm CLS", value=today, format="DD/MM/YYYY", key=f"quick_cls_date_{quick_pid}")
+            quick_test_date = st.date_input("Ngày làm CLS", value=TODAY, format="DD/MM/YYYY", key=f"quick_cls_date_{quick_pid}")
         except TypeError:
-            quick_test_date = st.date_input("Ngày làm CLS", value=today, key=f"quick_cls_date_{quick_pid}")
+            quick_test_date = st.date_input("Ngày làm CLS", value=TODAY, key=f"quick_cls_date_{quick_pid}")
 
         general_status, system_exam, plan = build_quick_round_text(
             quick_patient or {}, status, int(pain_score), neuro, wound, drain, decision, tasks, note
@@ -837,40 +1409,43 @@ if page == "Buổi sáng":
         save_quick = st.form_submit_button("Lưu nhanh và chuyển BN tiếp theo")
 
     if save_quick and quick_patient:
-        update_patient_operated(int(quick_pid), operated_now)
-        add_ward_round({
-            "patient_id": int(quick_pid),
-            "visit_date": today_str,
-            "general_status": general_status,
-            "system_exam": system_exam,
-            "plan": plan,
-            "extra_tests": ", ".join(quick_tests) if quick_tests else "",
-            "extra_tests_note": note.strip(),
-        })
+        quick_orders = []
         if quick_tests:
-            text_to_tuple = {f"{t[0]} — {t[1]}": t for t in COMMON_TESTS}
             for sel in quick_tests:
-                ot, desc = text_to_tuple[sel]
-                add_order({
+                ot, desc = COMMON_TESTS_BY_LABEL[sel]
+                quick_orders.append({
                     "patient_id": int(quick_pid),
                     "order_type": ot,
                     "description": desc if not note.strip() else f"{desc} — {note.strip()}",
-                    "date_ordered": today_str,
+                    "date_ordered": TODAY_STR,
                     "scheduled_date": quick_test_date.strftime(DATE_FMT),
                     "status": "scheduled",
                 })
+        save_ward_round({
+            "patient_id": int(quick_pid),
+            "visit_date": TODAY_STR,
+            "general_status": general_status,
+            "system_exam": system_exam,
+            "plan": plan,
+            "extra_tests": ", ".join(quick_tests) if quick_tests else "",
+            "extra_tests_note": note.strip(),
+        }, operated_now, quick_orders)
 
         remaining_ids = [int(x) for x in df_need_round["id"].tolist() if int(x) != int(quick_pid)]
         if remaining_ids:
             st.session_state.quick_patient_id = remaining_ids[0]
             st.session_state.morning_focus_patient = remaining_ids[0]
         st.success("Đã lưu khám nhanh.")
-        st.cache_data.clear()
         safe_rerun()
 
     st.markdown("---")
     st.subheader("Mở từng bệnh nhân")
-    patient_options = df_active["id"].astype(int).tolist()
+    # Nhãn dựng 1 lần cho cả danh sách; format_func chỉ tra dict thay vì lọc df_active 4 lần cho mỗi lựa chọn
+    focus_labels = {
+        int(r.id): f"{r.medical_id or '—'} - {r.name} (P.{r.ward or '—'} / G.{r.bed or '—'})"
+        for r in df_active[["id", "medical_id", "name", "ward", "bed"]].itertuples(index=False)
+    }
+    patient_options = list(focus_labels)
     default_patient = patient_options[0]
     if "morning_focus_patient" in st.session_state and int(st.session_state.morning_focus_patient) in patient_options:
         default_patient = int(st.session_state.morning_focus_patient)
@@ -878,11 +1453,7 @@ if page == "Buổi sáng":
         "Chọn bệnh nhân để xem lại và xử trí",
         options=patient_options,
         index=patient_options.index(default_patient),
-        format_func=lambda x: (
-            f"{df_active[df_active['id']==x]['medical_id'].values[0] or '—'} - "
-            f"{df_active[df_active['id']==x]['name'].values[0]} "
-            f"(P.{df_active[df_active['id']==x]['ward'].values[0] or '—'} / G.{df_active[df_active['id']==x]['bed'].values[0] or '—'})"
-        ),
+        format_func=focus_labels.get,
         key="morning_focus_patient",
     )
 
@@ -910,27 +1481,27 @@ if page == "Buổi sáng":
         if y_rounds.empty:
             st.info("Chưa có dữ liệu khám hôm qua cho bệnh nhân này.")
         else:
-            for _, rr in y_rounds.iterrows():
-                st.markdown(f"**Lần ghi #{rr['id']} — {rr['created_at']}**")
-                st.write("**Toàn thân:**", rr["general_status"] or "—")
-                st.write("**Khám bộ phận:**", rr["system_exam"] or "—")
-                st.write("**Kế hoạch:**", rr["plan"] or "—")
-                if rr["extra_tests"]:
-                    st.write("**CLS thêm:**", rr["extra_tests"])
-                if rr["extra_tests_note"]:
-                    st.write("**Ghi chú CLS:**", rr["extra_tests_note"])
+            for rr in y_rounds.itertuples(index=False):
+                st.markdown(f"**Lần ghi #{rr.id} — {rr.created_at}**")
+                st.write("**Toàn thân:**", rr.general_status or "—")
+                st.write("**Khám bộ phận:**", rr.system_exam or "—")
+                st.write("**Kế hoạch:**", rr.plan or "—")
+                if rr.extra_tests:
+                    st.write("**CLS thêm:**", rr.extra_tests)
+                if rr.extra_tests_note:
+                    st.write("**Ghi chú CLS:**", rr.extra_tests_note)
                 st.markdown("---")
 
     with t2:
-        p_y_orders = query_df("""
+        p_y_orders = query_rows("""
             SELECT * FROM orders
             WHERE patient_id=? AND date_ordered=?
             ORDER BY scheduled_date, id
         """, (int(selected_patient), yday_str))
-        if p_y_orders.empty:
+        if not p_y_orders:
             st.info("Bệnh nhân này không có CLS được yêu cầu hôm qua.")
         else:
-            for od in p_y_orders.to_dict("records"):
+            for od in p_y_orders:
                 st.markdown(f"**{od['order_type']}** — {od.get('description') or '—'}")
                 st.caption(f"Ngày làm: {od.get('scheduled_date') or '—'} | Trạng thái: {od.get('status') or '—'} | Kết quả: {od.get('result') or '—'}")
                 res_key = f"morning_res_{od['id']}"
@@ -938,7 +1509,6 @@ if page == "Buổi sáng":
                 if st.button("Đánh dấu đã có kết quả", key=f"morning_done_{od['id']}"):
                     mark_order_done(int(od["id"]), result_text)
                     st.success("Đã cập nhật kết quả CLS.")
-                    st.cache_data.clear()
                     safe_rerun()
 
     with t3:
@@ -948,14 +1518,13 @@ if page == "Buổi sáng":
         if up_file is not None and st.button("Lưu tệp vào hồ sơ BN", key=f"save_patient_file_{selected_patient}"):
             save_patient_file(int(selected_patient), up_file, file_note)
             st.success("Đã lưu tệp.")
-            st.cache_data.clear()
             safe_rerun()
 
-        files = query_df("SELECT * FROM patient_files WHERE patient_id=? ORDER BY uploaded_at DESC", (int(selected_patient),))
-        if files.empty:
+        files = query_rows("SELECT * FROM patient_files WHERE patient_id=? ORDER BY uploaded_at DESC", (int(selected_patient),))
+        if not files:
             st.info("Chưa có ảnh/tệp đã add cho bệnh nhân này.")
         else:
-            for f in files.to_dict("records"):
+            for f in files:
                 with st.expander(f"{f['filename']} — {f['uploaded_at']}", expanded=False):
                     st.caption(f.get("note") or "")
                     if os.path.exists(f["path"]):
@@ -963,16 +1532,15 @@ if page == "Buổi sáng":
                         if mime.startswith("image/"):
                             st.image(f["path"], use_container_width=True)
                         elif mime in ("application/pdf", "application/x-pdf"):
-                            with open(f["path"], "rb") as fh:
-                                b64 = base64.b64encode(fh.read()).decode("utf-8")
+                            b64 = _pdf_b64(f["path"], os.path.getmtime(f["path"]))
                             st.markdown(
                                 f"<div class='embed'><embed src='data:application/pdf;base64,{b64}' type='application/pdf' width='100%' height='100%'/></div>",
                                 unsafe_allow_html=True,
                             )
                         else:
                             st.info("Tệp đã lưu, định dạng này không xem trực tiếp trong app.")
-                        with open(f["path"], "rb") as fh:
-                            st.download_button("Tải tệp", data=fh.read(), file_name=f["filename"], key=f"dl_patient_file_{f['id']}")
+                        st.download_button("Tải tệp", data=functools.partial(_read_file_bytes, f["path"], os.path.getmtime(f["path"])),
+                                           file_name=f["filename"], mime=mime or None, key=f"dl_patient_file_{f['id']}")
                     else:
                         st.error("Không tìm thấy tệp trên máy chủ.")
 
@@ -984,42 +1552,39 @@ if page == "Buổi sáng":
                 general_status = st.text_area("Tình trạng toàn thân hôm nay", height=90)
                 system_exam = st.text_area("Khám bộ phận hôm nay", height=110)
                 plan = st.text_area("Nhận định / xử trí / theo dõi tiếp", height=110)
-                extra_opts = [f"{t[0]} — {t[1]}" for t in COMMON_TESTS]
-                extra_selected = st.multiselect("Yêu cầu CLS hôm nay nếu cần", extra_opts)
+                extra_selected = st.multiselect("Yêu cầu CLS hôm nay nếu cần", COMMON_TESTS_LABELS)
                 extra_note = st.text_area("Ghi chú/lý do CLS", height=70)
                 try:
-                    extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=today, format="DD/MM/YYYY", key=f"morning_cls_date_{selected_patient}")
+                    extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=TODAY, format="DD/MM/YYYY", key=f"morning_cls_date_{selected_patient}")
                 except TypeError:
-                    extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=today, key=f"morning_cls_date_{selected_patient}")
+                    extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=TODAY, key=f"morning_cls_date_{selected_patient}")
                 operated_now = st.checkbox("Đã phẫu thuật", value=bool(p.get("operated", 0)))
                 save_round = st.form_submit_button("Lưu khám hôm nay")
 
             if save_round:
-                update_patient_operated(int(selected_patient), operated_now)
-                add_ward_round({
-                    "patient_id": int(selected_patient),
-                    "visit_date": today_str,
-                    "general_status": general_status.strip(),
-                    "system_exam": system_exam.strip(),
-                    "plan": plan.strip(),
-                    "extra_tests": ", ".join(extra_selected) if extra_selected else "",
-                    "extra_tests_note": extra_note.strip(),
-                })
+                extra_orders = []
                 if extra_selected:
-                    text_to_tuple = {f"{t[0]} — {t[1]}": t for t in COMMON_TESTS}
                     for sel in extra_selected:
-                        ot, desc = text_to_tuple[sel]
+                        ot, desc = COMMON_TESTS_BY_LABEL[sel]
                         desc_full = desc if not extra_note.strip() else f"{desc} — {extra_note.strip()}"
-                        add_order({
+                        extra_orders.append({
                             "patient_id": int(selected_patient),
                             "order_type": ot,
                             "description": desc_full,
-                            "date_ordered": today_str,
+                            "date_ordered": TODAY_STR,
                             "scheduled_date": extra_scheduled.strftime(DATE_FMT),
                             "status": "scheduled",
                         })
+                save_ward_round({
+                    "patient_id": int(selected_patient),
+                    "visit_date": TODAY_STR,
+                    "general_status": general_status.strip(),
+                    "system_exam": system_exam.strip(),
+                    "plan": plan.strip(),
+                    "extra_tests": ", ".join(extra_selected) if extra_selected else "",
+                    "extra_tests_note": extra_note.strip(),
+                }, operated_now, extra_orders)
                 st.success("Đã lưu khám hôm nay.")
-                st.cache_data.clear()
                 safe_rerun()
 
         with col_discharge:
@@ -1037,613 +1602,610 @@ if page == "Buổi sáng":
                     discharge_patient(int(selected_patient), prescription, advice)
                     st.success("Đã ra viện và chuyển vào danh sách ra viện hôm nay.")
                     st.session_state.active_page = "Xuất viện"
-                    st.session_state.discharge_view_date = today
-                    st.cache_data.clear()
+                    st.session_state.discharge_view_date = TODAY
                     safe_rerun()
 
 # ======================
 # Trang chủ
 # ======================
 elif page == "Trang chủ":
-    st.title("📊 Dashboard — Theo dõi bệnh nhân")
-
-    # Hiển thị banner (nếu đã tải lên trong thư mục static/)
-    banner_paths = ["static/banner.png", "static/banner.jpg", "static/banner.jpeg", "static/banner.gif"]
-    banner_file = next((p for p in banner_paths if os.path.exists(p)), None)
-    if banner_file:
-        try:
-            st.image(banner_file, use_container_width=True)
-        except Exception:
-            st.markdown(f"![banner]({banner_file})")
-    else:
-        st.markdown(
-            "<div class='header-card'>"
-            "<h2 style='margin:0'>Phần mềm theo dõi bệnh nhân</h2>"
-            "<p class='small' style='margin:6px 0 0 0'>Không có banner. Vào Cài đặt / Demo để tải ảnh hiển thị ở đầu trang.</p>"
-            "</div>",
-            unsafe_allow_html=True
-        )
-
-    # Quick action toolbar
-    st.markdown("<div class='header-card'>", unsafe_allow_html=True)
-    col_a, col_b, col_c, col_d, col_e = st.columns([2,2,2,2,6])
-    with col_a:
-        if st.button("➕ Thêm BN"):
-            st.session_state.active_page = "Nhập viện mới"; safe_rerun()
-    with col_b:
-        if st.button("🚶 Đi buồng"):
-            st.session_state.active_page = "Đi buồng"; safe_rerun()
-    with col_c:
-        if st.button("🧪 Lịch XN"):
-            st.session_state.active_page = "Lịch XN/Chụp"; safe_rerun()
-    with col_d:
-        if st.button("📑 Báo cáo"):
-            st.session_state.active_page = "Báo cáo"; safe_rerun()
-    with col_e:
-        st.markdown("<div class='small'>Ngắn gọn: Tạo BN mới, mở form đi buồng, quản lý chỉ định, xem báo cáo nhanh.</div>", unsafe_allow_html=True)
-    st.markdown("</div>", unsafe_allow_html=True)
-
-    df_all_wards = query_df("SELECT DISTINCT ward FROM patients WHERE ward IS NOT NULL AND ward<>'' ORDER BY ward")
-    ward_list = ["Tất cả"] + (df_all_wards["ward"].tolist() if not df_all_wards.empty else [])
-    f_col1, f_col2 = st.columns([1,2])
-    with f_col1: ward_filter = st.selectbox("Lọc theo phòng", ward_list, index=0)
-    with f_col2: st.markdown("<div class='small'>Gợi ý: dùng bộ lọc để xem nhanh khoa/phòng.</div>", unsafe_allow_html=True)
-
-    stats = dashboard_stats({"ward": ward_filter})
-
-    c1, c2, c3, c4, c5 = st.columns(5)
-    with c1: kpi("BN đang điều trị", stats["total_active"], icon="🫀")
-    with c2: kpi("Thời gian điều trị TB (ngày)", stats["avg_days"], icon="⏱️")
-    with c3: kpi("Chờ mổ", stats["count_wait_surg"], icon="🔪")
-    with c4: kpi("BN có order chưa xong", stats["pending_patients"], icon="📋")
-    with c5: kpi("Order quá hạn / đến hạn", stats["scheduled_not_done"], icon="⚠️")
-    st.markdown("---")
-
-    st.subheader("BN theo phòng")
-    ward_pie_chart(stats["patients_per_ward"])
-
-    st.subheader("Trạng thái chỉ định")
-    orders_status_pie_chart(stats["df_orders"])
-
-    with st.expander("📋 Danh sách BN (đang điều trị)", expanded=True):
-        df_active = stats["df_active"]
-        if df_active.empty:
-            st.info("Không có bệnh nhân đang nằm.")
-        else:
-            base_cols = ["id","medical_id","name","ward","bed","surgery_needed","admission_date","diagnosis","notes","operated"]
-            view_cols = [c for c in base_cols if c in df_active.columns]
-            st.dataframe(
-                df_active[view_cols].rename(columns={
-                    "medical_id":"Mã BA","name":"Họ tên","ward":"Phòng","bed":"Giường",
-                    "surgery_needed":"Cần mổ","admission_date":"Ngày NV",
-                    "diagnosis":"Chẩn đoán","notes":"Ghi chú","operated":"Đã phẫu thuật"
-                }), use_container_width=True, hide_index=True
-            )
-            for row in df_active.to_dict(orient="records"):
-                cols = st.columns([1,3,1,1,1,1,1])
-                cols[0].markdown(f"**{row['medical_id']}**")
-                diag_txt = f"<br/><span class='small'>Chẩn đoán: {row.get('diagnosis','')}</span>" if row.get("diagnosis") else ""
-                cols[1].markdown(f"**{row['name']}**  \n<span class='small'>{row.get('notes','')}</span>{diag_txt}", unsafe_allow_html=True)
-                cols[2].markdown(f"{row.get('ward','')}/{row.get('bed','') or ''}")
-                cols[3].markdown("🔪 Cần mổ" if row.get("surgery_needed")==1 else "")
-                cols[4].markdown("✅" if row.get("operated")==1 else "✗")
-                if cols[5].button("✏️ Chỉnh sửa", key=f"edit_home_{row['id']}"):
-                    go_edit(row["id"])
-                if cols[6].button("Xuất viện", key=f"dis_{row['id']}"):
-                    discharge_patient(row["id"]); st.success(f"Đã xuất viện {row['name']}"); safe_rerun()
-
-# ======================
-# Trang TỔNG QUAN
-# ======================
-elif page == "Tổng quan":
-    st.title("📈 Tổng quan theo tuần")
-
-    # Tính toán số liệu
-    today = date.today()
-    this_start, this_end = week_range(today, 0)
-    last_start, last_end = week_range(today, -1)
-
-    try:
-        active_this_df = patients_active_between(this_start, this_end)
-        treatment_this = len(active_this_df)
-        discharge_this = count_discharges_between(this_start, this_end)
-        orders_this    = count_orders_between(this_start, this_end)
-        avg_days_this  = avg_days_treated_in_week(this_start, this_end)
-
-        active_last_df = patients_active_between(last_start, last_end)
-        treatment_last = len(active_last_df)
-        discharge_last = count_discharges_between(last_start, last_end)
-        orders_last    = count_orders_between(last_start, last_end)
-        avg_days_last  = avg_days_treated_in_week(last_start, last_end)
-    except Exception as e:
-        import traceback
-        st.error("Lỗi khi tính toán số liệu. Xem chi tiết")
-        st.code(traceback.format_exc())
-        st.stop()
-
-    # Debug expander (ẩn) để kiểm tra nội dung trung gian
-    with st.expander("Debug số liệu (chỉ hiện khi cần)"):
-        st.write("this_start", this_start, "this_end", this_end)
-        st.write("treatment_this", treatment_this, type(treatment_this))
-        st.write("discharge_this", discharge_this, type(discharge_this))
-        st.write("orders_this", orders_this, type(orders_this))
-        st.write("avg_days_this", avg_days_this, type(avg_days_this))
-        st.write("treatment_last", treatment_last)
-        st.write("discharge_last", discharge_last)
-        st.write("orders_last", orders_last)
-        st.write("avg_days_last", avg_days_last)
-        st.markdown("---")
-        st.write("Sample active_this_df:")
-        try:
-            st.dataframe(active_this_df.head(), use_container_width=True)
-        except Exception as e:
-            st.write("Không thể hiển thị dataframe:", e)
-
-    # Vẽ biểu đồ — mỗi phần có try/except riêng để bắt lỗi
-    st.subheader("Ra viện vs Lượt điều trị (tuần này)")
-    try:
-        df1 = pd.DataFrame({"Chỉ số": ["Lượt điều trị", "Ra viện"], "Giá trị": [treatment_this, discharge_this]})
-        st.altair_chart(alt.Chart(df1).mark_bar().encode(x="Chỉ số:N", y="Giá trị:Q", tooltip=["Chỉ số","Giá trị"]).properties(height=280), use_container_width=True)
-    except Exception:
-        import traceback
-        st.error("Lỗi khi vẽ biểu đồ Ra viện vs Lượt điều trị")
-        st.code(traceback.format_exc())
-
-    st.subheader("Chỉ định cận lâm sàng (tuần này) so với Lượt điều trị")
-    try:
-        df2 = pd.DataFrame({"Hạng mục": ["Chỉ định CLS", "Lượt điều trị"], "Số lượng": [orders_this, treatment_this]})
-        st.altair_chart(alt.Chart(df2).mark_bar().encode(x="Hạng mục:N", y="Số lượng:Q", tooltip=["Hạng mục","Số lượng"]).properties(height=280), use_container_width=True)
-    except Exception:
-        import traceback
-        st.error("Lỗi khi vẽ biểu đồ Chỉ định CLS")
-        st.code(traceback.format_exc())
-
-    st.subheader("So sánh tuần này và tuần trước")
-    try:
-        comp_df = pd.DataFrame([
-            {"Chỉ số":"Số ngày điều trị TB/BN", "Tuần":"Tuần trước", "Giá trị": avg_days_last},
-            {"Chỉ số":"Số ngày điều trị TB/BN", "Tuần":"Tuần này",   "Giá trị": avg_days_this},
-            {"Chỉ số":"Ra viện",                "Tuần":"Tuần trước", "Giá trị": discharge_last},
-            {"Chỉ số":"Ra viện",                "Tuần":"Tuần này",   "Giá trị": discharge_this},
-            {"Chỉ số":"Lượt điều trị",          "Tuần":"Tuần trước", "Giá trị": treatment_last},
-            {"Chỉ số":"Lượt điều trị",          "Tuần":"Tuần này",   "Giá trị": treatment_this},
-        ])
-        chart3 = (
-            alt.Chart(comp_df)
-            .mark_bar()
-            .encode(x=alt.X("Chỉ số:N", sort=None), y="Giá trị:Q", column=alt.Column("Tuần:N", sort=["Tuần trước","Tuần này"]),
-                    tooltip=["Tuần","Chỉ số","Giá trị"]) 
-            .properties(height=280)
-            .resolve_scale(y='independent')
-        )
-        st.altair_chart(chart3, use_container_width=True)
-    except Exception:
-        import traceback
-        st.error("Lỗi khi vẽ biểu đồ So sánh tuần")
-        st.code(traceback.format_exc())
-
-    st.markdown("---")
-    try:
-        c1, c2, c3, c4 = st.columns(4)
-        with c1: kpi("Lượt điều trị (tuần này)", treatment_this)
-        with c2: kpi("Ra viện (tuần này)", discharge_this)
-        with c3: kpi("CLS (tuần này)", orders_this)
-        with c4: kpi("Số ngày điều trị TB/BN", avg_days_this)
-    except Exception:
-        import traceback
-        st.error("Lỗi khi hiển thị KPI")
-        st.code(traceback.format_exc())
-
-# ======================
-# Đi buồng (đã chuyển sang dùng Modal/Dialog)
-# ======================
-elif page == "Đi buồng":
-    st.title("🚶‍♂️ Đi buồng (Ward round)")
-
-    # ========= Modal: form khám =========
-    @st.dialog("🧑‍⚕️ Khám đi buồng")
-    def open_round_dialog(patient_id: int):
-        p = get_patient_info(patient_id)
-        if not p:
-            st.error("Không tìm thấy bệnh nhân."); return
-
-        st.markdown(f"**{p['name']}** — {p.get('medical_id') or '—'}  \nPhòng {p.get('ward','')} • Giường {p.get('bed','') or '—'}")
-        with st.form(f"form_round_{patient_id}"):
-            colA, colB = st.columns([1,1])
-            with colA:
-                try:
-                    visit_day = st.date_input("Ngày khám", value=date.today(), format="DD/MM/YYYY")
-                except TypeError:
-                    visit_day = st.date_input("Ngày khám", value=date.today())
-            with colB:
-                operated_now = st.checkbox("Đã phẫu thuật", value=bool(p.get("operated",0)))
-
-            general_status = st.text_area("Tình trạng toàn thân", height=100)
-            system_exam    = st.text_area("Khám bộ phận", height=140)
-            plan           = st.text_area("Phương án điều trị tiếp", height=120)
-
-            st.markdown("#### 🧪 CLS thêm")
-            extra_opts = [f"{t[0]} — {t[1]}" for t in COMMON_TESTS]
-            extra_selected = st.multiselect("Chọn CLS", extra_opts)
-            extra_note = st.text_area("Diễn giải CLS / Lý do", placeholder="VD: tăng CRP, nghi nhiễm; kiểm tra HbA1c…")
-            try:
-                extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=date.today(), format="DD/MM/YYYY")
-            except TypeError:
-                extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=date.today())
-
-            b1, b2, b3 = st.columns([1,1,1])
-            save_round    = b1.form_submit_button("💾 Lưu khám")
-            discharge_now = b3.form_submit_button("🏁 Xuất viện hôm nay")
-
-        if save_round:
-            update_patient_operated(patient_id, operated_now)
-            round_rec = {
-                "patient_id": patient_id,
-                "visit_date": visit_day.strftime(DATE_FMT),
-                "general_status": general_status.strip(),
-                "system_exam": system_exam.strip(),
-                "plan": plan.strip(),
-                "extra_tests": ", ".join(extra_selected) if extra_selected else "",
-                "extra_tests_note": extra_note.strip(),
-            }
-            add_ward_round(round_rec)
-
-            if extra_selected:
-                today_str = date.today().strftime(DATE_FMT)
-                sched_str = extra_scheduled.strftime(DATE_FMT)
-                text_to_tuple = {f"{t[0]} — {t[1]}": t for t in COMMON_TESTS}
-                for sel in extra_selected:
-                    ot, desc = text_to_tuple[sel]
-                    desc_full = desc if not extra_note.strip() else f"{desc} — {extra_note.strip()}"
-                    add_order({
-                        "patient_id": patient_id,
-                        "order_type": ot,
-                        "description": desc_full,
-                        "date_ordered": today_str,
-                        "scheduled_date": sched_str,
-                        "status": "scheduled"
-                    })
-
-            st.success("✅ Đã lưu nội dung khám đi buồng")
-            st.cache_data.clear()
-            safe_rerun()
-
-        if discharge_now:
-            discharge_patient(patient_id)
-            st.success("🏁 Đã xuất viện.")
-            st.cache_data.clear()
-            st.session_state.active_page = "Xuất viện"
-            st.session_state.discharge_view_date = date.today()
-            safe_rerun()
-
-    # ==== TÌM KIẾM NHANH BN (không phân biệt dấu, Enter để tìm) ====
-    def _strip_accents(s: str) -> str:
-        if not isinstance(s, str):
-            return ""
-        s = s.lower().strip()
-        return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
-
-    st.markdown("### 🔎 Tìm BN nhanh")
-
-    # 1) Nhập & nhấn Enter để tìm
-    with st.form("qsearch_form", clear_on_submit=False):
-        q_text = st.text_input(
-            "Nhập tên (có/không dấu) hoặc mã bệnh án rồi nhấn Enter",
-            key="qsearch_text",
-            placeholder="VD: hoang kim tuoc hoặc BN001"
-        )
-        submitted = st.form_submit_button("Tìm")  # Enter trong ô sẽ kích hoạt
-
-    # 2) Xử lý sau khi submit
-    if submitted:
-        q_norm = _strip_accents(q_text)
-        if not q_norm:  # cho phép 1 chữ, nhưng không để rỗng
-            st.warning("Bạn chưa nhập nội dung tìm kiếm.")
-        else:
-            # Lấy danh sách BN đang điều trị (bỏ giường/đã mổ; thêm chẩn đoán)
-            df_act = query_df("""
-                SELECT id, medical_id, name, ward, diagnosis
-                FROM patients
-                WHERE active = 1
-                ORDER BY name
-            """)
-
-            if df_act.empty:
-                st.info("Chưa có bệnh nhân đang điều trị.")
-            else:
-                # Map phương án điều trị tiếp mới nhất cho mọi BN
-                plan_map = latest_plan_map_all_patients()
-
-                # Lọc: trùng 1 phần tên (không dấu) hoặc 1 phần mã BA
-                results = []
-                for r in df_act.to_dict(orient="records"):
-                    name_norm = _strip_accents(r.get("name", ""))
-                    mid = (r.get("medical_id") or "").lower()
-                    if (q_norm in name_norm) or (q_norm in mid):
-                        results.append(r)
-
-                # Hiển thị theo BẢNG có thể kéo ngang (phù hợp mobile)
-                if not results:
-                    st.info("Không tìm thấy bệnh nhân phù hợp.")
-                else:
-                    st.success(f"Tìm thấy {len(results)} bệnh nhân:")
-
-                    table_rows = []
-                    label_map = {}
-                    for r in results:
-                        pid = int(r["id"])
-                        plan_last = plan_map.get(pid, "") or "—"
-                        row = {
-                            "Họ tên": r.get("name", "—"),
-                            "Mã BA": r.get("medical_id") or "—",
-                            "Phòng": r.get("ward") or "—",
-                            "Chẩn đoán": r.get("diagnosis") or "—",
-                            "PA điều trị tiếp": plan_last,
-                            "PID": pid,  # để mở Khám
-                        }
-                        table_rows.append(row)
-                        label_map[pid] = f"{row['Họ tên']} — {row['Mã BA']} (P.{row['Phòng']})"
-
-                    df_view = pd.DataFrame(table_rows)
-                    st.dataframe(
-                        df_view.drop(columns=["PID"]),
-                        use_container_width=True,
-                        hide_index=True
-                    )
-
-                    # Chọn một BN để mở dialog Khám
-                    pid_options = [r["PID"] for r in table_rows]
-                    if pid_options:
-                        selected_pid = st.selectbox(
-                            "Chọn bệnh nhân để mở Khám",
-                            options=pid_options,
-                            format_func=lambda x: label_map.get(int(x), str(x)),
-                            key="qsearch_pick_pid"
-                        )
-                        if st.button("Khám", key="qsearch_open"):
-                            open_round_dialog(int(selected_pid))
-
-    st.markdown("---")
-    # ==== HẾT - TÌM KIẾM NHANH BN ====
-
-    # ================== Nội dung trang ==================
-    wards_df = query_df("SELECT DISTINCT ward FROM patients WHERE active=1 AND ward IS NOT NULL AND ward<>'' ORDER BY ward")
-    ward_options = wards_df["ward"].tolist() if not wards_df.empty else []
-    sel_ward = st.selectbox("Chọn phòng", ward_options if ward_options else ["(Chưa có phòng)"])
-
-    # === 🗂️ Thư mục trong ngày: Đã khám hôm nay & Nhập mới hôm nay (theo phòng) ===
-    if ward_options:
-        st.markdown(f"### 🗂️ Thư mục trong ngày — Phòng **{sel_ward}**")
-        today_str = date.today().strftime(DATE_FMT)
-        colL, colR = st.columns(2)
-
-        # ĐÃ KHÁM HÔM NAY
-        df_round_today_full = rounds_latest_today_with_plan()
-        if not df_round_today_full.empty:
-            df_round_today_full = df_round_today_full[df_round_today_full["ward"] == sel_ward]
-            if df_round_today_full.empty:
-                with colL:
-                    st.markdown("**Đã khám đi buồng hôm nay**")
-                    st.info("Chưa có.")
-            else:
-                df_v1 = df_round_today_full.copy()
-                df_v1["Tuổi"] = df_v1["dob"].apply(calc_age)
-                df_v1 = df_v1.rename(columns={
-                    "name":"Họ và tên","diagnosis":"Chẩn đoán","notes":"Ghi chú","plan":"Phương án điều trị tiếp"
-                })
-                df_v1 = df_v1[["Họ và tên","Tuổi","Chẩn đoán","Phương án điều trị tiếp","Ghi chú"]]
-                with colL:
-                    st.markdown("**Đã khám đi buồng hôm nay**")
-                    st.dataframe(df_v1, use_container_width=True, hide_index=True)
-        else:
-            with colL:
-                st.markdown("**Đã khám đi buồng hôm nay**")
-                st.info("Chưa có.")
-
-        # BN nhập mới hôm nay
-        df_new_today = query_df("""
-            SELECT id, name, dob, diagnosis, notes, ward, active
-            FROM patients
-            WHERE admission_date = ? AND active = 1
-            ORDER BY name
-        """, (today_str,))
-        if not df_new_today.empty:
-            df_new_today = df_new_today[df_new_today["ward"] == sel_ward]
-            if df_new_today.empty:
-                with colR:
-                    st.markdown("**BN nhập mới hôm nay**")
-                    st.info("Chưa có.")
-            else:
-                df_v2 = df_new_today.copy()
-                df_v2["Tuổi"] = df_v2["dob"].apply(calc_age)
-                df_v2 = df_v2.rename(columns={"name":"Họ và tên","diagnosis":"Chẩn đoán","notes":"Ghi chú"})
-                df_v2 = df_v2[["Họ và tên","Tuổi","Chẩn đoán","Ghi chú"]]
-                with colR:
-                    st.markdown("**BN nhập mới hôm nay**")
-                    st.dataframe(df_v2, use_container_width=True, hide_index=True)
-        else:
-            with colR:
-                st.markdown("**BN nhập mới hôm nay**")
-                st.info("Chưa có.")
-
-        st.markdown("---")
-
-    # DANH SÁCH PHÒNG + Nút KHÁM mở modal
-    if ward_options:
-        df_room = query_df("SELECT * FROM patients WHERE active=1 AND ward=? ORDER BY bed, name", (sel_ward,))
-        if df_room.empty:
-            st.info("Phòng này chưa có BN đang điều trị.")
-        else:
-            st.subheader(f"📋 Danh sách BN phòng {sel_ward}")
-
-            # Map phương án điều trị mới nhất (mọi ngày) cho từng BN
-            plan_map = latest_plan_map_all_patients()
-
-            table_rows = []
-            for r in df_room.to_dict(orient="records"):
-                age = calc_age(r.get("dob"))
-                d_in = days_between(r.get("admission_date"))
-                table_rows.append({
-                    "Mã BA": r["medical_id"],
-                    "Họ tên": r["name"],
-                    "Tuổi": age if age is not None else "",
-                    "Chẩn đoán": r.get("diagnosis","") or "",
-                    "Số ngày điều trị": d_in if d_in is not None else "",
-                    "Đã PT": "✅" if r.get("operated",0)==1 else "✗",
-                    "PA điều trị tiếp": plan_map.get(int(r["id"]), "") or "",
-                    "Ghi chú": r.get("notes","") or "",
-                    "ID": r["id"],
-                })
-            df_view = pd.DataFrame(table_rows)
-            st.dataframe(df_view.drop(columns=["ID"]), use_container_width=True, hide_index=True)
-
-            st.markdown("### Khám tại giường")
-            for r in df_room.to_dict("records"):
-                c = st.columns([3,1,1,1,2,1,1])
-                age = calc_age(r.get("dob"))
-                plan_last = plan_map.get(int(r["id"]), "")
-                c[0].markdown(
-                    f"**{r['name']}** — {r['medical_id']}  "
-                    f"<br/><span class='small'>Chẩn đoán: {r.get('diagnosis','')}</span>"
-                    + (f"<br/><span class='small'>PA điều trị: {plan_last}</span>" if plan_last else ""),
-                    unsafe_allow_html=True
-                )
-                d_in = days_between(r.get("admission_date"))
-                c[1].markdown(f"Tuổi: **{age if age is not None else ''}**")
-                c[2].markdown(f"Ngày điều trị: **{d_in if d_in is not None else ''}**")
-                c[3].markdown("Đã PT: **✅**" if r.get("operated",0)==1 else "Đã PT: **✗**")
-                c[4].markdown(f"<span class='small'>{r.get('notes','')}</span>", unsafe_allow_html=True)
-                if c[5].button("Khám", key=f"round_{r['id']}"):
-                    open_round_dialog(int(r["id"]))  # mở modal
-                if c[6].button("✏️ Sửa", key=f"round_edit_{r['id']}"):
-                    go_edit(r["id"])
-
-    # LỊCH SỬ KHÁM (xem lại)
-    st.markdown("---")
-    st.markdown("### 📅 Lịch sử khám")
-    all_active = query_df("SELECT id, name FROM patients WHERE active=1 ORDER BY name")
-    if all_active.empty:
-        st.info("Chưa có BN đang điều trị để xem lịch sử.")
-    else:
-        pid_hist = st.selectbox("Chọn BN để xem lịch sử", options=all_active["id"],
-                                format_func=lambda x: f"{all_active[all_active['id']==x]['name'].values[0]}")
-        if pid_hist:
-            hist_days = query_df("SELECT DISTINCT visit_date FROM ward_rounds WHERE patient_id=? ORDER BY visit_date DESC", (int(pid_hist),))
-            if hist_days.empty:
-                st.info("BN này chưa có lịch sử đi buồng.")
-            else:
-                day_strs = hist_days["visit_date"].tolist()
-                sel_hist = st.selectbox("Chọn ngày để xem lại", day_strs)
-                hist = query_df("""
-                    SELECT * FROM ward_rounds
-                    WHERE patient_id=? AND visit_date=?
-                    ORDER BY id DESC
-                """, (int(pid_hist), sel_hist))
-                for _, r in hist.iterrows():
-                    st.markdown(f"**Lần ghi #{r['id']} — {r['visit_date']}**")
-                    st.write("**Tình trạng toàn thân:**", r["general_status"] or "—")
-                    st.write("**Khám bộ phận:**", r["system_exam"] or "—")
-                    st.write("**Phương án điều trị:**", r["plan"] or "—")
-                    if r["extra_tests"]:
-                        st.write("**CLS thêm:**", r["extra_tests"])
-                    if r["extra_tests_note"]:
-                        st.write("**Diễn giải CLS:**", r["extra_tests_note"])
-                    st.caption(f"🕒 Tạo lúc: {r['created_at']}")
-                    st.markdown("---")
-
-# ======================
-# Lịch XN/Chụp
-# ======================
-elif page == "Lịch XN/Chụp":
-    st.title("🧪 Lịch xét nghiệm & chụp chiếu")
-
-    df_orders = query_df("""
-        SELECT o.*, p.name as patient_name, p.ward
-        FROM orders o LEFT JOIN patients p ON o.patient_id=p.id
-    """)
-    if df_orders.empty:
-        st.info("Chưa có chỉ định nào.")
-    else:
-        filter_choice = st.selectbox("Xem", ["Hôm nay", "7 ngày tới", "Tất cả"], index=0)
-        today_str = date.today().strftime(DATE_FMT)
-        if filter_choice == "Hôm nay":
-            df_view = df_orders[df_orders["scheduled_date"]==today_str]
-        elif filter_choice == "7 ngày tới":
-            end = (date.today()+timedelta(days=7)).strftime(DATE_FMT)
-            df_view = df_orders[(df_orders["scheduled_date"]>=today_str) & (df_orders["scheduled_date"]<=end)]
-        else:
-            df_view = df_orders.copy()
-
-        for od in df_view.sort_values(["scheduled_date"]).to_dict(orient="records"):
-            st.markdown(f"**{od['patient_name']}** — {od['order_type']} — {od.get('description','')}")
-            st.caption(f"Đặt: {od.get('date_ordered')} | Dự kiến: {od.get('scheduled_date')} | Trạng thái: {od.get('status')}")
-            col1, col2 = st.columns([3,1])
-            with col1:
-                result_text = st.text_input(f"Kết quả (Order {od['id']})", key=f"res_{od['id']}")
-            with col2:
-                if st.button("Đánh dấu đã làm", key=f"done_{od['id']}"):
-                    mark_order_done(od["id"], result_text)
-                    st.success("✅ Đã đánh dấu hoàn thành")
-                    st.cache_data.clear()
-                    safe_rerun()
-        st.dataframe(
-            df_view[["id","patient_name","ward","order_type","description","date_ordered","scheduled_date","status","result_date"]],
-            use_container_width=True, hide_index=True
-        )
-
-    st.subheader("Thêm chỉ định mới")
-    patients_df = query_df("SELECT id, medical_id, name, ward FROM patients WHERE active=1 ORDER BY ward, name")
-    if not patients_df.empty:
-        with st.form("form_add_order", clear_on_submit=True):
-            pid = st.selectbox(
-                "Chọn BN",
-                options=patients_df["id"],
-                format_func=lambda x: f"{patients_df[patients_df['id']==x]['medical_id'].values[0]} - {patients_df[patients_df['id']==x]['name'].values[0]} ({patients_df[patients_df['id']==x]['ward'].values[0]})"
-            )
-            custom_types = ["XN máu","X-quang","CT","Siêu âm","Khác"]
-            order_type = st.selectbox("Loại", sorted(set(custom_types + [t[0] for t in COMMON_TESTS])))
-            desc = st.text_area("Mô tả")
-            try:
-                scheduled = st.date_input("Ngày dự kiến", value=date.today(), format="DD/MM/YYYY")
-            except TypeError:
-                scheduled = st.date_input("Ngày dự kiến", value=date.today())
-            submitted2 = st.form_submit_button("➕ Thêm chỉ định")
-            if submitted2:
-                add_order({
-                    "patient_id": int(pid),
-                    "order_type": order_type,
-                    "description": desc.strip(),
-                    "date_ordered": date.today().strftime(DATE_FMT),
-                    "scheduled_date": scheduled.strftime(DATE_FMT),
-                    "status":"scheduled"
-                })
-                st.success("✅ Thêm chỉ định thành công")
-                st.cache_data.clear()
-                safe_rerun()
-    else:
-        st.info("Không có BN đang điều trị để thêm chỉ định.")
-
-# ======================
-# Trang XUẤT VIỆN
-# ======================
-elif page == "Xuất viện":
-    st.title("🏁 Xuất viện")
-
-    if "discharge_view_date" not in st.session_state:
-        st.session_state.discharge_view_date = date.today()
-
-    today_date = date.today()
-    today_str = today_date.strftime(DATE_FMT)
-    df_today = query_df("SELECT * FROM patients WHERE discharge_date = ? ORDER BY ward, name", (today_str,))
-    st.subheader(f"Hôm nay ({today_date.strftime('%d/%m/%Y')})")
-    st.write(f"Số bệnh nhân xuất viện: **{len(df_today)}**")
-
-    def _render_discharge_list(df_src: pd.DataFrame, key_prefix: str):
-        if df_src.empty:
-            st.info("Không có bệnh nhân.")
-            return
-        df_show = df_src.copy()
-        df_show["Số ngày điều trị"] = df_show.apply(lambda r: days_between(r["admission_date"], r["discharge_date"]), axis=1)
+    st.title("📊 Dashboard — Theo dõi bệnh nhân")
+
+    # Hiển thị banner (nếu đã tải lên trong thư mục static/)
+    banner_paths = ["static/banner.png", "static/banner.jpg", "static/banner.jpeg", "static/banner.gif"]
+    banner_file = next((p for p in banner_paths if os.path.exists(p)), None)
+    if banner_file:
+        try:
+            st.image(banner_file, use_container_width=True)
+        except Exception:
+            st.markdown(f"![banner]({banner_file})")
+    else:
+        st.markdown(
+            "<div class='header-card'>"
+            "<h2 style='margin:0'>Phần mềm theo dõi bệnh nhân</h2>"
+            "<p class='small' style='margin:6px 0 0 0'>Không có banner. Vào Cài đặt / Demo để tải ảnh hiển thị ở đầu trang.</p>"
+            "</div>",
+            unsafe_allow_html=True
+        )
+
+    # Quick action toolbar
+    st.markdown("<div class='header-card'>", unsafe_allow_html=True)
+    col_a, col_b, col_c, col_d, col_e = st.columns([2,2,2,2,6])
+    with col_a:
+        if st.button("➕ Thêm BN"):
+            st.session_state.active_page = "Nhập viện mới"; safe_rerun()
+    with col_b:
+        if st.button("🚶 Đi buồng"):
+            st.session_state.active_page = "Đi buồng"; safe_rerun()
+    with col_c:
+        if st.button("🧪 Lịch XN"):
+            st.session_state.active_page = "Lịch XN/Chụp"; safe_rerun()
+    with col_d:
+        if st.button("📑 Báo cáo"):
+            st.session_state.active_page = "Báo cáo"; safe_rerun()
+    with col_e:
+        st.markdown("<div class='small'>Ngắn gọn: Tạo BN mới, mở form đi buồng, quản lý chỉ định, xem báo cáo nhanh.</div>", unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    ward_list = ["Tất cả"] + list_wards()
+    f_col1, f_col2 = st.columns([1,2])
+    with f_col1: ward_filter = st.selectbox("Lọc theo phòng", ward_list, index=0)
+    with f_col2: st.markdown("<div class='small'>Gợi ý: dùng bộ lọc để xem nhanh khoa/phòng.</div>", unsafe_allow_html=True)
+
+    stats = dashboard_stats(ward_filter)
+
+    c1, c2, c3, c4, c5 = st.columns(5)
+    with c1: kpi("BN đang điều trị", stats["total_active"], icon="🫀")
+    with c2: kpi("Thời gian điều trị TB (ngày)", stats["avg_days"], icon="⏱️")
+    with c3: kpi("Chờ mổ", stats["count_wait_surg"], icon="🔪")
+    with c4: kpi("BN có order chưa xong", stats["pending_patients"], icon="📋")
+    with c5: kpi("Order quá hạn / đến hạn", stats["scheduled_not_done"], icon="⚠️")
+    st.markdown("---")
+
+    st.subheader("BN theo phòng")
+    ward_pie_chart(stats["patients_per_ward"])
+
+    st.subheader("Trạng thái chỉ định")
+    orders_status_pie_chart(stats["orders_by_status"])
+
+    # Fragment: chọn dòng trong bảng chỉ chạy lại phần danh sách, không chạy lại KPI/biểu đồ
+    @st.fragment
+    def render_active_list(ward: str, total_active: int):
+        # on_change="rerun": chỉ truy vấn bảng BN khi người dùng mở expander (chỉ xem KPI thì không đọc)
+        active_exp = st.expander("📋 Danh sách BN (đang điều trị)", expanded=False,
+                                 key="home_active_exp", on_change="rerun")
+        if not active_exp.open:
+            return
+        with active_exp:
+            df_active = active_patients_table(ward) if total_active else pd.DataFrame(columns=ACTIVE_LIST_COLS)
+            if df_active.empty:
+                st.info("Không có bệnh nhân đang nằm.")
+            else:
+                # Huy hiệu hiển thị ngay trong bảng (thay cho markdown từng dòng)
+                view_df = df_active[ACTIVE_LIST_COLS].assign(
+                    surgery_needed=lambda d: d["surgery_needed"].map({1: "🔪 Cần mổ"}).fillna(""),
+                    operated=lambda d: d["operated"] == 1,
+                )
+                # Chọn BN bằng cách bấm vào dòng trong bảng, thay cho selectbox riêng
+                table = st.dataframe(
+                    view_df, use_container_width=True, hide_index=True,
+                    column_config={
+                        "id": "ID", "medical_id": "Mã BA", "name": "Họ tên", "ward": "Phòng", "bed": "Giường",
+                        "surgery_needed": "Cần mổ", "admission_date": "Ngày NV",
+                        "diagnosis": "Chẩn đoán", "notes": "Ghi chú",
+                        "operated": st.column_config.CheckboxColumn("Đã phẫu thuật"),
+                    },
+                    key="home_active_table", on_select="rerun", selection_mode="single-row",
+                )
+                rows = [i for i in table.selection.rows if i < len(view_df)]
+                home_pid = int(view_df["id"].iloc[rows[0]]) if rows else None
+                a_col1, a_col2, a_col3 = st.columns([3,1,1])
+                if home_pid is None:
+                    a_col1.caption("Bấm chọn 1 dòng trong bảng để chỉnh sửa / xuất viện.")
+                else:
+                    picked = view_df.iloc[rows[0]]
+                    a_col1.markdown(f"Đã chọn: **{picked['medical_id'] or '—'} - {picked['name']}** (Phòng {picked['ward'] or '—'})")
+                if a_col2.button("✏️ Chỉnh sửa", key="edit_home", disabled=home_pid is None):
+                    go_edit(home_pid)
+                if a_col3.button("Xuất viện", key="dis_home", disabled=home_pid is None):
+                    discharge_patient(home_pid); st.success(f"Đã xuất viện {picked['name']}"); safe_rerun()
+
+    render_active_list(ward_filter, stats["total_active"])
+
+# ======================
+# Trang TỔNG QUAN
+# ======================
+elif page == "Tổng quan":
+    st.title("📈 Tổng quan theo tuần")
+
+    # Tính toán số liệu
+    this_start, this_end = week_range(TODAY, 0)
+    last_start, last_end = week_range(TODAY, -1)
+
+    try:
+        # Biểu đồ chỉ cần vài con số: gộp trong SQL, không tải cả bảng patients về pandas
+        treatment_this, avg_days_this = treatment_stats_between(this_start, this_end)
+        discharge_this = count_discharges_between(this_start, this_end)
+        orders_this    = count_orders_between(this_start, this_end)
+
+        treatment_last, avg_days_last = treatment_stats_between(last_start, last_end)
+        discharge_last = count_discharges_between(last_start, last_end)
+        orders_last    = count_orders_between(last_start, last_end)
+    except Exception as e:
+        import traceback
+        st.error("Lỗi khi tính toán số liệu. Xem chi tiết")
+        st.code(traceback.format_exc())
+        st.stop()
+
+    # Debug expander (ẩn) để kiểm tra nội dung trung gian
+    with st.expander("Debug số liệu (chỉ hiện khi cần)"):
+        st.write("this_start", this_start, "this_end", this_end)
+        st.write("treatment_this", treatment_this, type(treatment_this))
+        st.write("discharge_this", discharge_this, type(discharge_this))
+        st.write("orders_this", orders_this, type(orders_this))
+        st.write("avg_days_this", avg_days_this, type(avg_days_this))
+        st.write("treatment_last", treatment_last)
+        st.write("discharge_last", discharge_last)
+        st.write("orders_last", orders_last)
+        st.write("avg_days_last", avg_days_last)
+        st.markdown("---")
+        st.write("Sample active_this_df:")
+        try:
+            st.dataframe(patients_active_between(this_start, this_end, limit=5), use_container_width=True)
+        except Exception as e:
+            st.write("Không thể hiển thị dataframe:", e)
+
+    # Vẽ biểu đồ — mỗi phần có try/except riêng để bắt lỗi
+    st.subheader("Ra viện vs Lượt điều trị (tuần này)")
+    try:
+        df1 = pd.DataFrame({"Chỉ số": ["Lượt điều trị", "Ra viện"], "Giá trị": [treatment_this, discharge_this]})
+        st.altair_chart(alt.Chart(df1).mark_bar().encode(x="Chỉ số:N", y="Giá trị:Q", tooltip=["Chỉ số","Giá trị"]).properties(height=280), use_container_width=True)
+    except Exception:
+        import traceback
+        st.error("Lỗi khi vẽ biểu đồ Ra viện vs Lượt điều trị")
+        st.code(traceback.format_exc())
+
+    st.subheader("Chỉ định cận lâm sàng (tuần này) so với Lượt điều trị")
+    try:
+        df2 = pd.DataFrame({"Hạng mục": ["Chỉ định CLS", "Lượt điều trị"], "Số lượng": [orders_this, treatment_this]})
+        st.altair_chart(alt.Chart(df2).mark_bar().encode(x="Hạng mục:N", y="Số lượng:Q", tooltip=["Hạng mục","Số lượng"]).properties(height=280), use_container_width=True)
+    except Exception:
+        import traceback
+        st.error("Lỗi khi vẽ biểu đồ Chỉ định CLS")
+        st.code(traceback.format_exc())
+
+    st.subheader("So sánh tuần này và tuần trước")
+    try:
+        comp_df = pd.DataFrame([
+            {"Chỉ số":"Số ngày điều trị TB/BN", "Tuần":"Tuần trước", "Giá trị": avg_days_last},
+            {"Chỉ số":"Số ngày điều trị TB/BN", "Tuần":"Tuần này",   "Giá trị": avg_days_this},
+            {"Chỉ số":"Ra viện",                "Tuần":"Tuần trước", "Giá trị": discharge_last},
+            {"Chỉ số":"Ra viện",                "Tuần":"Tuần này",   "Giá trị": discharge_this},
+            {"Chỉ số":"Lượt điều trị",          "Tuần":"Tuần trước", "Giá trị": treatment_last},
+            {"Chỉ số":"Lượt điều trị",          "Tuần":"Tuần này",   "Giá trị": treatment_this},
+        ])
+        chart3 = (
+            alt.Chart(comp_df)
+            .mark_bar()
+            .encode(x=alt.X("Chỉ số:N", sort=None), y="Giá trị:Q", column=alt.Column("Tuần:N", sort=["Tuần trước","Tuần này"]),
+                    tooltip=["Tuần","Chỉ số","Giá trị"]) 
+            .properties(height=280)
+            .resolve_scale(y='independent')
+        )
+        st.altair_chart(chart3, use_container_width=True)
+    except Exception:
+        import traceback
+        st.error("Lỗi khi vẽ biểu đồ So sánh tuần")
+        st.code(traceback.format_exc())
+
+    st.markdown("---")
+    try:
+        c1, c2, c3, c4 = st.columns(4)
+        with c1: kpi("Lượt điều trị (tuần này)", treatment_this)
+        with c2: kpi("Ra viện (tuần này)", discharge_this)
+        with c3: kpi("CLS (tuần này)", orders_this)
+        with c4: kpi("Số ngày điều trị TB/BN", avg_days_this)
+    except Exception:
+        import traceback
+        st.error("Lỗi khi hiển thị KPI")
+        st.code(traceback.format_exc())
+
+# ======================
+# Đi buồng (đã chuyển sang dùng Modal/Dialog)
+# ======================
+elif page == "Đi buồng":
+    st.title("🚶‍♂️ Đi buồng (Ward round)")
+
+    # ========= Modal: form khám =========
+    @st.dialog("🧑‍⚕️ Khám đi buồng")
+    def open_round_dialog(patient_id: int):
+        p = get_patient_info(patient_id)
+        if not p:
+            st.error("Không tìm thấy bệnh nhân."); return
+
+        st.markdown(f"**{p['name']}** — {p.get('medical_id') or '—'}  \nPhòng {p.get('ward','')} • Giường {p.get('bed','') or '—'}")
+        with st.form(f"form_round_{patient_id}"):
+            colA, colB = st.columns([1,1])
+            with colA:
+                try:
+                    visit_day = st.date_input("Ngày khám", value=TODAY, format="DD/MM/YYYY")
+                except TypeError:
+                    visit_day = st.date_input("Ngày khám", value=TODAY)
+            with colB:
+                operated_now = st.checkbox("Đã phẫu thuật", value=bool(p.get("operated",0)))
+
+            general_status = st.text_area("Tình trạng toàn thân", height=100)
+            system_exam    = st.text_area("Khám bộ phận", height=140)
+            plan           = st.text_area("Phương án điều trị tiếp", height=120)
+
+            st.markdown("#### 🧪 CLS thêm")
+            extra_selected = st.multiselect("Chọn CLS", COMMON_TESTS_LABELS)
+            extra_note = st.text_area("Diễn giải CLS / Lý do", placeholder="VD: tăng CRP, nghi nhiễm; kiểm tra HbA1c…")
+            try:
+                extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=TODAY, format="DD/MM/YYYY")
+            except TypeError:
+                extra_scheduled = st.date_input("Ngày dự kiến thực hiện CLS", value=TODAY)
+
+            b1, b2, b3 = st.columns([1,1,1])
+            save_round    = b1.form_submit_button("💾 Lưu khám")
+            discharge_now = b3.form_submit_button("🏁 Xuất viện hôm nay")
+
+        if save_round:
+            round_rec = {
+                "patient_id": patient_id,
+                "visit_date": visit_day.strftime(DATE_FMT),
+                "general_status": general_status.strip(),
+                "system_exam": system_exam.strip(),
+                "plan": plan.strip(),
+                "extra_tests": ", ".join(extra_selected) if extra_selected else "",
+                "extra_tests_note": extra_note.strip(),
+            }
+            new_orders = []
+            if extra_selected:
+                sched_str = extra_scheduled.strftime(DATE_FMT)
+                for sel in extra_selected:
+                    ot, desc = COMMON_TESTS_BY_LABEL[sel]
+                    desc_full = desc if not extra_note.strip() else f"{desc} — {extra_note.strip()}"
+                    new_orders.append({
+                        "patient_id": patient_id,
+                        "order_type": ot,
+                        "description": desc_full,
+                        "date_ordered": TODAY_STR,
+                        "scheduled_date": sched_str,
+                        "status": "scheduled"
+                    })
+            save_ward_round(round_rec, operated_now, new_orders)
+
+            st.success("✅ Đã lưu nội dung khám đi buồng")
+            safe_rerun()
+
+        if discharge_now:
+            discharge_patient(patient_id)
+            st.success("🏁 Đã xuất viện.")
+            st.session_state.active_page = "Xuất viện"
+            st.session_state.discharge_view_date = TODAY
+            safe_rerun()
+
+    # ==== TÌM KIẾM NHANH BN (không phân biệt dấu, Enter để tìm) ====
+    st.markdown("### 🔎 Tìm BN nhanh")
+
+    # 1) Nhập & nhấn Enter để tìm
+    with st.form("qsearch_form", clear_on_submit=False):
+        q_text = st.text_input(
+            "Nhập tên (có/không dấu) hoặc mã bệnh án rồi nhấn Enter",
+            key="qsearch_text",
+            placeholder="VD: hoang kim tuoc hoặc BN001"
+        )
+        submitted = st.form_submit_button("Tìm")  # Enter trong ô sẽ kích hoạt
+
+    # 2) Xử lý sau khi submit
+    if submitted:
+        q_norm = _strip_accents(q_text)
+        if not q_norm:  # cho phép 1 chữ, nhưng không để rỗng
+            st.warning("Bạn chưa nhập nội dung tìm kiếm.")
+        else:
+            # Lọc ngay trong SQLite: trùng 1 phần tên (không dấu, cột name_ascii) hoặc 1 phần mã BA
+            q_like = q_norm.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            df_hits = query_df(r"""
+                SELECT id, medical_id, name, ward, diagnosis
+                FROM patients
+                WHERE active = 1
+                  AND (name_ascii LIKE '%' || ? || '%' ESCAPE '\'
+                       OR LOWER(medical_id) LIKE '%' || ? || '%' ESCAPE '\')
+                ORDER BY name
+            """, (q_like, q_like))
+            results = list(df_hits.itertuples(index=False))
+
+            # Hiển thị theo BẢNG có thể kéo ngang (phù hợp mobile)
+            if not results:
+                st.info("Không tìm thấy bệnh nhân phù hợp.")
+            else:
+                st.success(f"Tìm thấy {len(results)} bệnh nhân:")
+                # Map phương án điều trị tiếp mới nhất cho mọi BN
+                plan_map = latest_plan_map_all_patients()
+
+                # Một lượt duyệt: dòng bảng + danh sách PID + nhãn cho selectbox
+                table_rows = []
+                pid_options = []
+                label_map = {}
+                for r in results:
+                    pid = int(r.id)
+                    row = {
+                        "Họ tên": r.name or "—",
+                        "Mã BA": r.medical_id or "—",
+                        "Phòng": r.ward or "—",
+                        "Chẩn đoán": r.diagnosis or "—",
+                        "PA điều trị tiếp": plan_map.get(pid, "") or "—",
+                    }
+                    table_rows.append(row)
+                    pid_options.append(pid)
+                    label_map[pid] = f"{row['Họ tên']} — {row['Mã BA']} (P.{row['Phòng']})"
+
+                st.dataframe(
+                    pd.DataFrame(table_rows),
+                    use_container_width=True,
+                    hide_index=True
+                )
+
+                # Chọn một BN để mở dialog Khám
+                if pid_options:
+                    selected_pid = st.selectbox(
+                        "Chọn bệnh nhân để mở Khám",
+                        options=pid_options,
+                        format_func=label_map.get,
+                        key="qsearch_pick_pid"
+                    )
+                    if st.button("Khám", key="qsearch_open"):
+                        open_round_dialog(int(selected_pid))
+
+    st.markdown("---")
+    # ==== HẾT - TÌM KIẾM NHANH BN ====
+
+    # ================== Nội dung trang ==================
+    ward_options = list_wards(active_only=True)
+    sel_ward = st.selectbox("Chọn phòng", ward_options if ward_options else ["(Chưa có phòng)"])
+
+    # === 🗂️ Thư mục trong ngày: Đã khám hôm nay & Nhập mới hôm nay (theo phòng) ===
+    if ward_options:
+        st.markdown(f"### 🗂️ Thư mục trong ngày — Phòng **{sel_ward}**")
+        colL, colR = st.columns(2)
+
+        # ĐÃ KHÁM HÔM NAY
+        df_round_today_full = rounds_latest_today_with_plan()
+        if not df_round_today_full.empty:
+            df_round_today_full = df_round_today_full[df_round_today_full["ward"] == sel_ward]
+            if df_round_today_full.empty:
+                with colL:
+                    st.markdown("**Đã khám đi buồng hôm nay**")
+                    st.info("Chưa có.")
+            else:
+                df_v1 = df_round_today_full.copy()
+                df_v1["Tuổi"] = ages_from_dob(df_v1["dob"], TODAY)
+                df_v1 = df_v1.rename(columns={
+                    "name":"Họ và tên","diagnosis":"Chẩn đoán","notes":"Ghi chú","plan":"Phương án điều trị tiếp"
+                })
+                df_v1 = df_v1[["Họ và tên","Tuổi","Chẩn đoán","Phương án điều trị tiếp","Ghi chú"]]
+                with colL:
+                    st.markdown("**Đã khám đi buồng hôm nay**")
+                    st.dataframe(df_v1, use_container_width=True, hide_index=True)
+        else:
+            with colL:
+                st.markdown("**Đã khám đi buồng hôm nay**")
+                st.info("Chưa có.")
+
+        # BN nhập mới hôm nay
+        df_new_today = query_df("""
+            SELECT id, name, dob, diagnosis, notes, ward, active
+            FROM patients
+            WHERE admission_date = ? AND active = 1
+            ORDER BY name
+        """, (TODAY_STR,))
+        if not df_new_today.empty:
+            df_new_today = df_new_today[df_new_today["ward"] == sel_ward]
+            if df_new_today.empty:
+                with colR:
+                    st.markdown("**BN nhập mới hôm nay**")
+                    st.info("Chưa có.")
+            else:
+                df_v2 = df_new_today.copy()
+                df_v2["Tuổi"] = ages_from_dob(df_v2["dob"], TODAY)
+                df_v2 = df_v2.rename(columns={"name":"Họ và tên","diagnosis":"Chẩn đoán","notes":"Ghi chú"})
+                df_v2 = df_v2[["Họ và tên","Tuổi","Chẩn đoán","Ghi chú"]]
+                with colR:
+                    st.markdown("**BN nhập mới hôm nay**")
+                    st.dataframe(df_v2, use_container_width=True, hide_index=True)
+        else:
+            with colR:
+                st.markdown("**BN nhập mới hôm nay**")
+                st.info("Chưa có.")
+
+        st.markdown("---")
+
+    # DANH SÁCH PHÒNG + Nút KHÁM mở modal
+    if ward_options:
+        df_room = query_df("SELECT * FROM patients WHERE active=1 AND ward=? ORDER BY bed, name", (sel_ward,))
+        if df_room.empty:
+            st.info("Phòng này chưa có BN đang điều trị.")
+        else:
+            st.subheader(f"📋 Danh sách BN phòng {sel_ward}")
+
+            # Map phương án điều trị mới nhất (mọi ngày) cho từng BN
+            plan_map = latest_plan_map_all_patients()
+
+            # Tuổi / số ngày điều trị tính 1 lần cho cả phòng (vector), dùng chung cho bảng và các dòng khám
+            df_room = df_room.assign(
+                age=ages_from_dob(df_room["dob"], TODAY),
+                d_in=days_since(df_room["admission_julian"], TODAY).astype("Int64"),
+            )
+            df_view = pd.DataFrame({
+                "Mã BA": df_room["medical_id"],
+                "Họ tên": df_room["name"],
+                "Tuổi": df_room["age"],
+                "Chẩn đoán": df_room["diagnosis"].fillna(""),
+                "Số ngày điều trị": df_room["d_in"],
+                "Đã PT": df_room["operated"].map({1: "✅"}).fillna("✗"),
+                "PA điều trị tiếp": df_room["id"].astype(int).map(plan_map).fillna(""),
+                "Ghi chú": df_room["notes"].fillna(""),
+            })
+            st.dataframe(df_view, use_container_width=True, hide_index=True)
+
+            st.markdown("### Khám tại giường")
+            for r in df_room.itertuples(index=False):
+                c = st.columns([3,1,1,1,2,1,1])
+                age = "" if pd.isna(r.age) else r.age
+                plan_last = plan_map.get(int(r.id), "")
+                c[0].markdown(
+                    f"**{r.name}** — {r.medical_id}  "
+                    f"<br/><span class='small'>Chẩn đoán: {r.diagnosis or ''}</span>"
+                    + (f"<br/><span class='small'>PA điều trị: {plan_last}</span>" if plan_last else ""),
+                    unsafe_allow_html=True
+                )
+                d_in = "" if pd.isna(r.d_in) else r.d_in
+                c[1].markdown(f"Tuổi: **{age}**")
+                c[2].markdown(f"Ngày điều trị: **{d_in}**")
+                c[3].markdown("Đã PT: **✅**" if r.operated==1 else "Đã PT: **✗**")
+                c[4].markdown(f"<span class='small'>{r.notes or ''}</span>", unsafe_allow_html=True)
+                if c[5].button("Khám", key=f"round_{r.id}"):
+                    open_round_dialog(int(r.id))  # mở modal
+                if c[6].button("✏️ Sửa", key=f"round_edit_{r.id}"):
+                    go_edit(r.id)
+
+    # LỊCH SỬ KHÁM (xem lại)
+    st.markdown("---")
+    st.markdown("### 📅 Lịch sử khám")
+    # Chỉ cần danh sách id/nhãn/ngày cho selectbox -> query_rows, không dựng DataFrame
+    hist_labels = {r["id"]: r["name"] for r in query_rows("SELECT id, name FROM patients WHERE active=1 ORDER BY name")}
+    if not hist_labels:
+        st.info("Chưa có BN đang điều trị để xem lịch sử.")
+    else:
+        pid_hist = st.selectbox("Chọn BN để xem lịch sử", options=list(hist_labels),
+                                format_func=hist_labels.get)
+        if pid_hist:
+            day_strs = [r["visit_date"] for r in query_rows(
+                "SELECT DISTINCT visit_date FROM ward_rounds WHERE patient_id=? ORDER BY visit_date DESC", (int(pid_hist),))]
+            if not day_strs:
+                st.info("BN này chưa có lịch sử đi buồng.")
+            else:
+                sel_hist = st.selectbox("Chọn ngày để xem lại", day_strs)
+                hist = query_df("""
+                    SELECT * FROM ward_rounds
+                    WHERE patient_id=? AND visit_date=?
+                    ORDER BY id DESC
+                """, (int(pid_hist), sel_hist))
+                for r in hist.itertuples(index=False):
+                    st.markdown(f"**Lần ghi #{r.id} — {r.visit_date}**")
+                    st.write("**Tình trạng toàn thân:**", r.general_status or "—")
+                    st.write("**Khám bộ phận:**", r.system_exam or "—")
+                    st.write("**Phương án điều trị:**", r.plan or "—")
+                    if r.extra_tests:
+                        st.write("**CLS thêm:**", r.extra_tests)
+                    if r.extra_tests_note:
+                        st.write("**Diễn giải CLS:**", r.extra_tests_note)
+                    st.caption(f"🕒 Tạo lúc: {r.created_at}")
+                    st.markdown("---")
+
+# ======================
+# Lịch XN/Chụp
+# ======================
+elif page == "Lịch XN/Chụp":
+    st.title("🧪 Lịch xét nghiệm & chụp chiếu")
+
+    filter_choice = st.selectbox("Xem", ["Hôm nay", "7 ngày tới", "Tất cả"], index=0)
+    # Lọc và sắp xếp ngay trong SQL (dùng idx_orders_sched_cov); "Tất cả" chỉ truy vấn toàn bộ lịch sử khi người dùng chọn
+    if filter_choice == "Hôm nay":
+        df_view = orders_on_day(TODAY_STR)
+    elif filter_choice == "7 ngày tới":
+        end = (TODAY+timedelta(days=7)).strftime(DATE_FMT)
+        df_view = query_df(ORDERS_JOIN_SQL + " WHERE o.scheduled_date BETWEEN ? AND ?" + ORDERS_ORDER_BY, (TODAY_STR, end))
+    else:
+        df_view = query_df(ORDERS_JOIN_SQL + ORDERS_ORDER_BY)
+
+    if df_view.empty:
+        st.info("Chưa có chỉ định nào." if filter_choice == "Tất cả" else "Không có chỉ định trong khoảng thời gian đã chọn.")
+    else:
+        # 1 bảng sửa được thay cho markdown + ô nhập + nút cho từng chỉ định; lưu các dòng đã đổi bằng 1 executemany
+        base = df_view[["id", "patient_name", "ward", "order_type", "description",
+                        "date_ordered", "scheduled_date", "status", "result"]]
+        with st.form("orders_edit_form"):
+            edited = st.data_editor(
+                base, use_container_width=True, hide_index=True,
+                disabled=["id", "patient_name", "ward", "order_type", "description", "date_ordered", "scheduled_date"],
+                column_config={
+                    "id": "ID", "patient_name": "Bệnh nhân", "ward": "Phòng", "order_type": "Loại",
+                    "description": "Nội dung", "date_ordered": "Ngày đặt", "scheduled_date": "Dự kiến",
+                    "status": st.column_config.SelectboxColumn("Trạng thái", options=ORDER_STATUSES, required=True),
+                    "result": st.column_config.TextColumn("Kết quả"),
+                },
+                # Khóa theo phiên bản bảng orders: sau khi lưu là bảng mới, không mang theo chỉnh sửa cũ
+                key=f"orders_edit_{filter_choice}_{table_version('orders')}",
+            )
+            saved = st.form_submit_button("💾 Lưu thay đổi")
+        if saved:
+            # fillna("") 2 phía: NULL/NaN != NULL/NaN là True -> không thì mọi dòng chưa có status/kết quả bị ghi lại mỗi lần lưu
+            cols = ["status", "result"]
+            diff = edited[cols].fillna("").ne(base[cols].fillna("")).any(axis=1)
+            changed = edited[diff]
+            if changed.empty:
+                st.info("Không có thay đổi.")
+            else:
+                set_orders_status([(int(r.id), r.status, r.result if isinstance(r.result, str) else None)
+                                   for r in changed.itertuples(index=False)])
+                st.success(f"✅ Đã cập nhật {len(changed)} chỉ định")
+                safe_rerun()
+
+    st.subheader("Thêm chỉ định mới")
+    order_pat_rows = query_rows("SELECT id, medical_id, name, ward FROM patients WHERE active=1 ORDER BY ward, name")
+    if order_pat_rows:
+        order_pat_labels = {r["id"]: f"{r['medical_id']} - {r['name']} ({r['ward']})" for r in order_pat_rows}
+        with st.form("form_add_order", clear_on_submit=True):
+            pid = st.selectbox(
+                "Chọn BN",
+                options=list(order_pat_labels),
+                format_func=order_pat_labels.get
+            )
+            order_type = st.selectbox("Loại", ORDER_TYPES)
+            desc = st.text_area("Mô tả")
+            try:
+                scheduled = st.date_input("Ngày dự kiến", value=TODAY, format="DD/MM/YYYY")
+            except TypeError:
+                scheduled = st.date_input("Ngày dự kiến", value=TODAY)
+            submitted2 = st.form_submit_button("➕ Thêm chỉ định")
+            if submitted2:
+                add_order({
+                    "patient_id": int(pid),
+                    "order_type": order_type,
+                    "description": desc.strip(),
+                    "date_ordered": TODAY_STR,
+                    "scheduled_date": scheduled.strftime(DATE_FMT),
+                    "status":"scheduled"
+                })
+                st.success("✅ Thêm chỉ định thành công")
+                safe_rerun()
+    else:
+        st.info("Không có BN đang điều trị để thêm chỉ định.")
+
+# ======================
+# Trang XUẤT VIỆN
+# ======================
+elif page == "Xuất viện":
+    st.title("🏁 Xuất viện")
+
+    if "discharge_view_date" not in st.session_state:
+        st.session_state.discharge_view_date = TODAY
+
+    df_today = query_df("SELECT * FROM patients WHERE discharge_date = ? ORDER BY ward, name", (TODAY_STR,))
+    st.subheader(f"Hôm nay ({TODAY.strftime('%d/%m/%Y')})")
+    st.write(f"Số bệnh nhân xuất viện: **{len(df_today)}**")
+
+    def _render_discharge_list(df_src: pd.DataFrame, key_prefix: str):
+        if df_src.empty:
+            st.info("Không có bệnh nhân.")
+            return
+        df_show = df_src.copy()
+        # Trừ 2 cột ngày 1 lần (vector) thay vì gọi days_between từng dòng
+        admitted = pd.to_datetime(df_show["admission_date"], format=DATE_FMT, errors="coerce")
+        discharged = pd.to_datetime(df_show["discharge_date"], format=DATE_FMT, errors="coerce")
+        df_show["Số ngày điều trị"] = (discharged - admitted).dt.days.astype("Int64")
         for col in ["discharge_time", "discharge_prescription", "discharge_advice"]:
             if col not in df_show.columns:
                 df_show[col] = ""
@@ -1656,337 +2218,350 @@ elif page == "Xuất viện":
             }),
             use_container_width=True, hide_index=True
         )
-        st.caption("Bấm ↩️ Quay lại để hủy xuất viện và chuyển BN về danh sách đang điều trị.")
-        for r in df_src.to_dict(orient="records"):
-            cols = st.columns([3,2,2,2,1])
-            cols[0].markdown(f"**{r['name']}** — {r.get('medical_id') or '—'}")
-            cols[1].markdown(f"Phòng {r.get('ward','')} • Giường {r.get('bed','') or '—'}")
-            out_time = r.get("discharge_time") or r.get("discharge_date") or ""
-            cols[2].markdown(f"NV: {r.get('admission_date','')} → Ra: {out_time}")
-            cols[3].markdown(f"<span class='small'>CD: {r.get('diagnosis','')}</span>", unsafe_allow_html=True)
-            if cols[4].button("↩️ Quay lại", key=f"{key_prefix}_undo_{r['id']}"):
-                undo_discharge(r["id"])
-                st.success(f"Đã chuyển {r['name']} về BN đang điều trị.")
-                st.session_state.active_page = "Trang chủ"
-                st.cache_data.clear()
-                safe_rerun()
-        return df_show
-
-    df_today_show = _render_discharge_list(df_today, "today")
-    if not df_today.empty:
-        if st.button("⬇️ Xuất Excel — Hôm nay"):
-            xls = export_excel({"discharges_today": df_today_show})
-            st.download_button("Tải file xuất viện hôm nay", data=xls.getvalue(),
-                               file_name=f"discharges_{today_str}.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-    st.markdown("---")
-    st.subheader("Xuất viện theo ngày khác")
-    try:
-        pick_date = st.date_input("Chọn ngày", value=st.session_state.discharge_view_date, format="DD/MM/YYYY")
-    except TypeError:
-        pick_date = st.date_input("Chọn ngày", value=st.session_state.discharge_view_date)
-    st.session_state.discharge_view_date = pick_date
-    pick_str = pick_date.strftime(DATE_FMT)
-    df_pick = query_df("SELECT * FROM patients WHERE discharge_date = ? ORDER BY ward, name", (pick_str,))
-    st.write(f"Số bệnh nhân xuất viện ngày {pick_date.strftime('%d/%m/%Y')}: **{len(df_pick)}**")
-
-    df_pick_show = _render_discharge_list(df_pick, "pick")
-    if not df_pick.empty:
-        if st.button("⬇️ Xuất Excel — Ngày đã chọn"):
-            xls2 = export_excel({"discharges_on": df_pick_show})
-            st.download_button("Tải file xuất viện ngày đã chọn", data=xls2.getvalue(),
-                               file_name=f"discharges_{pick_str}.xlsx",
-                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-# ======================
-# Trang LỊCH TRỰC (mới)
-# ======================
-elif page == "Lịch trực":
-    st.title("📅 Lịch trực")
-
-    def _sanitize_filename(name: str) -> str:
-        base = pathlib.Path(name).name
-        return re.sub(r"[^a-zA-Z0-9_.-]", "_", base)
-
-    def _save_uploaded(scope: str, up):
-        raw_name = _sanitize_filename(up.name)
-        ext = pathlib.Path(raw_name).suffix.lower()
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        final_name = f"{scope}_{ts}_{raw_name}"
-        full_path = os.path.join(DUTY_DIR, final_name)
-        with open(full_path, "wb") as f:
-            f.write(up.getbuffer())
-        mime = up.type or mimetypes.guess_type(raw_name)[0] or "application/octet-stream"
-        _exec("INSERT INTO duty_files(scope, filename, mime, path, uploaded_at) VALUES (?,?,?,?,?)",
-              (scope, raw_name, mime, full_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        st.success("✅ Đã tải lên.")
-        st.cache_data.clear()  # refresh query_df cache
-
-    def _embed_pdf_from_path(path: str):
-        try:
-            with open(path, "rb") as f:
-                data = f.read()
-            b64 = base64.b64encode(data).decode("utf-8")
-            html = f"""
-            <div class="embed">
-              <embed src="data:application/pdf;base64,{b64}" type="application/pdf" width="100%" height="100%"/>
-            </div>
-            """
-            st.markdown(html, unsafe_allow_html=True)
-        except Exception as e:
-            st.error(f"Không thể hiển thị PDF: {e}")
-
-    def _show_file_row(rec):
-        path = rec["path"]; mime = rec["mime"] or mimetypes.guess_type(rec["filename"])[0] or ""
-        st.write(f"**{rec['filename']}**  \n<span class='small'>Tải lên: {rec['uploaded_at']}</span>", unsafe_allow_html=True)
-        if os.path.exists(path):
-            if mime.startswith("image/"):
-                st.image(path, use_container_width=True)
-            elif mime in ("application/pdf", "application/x-pdf"):
-                _embed_pdf_from_path(path)
-            elif mime in ("text/csv", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"):
-                try:
-                    if mime == "text/csv":
-                        df = pd.read_csv(path)
-                    else:
-                        df = pd.read_excel(path)
-                    st.dataframe(df, use_container_width=True, hide_index=True)
-                except Exception as e:
-                    st.error(f"Không đọc được bảng: {e}")
-            else:
-                st.info("Định dạng không hỗ trợ xem trực tiếp. Bạn có thể tải xuống.")
-            try:
-                with open(path, "rb") as f:
-                    bytes_data = f.read()
-                st.download_button("⬇️ Tải tệp", data=bytes_data, file_name=rec["filename"])
-            except Exception as e:
-                st.error(f"Không thể tạo nút tải xuống: {e}")
-        else:
-            st.error("Tệp đã bị xóa trên máy chủ.")
-
-    tabs = st.tabs(["🏥 Lịch trực bệnh viện", "🏨 Lịch trực khoa"])
-
-    # ---- Lịch trực bệnh viện
-    with tabs[0]:
-        st.subheader("Tải lịch trực bệnh viện")
-        up = st.file_uploader("Chọn tệp (PDF/Ảnh/CSV/XLSX...)", type=None, key="duty_hospital")
-        if up is not None:
-            if st.button("📤 Tải lên — Bệnh viện"):
-                _save_uploaded("hospital", up)
-                safe_rerun()
-        st.markdown("---")
-        st.subheader("Xem lịch trực bệnh viện")
-        df_files = query_df("SELECT * FROM duty_files WHERE scope='hospital' ORDER BY uploaded_at DESC")
-        if df_files.empty:
-            st.info("Chưa có tệp lịch trực bệnh viện.")
-        else:
-            for _, rec in df_files.iterrows():
-                with st.expander(f"📄 {rec['filename']}  —  {rec['uploaded_at']}", expanded=False):
-                    _show_file_row(rec)
-
-    # ---- Lịch trực khoa
-    with tabs[1]:
-        st.subheader("Tải lịch trực khoa")
-        up2 = st.file_uploader("Chọn tệp (PDF/Ảnh/CSV/XLSX...)", type=None, key="duty_department")
-        if up2 is not None:
-            if st.button("📤 Tải lên — Khoa"):
-                _save_uploaded("department", up2)
-                safe_rerun()
-        st.markdown("---")
-        st.subheader("Xem lịch trực khoa")
-        df_files2 = query_df("SELECT * FROM duty_files WHERE scope='department' ORDER BY uploaded_at DESC")
-        if df_files2.empty:
-            st.info("Chưa có tệp lịch trực khoa.")
-        else:
-            for _, rec in df_files2.iterrows():
-                with st.expander(f"📄 {rec['filename']}  —  {rec['uploaded_at']}", expanded=False):
-                    _show_file_row(rec)
-
-# ======================
-# Tìm kiếm & Lịch sử
-# ======================
-elif page == "Tìm kiếm & Lịch sử":
-    st.title("🔎 Tìm kiếm bệnh nhân")
-    q = st.text_input("Tìm theo tên / mã bệnh án / phòng")
-    if q:
-        q_like = f"%{q.strip()}%"
-        df = query_df("""
-            SELECT * FROM patients
-            WHERE medical_id LIKE ? OR name LIKE ? OR ward LIKE ?
-            ORDER BY admission_date DESC
-        """, (q_like, q_like, q_like))
-        if df.empty:
-            st.warning("Không tìm thấy")
-        else:
-            for r in df.to_dict(orient="records"):
-                st.subheader(f"{r['medical_id']} - {r['name']}")
-                st.write(f"Phòng: {r.get('ward','')} | Giường: {r.get('bed','')}")
-                chandoan = r.get('diagnosis') or ''
-                st.write(f"Ngày NV: {r.get('admission_date','')} | Phẫu thuật: {'Có' if r.get('surgery_needed',0)==1 else 'Không'} | Đã mổ: {'Có' if r.get('operated',0)==1 else 'Chưa'} | Active: {r['active']}")
-                if chandoan:
-                    st.write(f"📝 Chẩn đoán: {chandoan}")
-                st.write("Ghi chú:", r.get("notes",""))
-                ords = query_df("SELECT * FROM orders WHERE patient_id=? ORDER BY scheduled_date DESC", (r["id"],))
-                if not ords.empty:
-                    st.table(ords[["order_type","description","scheduled_date","status","result_date"]])
-                else:
-                    st.write("Chưa có chỉ định.")
-
-                col1, col2, col3 = st.columns([1, 1, 1])
-                if col1.button("✏️ Chỉnh sửa", key=f"edit_{r['id']}"):
-                    go_edit(r['id'])
-                if col2.button("🗑️ Xóa", key=f"delete_{r['id']}"):
-                    _exec("DELETE FROM patients WHERE id=?", (r['id'],))
-                    st.success(f"Đã xóa bệnh nhân {r['name']}")
-                    st.cache_data.clear()
-                    safe_rerun()
-                if col3.button("Xuất viện", key=f"dis2_{r['id']}"):
-                    discharge_patient(r["id"])
-                    st.success("✅ Đã xuất viện")
-                    st.cache_data.clear()
-                    safe_rerun()
-
-# ======================
-# Chỉnh sửa BN
-# ======================
-elif page == "Chỉnh sửa BN":
-    st.title("✏️ Chỉnh sửa bệnh nhân")
-
-    show_only_active = st.checkbox("Chỉ hiển thị BN đang điều trị (active=1)", value=True)
-    name_query = st.text_input("Tìm theo tên/mã bệnh án (gõ để lọc nhanh)")
-
-    if show_only_active:
-        df_pat = query_df("SELECT id, medical_id, name, ward FROM patients WHERE active=1 ORDER BY ward, name")
-    else:
-        df_pat = query_df("SELECT id, medical_id, name, ward FROM patients ORDER BY active DESC, ward, name")
-
-    if not df_pat.empty and name_query:
-        q = f"%{name_query.strip()}%"
-        df_pat = query_df(
-            """
-            SELECT id, medical_id, name, ward FROM patients
-            WHERE (medical_id LIKE ? OR name LIKE ?) AND (? = 1 OR active = 1)
-            ORDER BY ward, name
-            """,
-            (q, q, 1 if show_only_active else 0)
-        )
-
-    if df_pat.empty:
-        st.info("Chưa có bệnh nhân phù hợp để chỉnh sửa.")
-        st.stop()
-
-    options = df_pat["id"].tolist()
-    if "edit_patient_id" in st.session_state and st.session_state.edit_patient_id in options:
-        default_index = options.index(int(st.session_state.edit_patient_id))
-    else:
-        default_index = 0
-
-    pid = st.selectbox(
-        "Chọn bệnh nhân",
-        options=options,
-        index=default_index,
-        format_func=lambda x: f"{df_pat[df_pat['id']==x]['medical_id'].values[0] or '—'} - {df_pat[df_pat['id']==x]['name'].values[0]} (Phòng {df_pat[df_pat['id']==x]['ward'].values[0] or '—'})",
-        key="edit_select_pid"
-    )
-
-    info_df = query_df("SELECT * FROM patients WHERE id=?", (int(pid),))
-    if info_df.empty:
-        st.error("Không tìm thấy bệnh nhân.")
-        st.stop()
-    p = info_df.iloc[0].to_dict()
-
-    st.markdown("---")
-    st.subheader(f"Đang chỉnh sửa: **{p.get('medical_id') or '—'} — {p.get('name', '')}**")
-
-    def _safe_date(s: Optional[str], fallback: date) -> date:
-        try:
-            return datetime.strptime(s, DATE_FMT).date() if s else fallback
-        except Exception:
-            return fallback
-
-    admission_default  = _safe_date(p.get("admission_date"), date.today())
-    discharge_default  = _safe_date(p.get("discharge_date"), date.today()) if p.get("discharge_date") else None
-
-    with st.form("form_edit_patient_full"):
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            medical_id = st.text_input("Mã bệnh án", value=p.get("medical_id") or "")
-            name       = st.text_input("Họ tên *", value=p.get("name") or "")
-        with col2:
-            ward       = st.text_input("Phòng", value=p.get("ward") or "")
-            bed        = st.text_input("Giường", value=p.get("bed") or "")
-        with col3:
-            surgery_needed = st.checkbox("Cần phẫu thuật?", value=bool(p.get("surgery_needed",0)))
-            operated       = st.checkbox("Đã phẫu thuật", value=bool(p.get("operated",0)))
-
-        try:
-            admission_date = st.date_input("Ngày nhập viện", value=admission_default, format="DD/MM/YYYY")
-        except TypeError:
-            admission_date = st.date_input("Ngày nhập viện", value=admission_default)
-
-        discharge_enable = st.checkbox("Có ngày xuất viện?", value=bool(discharge_default))
-        if discharge_enable:
-            try:
-                discharge_date = st.date_input("Ngày xuất viện", value=discharge_default or date.today(), format="DD/MM/YYYY")
-            except TypeError:
-                discharge_date = st.date_input("Ngày xuất viện", value=discharge_default or date.today())
-        else:
-            discharge_date = None
-
-        diagnosis = st.text_input("📝 Chẩn đoán", value=p.get("diagnosis") or "")
-        notes     = st.text_area("Ghi chú", value=p.get("notes") or "")
-
-        c_save, c_dis, c_del = st.columns([1,1,1])
-        submitted = c_save.form_submit_button("💾 Lưu thay đổi")
-        do_discharge = c_dis.form_submit_button("🏁 Xuất viện (set active=0)")
-        do_delete = c_del.form_submit_button("🗑️ Xoá bệnh nhân")
-
-    if submitted:
-        if not name.strip():
-            st.error("Vui lòng nhập Họ tên."); st.stop()
-        _exec(
-            """
-            UPDATE patients
-            SET medical_id=?, name=?, ward=?, bed=?,
-                admission_date=?, discharge_date=?,
-                surgery_needed=?, operated=?,
-                diagnosis=?, notes=?
-            WHERE id=?
-            """,
-            (
-                medical_id.strip() or None,
-                name.strip(),
-                ward.strip(),
-                bed.strip(),
-                admission_date.strftime(DATE_FMT),
-                discharge_date.strftime(DATE_FMT) if discharge_date else None,
-                1 if surgery_needed else 0,
-                1 if operated else 0,
-                diagnosis.strip(),
-                notes.strip(),
-                int(pid),
-            )
-        )
-        st.success("✅ Đã lưu thay đổi.")
-        st.cache_data.clear()
-
-    if do_discharge:
-        discharge_patient(int(pid))
-        st.success("✅ Đã xuất viện.")
-        st.cache_data.clear()
-
-    if do_delete:
-        _exec("DELETE FROM patients WHERE id=?", (int(pid),))
-        st.success("🗑️ Đã xoá bệnh nhân.")
-        st.cache_data.clear()
-
-# ======================
-# Nhập viện mới
-# ======================
+        st.caption("Bấm ↩️ Quay lại để hủy xuất viện và chuyển BN về danh sách đang điều trị.")
+        for r in df_show.itertuples(index=False):
+            cols = st.columns([3,2,2,2,1])
+            cols[0].markdown(f"**{r.name}** — {r.medical_id or '—'}")
+            cols[1].markdown(f"Phòng {r.ward or ''} • Giường {r.bed or '—'}")
+            out_time = r.discharge_time or r.discharge_date or ""
+            cols[2].markdown(f"NV: {r.admission_date or ''} → Ra: {out_time}")
+            cols[3].markdown(f"<span class='small'>CD: {r.diagnosis or ''}</span>", unsafe_allow_html=True)
+            if cols[4].button("↩️ Quay lại", key=f"{key_prefix}_undo_{r.id}"):
+                undo_discharge(r.id)
+                st.success(f"Đã chuyển {r.name} về BN đang điều trị.")
+                st.session_state.active_page = "Trang chủ"
+                safe_rerun()
+        return df_show
+
+    df_today_show = _render_discharge_list(df_today, "today")
+    if not df_today.empty:
+        # data là callable: file chỉ dựng khi bấm tải (cache theo ngày + danh sách id + phiên bản patients)
+        st.download_button("⬇️ Xuất Excel — Hôm nay",
+                           data=functools.partial(build_discharge_xls, "discharges_today", TODAY_STR,
+                                                  tuple(sorted(df_today["id"].tolist())), table_version("patients"),
+                                                  df_today_show),
+                           file_name=f"discharges_{TODAY_STR}.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+    st.markdown("---")
+    st.subheader("Xuất viện theo ngày khác")
+    try:
+        pick_date = st.date_input("Chọn ngày", value=st.session_state.discharge_view_date, format="DD/MM/YYYY")
+    except TypeError:
+        pick_date = st.date_input("Chọn ngày", value=st.session_state.discharge_view_date)
+    st.session_state.discharge_view_date = pick_date
+    pick_str = pick_date.strftime(DATE_FMT)
+    df_pick = query_df("SELECT * FROM patients WHERE discharge_date = ? ORDER BY ward, name", (pick_str,))
+    st.write(f"Số bệnh nhân xuất viện ngày {pick_date.strftime('%d/%m/%Y')}: **{len(df_pick)}**")
+
+    df_pick_show = _render_discharge_list(df_pick, "pick")
+    if not df_pick.empty:
+        st.download_button("⬇️ Xuất Excel — Ngày đã chọn",
+                           data=functools.partial(build_discharge_xls, "discharges_on", pick_str,
+                                                  tuple(sorted(df_pick["id"].tolist())), table_version("patients"),
+                                                  df_pick_show),
+                           file_name=f"discharges_{pick_str}.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+# ======================
+# Trang LỊCH TRỰC (mới)
+# ======================
+elif page == "Lịch trực":
+    st.title("📅 Lịch trực")
+
+    def _sanitize_filename(name: str) -> str:
+        base = pathlib.Path(name).name
+        return re.sub(r"[^a-zA-Z0-9_.-]", "_", base)
+
+    def _save_uploaded(scope: str, up):
+        raw_name = _sanitize_filename(up.name)
+        ext = pathlib.Path(raw_name).suffix.lower()
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        final_name = f"{scope}_{ts}_{raw_name}"
+        full_path = os.path.join(DUTY_DIR, final_name)
+        # Ghi ra tệp tạm và băm SHA-256 cùng lúc (từng khối 1 MiB)
+        tmp_path = full_path + ".part"
+        hasher = hashlib.sha256()
+        up.seek(0)
+        with open(tmp_path, "wb") as f:
+            for chunk in iter(lambda: up.read(1024 * 1024), b""):
+                hasher.update(chunk)
+                f.write(chunk)
+        digest = hasher.hexdigest()
+        # Cùng nội dung đã có trên đĩa (thường gặp khi tải lại lịch tuần) -> dùng lại tệp cũ
+        same = query_df("SELECT path FROM duty_files WHERE sha256=? ORDER BY id LIMIT 1", (digest,))
+        if not same.empty and os.path.exists(same.iloc[0]["path"]):
+            os.remove(tmp_path)
+            full_path = same.iloc[0]["path"]
+        else:
+            os.replace(tmp_path, full_path)
+        mime = up.type or mimetypes.guess_type(raw_name)[0] or "application/octet-stream"
+        _exec("INSERT INTO duty_files(scope, filename, mime, path, uploaded_at, sha256) VALUES (?,?,?,?,?,?)",
+              (scope, raw_name, mime, full_path, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), digest))
+        st.success("✅ Đã tải lên.")
+
+    def _embed_pdf_from_path(path: str):
+        try:
+            # Nhúng base64 qua phiên đã đăng nhập (không để PDF ở static/ ai cũng tải được); _pdf_b64 cache theo (path, mtime)
+            src = "data:application/pdf;base64," + _pdf_b64(path, os.path.getmtime(path))
+            html = f"""
+            <div class="embed">
+              <embed src="{src}" type="application/pdf" width="100%" height="100%"/>
+            </div>
+            """
+            st.markdown(html, unsafe_allow_html=True)
+        except Exception as e:
+            st.error(f"Không thể hiển thị PDF: {e}")
+
+    def _show_file_row(rec):
+        path = rec["path"]; mime = rec["mime"] or mimetypes.guess_type(rec["filename"])[0] or ""
+        st.write(f"**{rec['filename']}**  \n<span class='small'>Tải lên: {rec['uploaded_at']}</span>", unsafe_allow_html=True)
+        if os.path.exists(path):
+            if mime.startswith("image/"):
+                st.image(path, use_container_width=True)
+            elif mime in ("application/pdf", "application/x-pdf"):
+                _embed_pdf_from_path(path)
+            elif mime in ("text/csv", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"):
+                try:
+                    # Chỉ đọc PREVIEW_ROWS dòng đầu để xem trước; tệp lớn không bị nạp hết vào RAM
+                    if mime == "text/csv":
+                        df = pd.read_csv(path, nrows=PREVIEW_ROWS)
+                    else:
+                        df = pd.read_excel(path, nrows=PREVIEW_ROWS)
+                    st.dataframe(df, use_container_width=True, hide_index=True)
+                    if len(df) >= PREVIEW_ROWS:
+                        st.caption(f"Xem trước {PREVIEW_ROWS} dòng đầu — tải tệp để xem toàn bộ.")
+                except Exception as e:
+                    st.error(f"Không đọc được bảng: {e}")
+            else:
+                st.info("Định dạng không hỗ trợ xem trực tiếp. Bạn có thể tải xuống.")
+            try:
+                # Chỉ đọc tệp khi người dùng bấm tải (data là hàm, Streamlit gọi lúc click)
+                st.download_button("⬇️ Tải tệp", data=functools.partial(_read_file_bytes, path, os.path.getmtime(path)),
+                                   file_name=rec["filename"], mime=mime or None)
+            except Exception as e:
+                st.error(f"Không thể tạo nút tải xuống: {e}")
+        else:
+            st.error("Tệp đã bị xóa trên máy chủ.")
+
+    tabs = st.tabs(["🏥 Lịch trực bệnh viện", "🏨 Lịch trực khoa"])
+
+    # ---- Lịch trực bệnh viện
+    with tabs[0]:
+        st.subheader("Tải lịch trực bệnh viện")
+        up = st.file_uploader("Chọn tệp (PDF/Ảnh/CSV/XLSX...)", type=None, key="duty_hospital")
+        if up is not None:
+            if st.button("📤 Tải lên — Bệnh viện"):
+                _save_uploaded("hospital", up)
+                safe_rerun()
+        st.markdown("---")
+        st.subheader("Xem lịch trực bệnh viện")
+        hosp_files = query_rows("SELECT id, filename, mime, path, uploaded_at FROM duty_files WHERE scope='hospital' ORDER BY uploaded_at DESC")
+        if not hosp_files:
+            st.info("Chưa có tệp lịch trực bệnh viện.")
+        else:
+            for rec in hosp_files:
+                with st.expander(f"📄 {rec['filename']}  —  {rec['uploaded_at']}", expanded=False):
+                    _show_file_row(rec)
+
+    # ---- Lịch trực khoa
+    with tabs[1]:
+        st.subheader("Tải lịch trực khoa")
+        up2 = st.file_uploader("Chọn tệp (PDF/Ảnh/CSV/XLSX...)", type=None, key="duty_department")
+        if up2 is not None:
+            if st.button("📤 Tải lên — Khoa"):
+                _save_uploaded("department", up2)
+                safe_rerun()
+        st.markdown("---")
+        st.subheader("Xem lịch trực khoa")
+        dept_files = query_rows("SELECT id, filename, mime, path, uploaded_at FROM duty_files WHERE scope='department' ORDER BY uploaded_at DESC")
+        if not dept_files:
+            st.info("Chưa có tệp lịch trực khoa.")
+        else:
+            for rec in dept_files:
+                with st.expander(f"📄 {rec['filename']}  —  {rec['uploaded_at']}", expanded=False):
+                    _show_file_row(rec)
+
+# ======================
+# Tìm kiếm & Lịch sử
+# ======================
+elif page == "Tìm kiếm & Lịch sử":
+    st.title("🔎 Tìm kiếm bệnh nhân")
+    q = st.text_input("Tìm theo tên / mã bệnh án / phòng")
+    if q:
+        df = search_patients(q)
+        if df.empty:
+            st.warning("Không tìm thấy")
+        else:
+            # 1 truy vấn chỉ định cho mọi BN tìm được (thay vì 1 truy vấn / BN), rồi nhóm theo patient_id
+            ids = tuple(int(x) for x in df["id"])
+            ords_all = query_df(f"""
+                SELECT patient_id, order_type, description, scheduled_date, status, result_date
+                FROM orders WHERE patient_id IN ({','.join('?' * len(ids))})
+                ORDER BY scheduled_date DESC
+            """, ids)
+            # sort=False: chỉ tra theo patient_id, không cần sắp khóa nhóm; thứ tự dòng trong nhóm vẫn theo ORDER BY
+            by_pid = dict(tuple(ords_all.groupby("patient_id", sort=False)))
+            for r in df.itertuples(index=False):
+                st.subheader(f"{r.medical_id} - {r.name}")
+                st.write(f"Phòng: {r.ward} | Giường: {r.bed}")
+                chandoan = r.diagnosis or ''
+                st.write(f"Ngày NV: {r.admission_date} | Phẫu thuật: {'Có' if r.surgery_needed==1 else 'Không'} | Đã mổ: {'Có' if r.operated==1 else 'Chưa'} | Active: {r.active}")
+                if chandoan:
+                    st.write(f"📝 Chẩn đoán: {chandoan}")
+                st.write("Ghi chú:", r.notes)
+                ords = by_pid.get(r.id)
+                if ords is not None:
+                    st.table(ords[["order_type","description","scheduled_date","status","result_date"]])
+                else:
+                    st.write("Chưa có chỉ định.")
+
+                col1, col2, col3 = st.columns([1, 1, 1])
+                if col1.button("✏️ Chỉnh sửa", key=f"edit_{r.id}"):
+                    go_edit(r.id)
+                if col2.button("🗑️ Xóa", key=f"delete_{r.id}"):
+                    _exec("DELETE FROM patients WHERE id=?", (r.id,))
+                    st.success(f"Đã xóa bệnh nhân {r.name}")
+                    safe_rerun()
+                if col3.button("Xuất viện", key=f"dis2_{r.id}"):
+                    discharge_patient(r.id)
+                    st.success("✅ Đã xuất viện")
+                    safe_rerun()
+
+# ======================
+# Chỉnh sửa BN
+# ======================
+elif page == "Chỉnh sửa BN":
+    st.title("✏️ Chỉnh sửa bệnh nhân")
+
+    # Fragment: gõ tìm / đổi bộ lọc chỉ chạy lại phần chọn BN; cả trang (form) chỉ chạy lại khi BN được chọn đổi
+    @st.fragment
+    def edit_patient_picker() -> Optional[int]:
+        show_only_active = st.checkbox("Chỉ hiển thị BN đang điều trị (active=1)", value=True)
+        name_query = st.text_input("Tìm theo tên/mã bệnh án (gõ để lọc nhanh)")
+
+        pat_rows = edit_candidates(name_query, show_only_active)
+        picked = None
+        if not pat_rows:
+            st.info("Chưa có bệnh nhân phù hợp để chỉnh sửa.")
+        else:
+            options = [r["id"] for r in pat_rows]
+            id_to_label = {
+                r["id"]: f"{r['medical_id'] or '—'} - {r['name']} (Phòng {r['ward'] or '—'})"
+                for r in pat_rows
+            }
+            if "edit_patient_id" in st.session_state and st.session_state.edit_patient_id in options:
+                default_index = options.index(int(st.session_state.edit_patient_id))
+            else:
+                default_index = 0
+
+            picked = st.selectbox(
+                "Chọn bệnh nhân",
+                options=options,
+                index=default_index,
+                format_func=id_to_label.get,
+                key="edit_select_pid"
+            )
+        first_run = "edit_form_pid" not in st.session_state
+        changed = st.session_state.get("edit_form_pid") != picked
+        st.session_state.edit_form_pid = picked
+        if changed and not first_run:
+            st.rerun(scope="app")
+        return picked
+
+    pid = edit_patient_picker()
+    if pid is None:
+        st.stop()
+
+    p = query_one("""
+        SELECT medical_id, name, ward, bed, admission_date, discharge_date,
+               surgery_needed, operated, diagnosis, notes
+        FROM patients WHERE id=?
+    """, (int(pid),))
+    if p is None:
+        st.error("Không tìm thấy bệnh nhân.")
+        st.stop()
+
+    st.markdown("---")
+    st.subheader(f"Đang chỉnh sửa: **{p.get('medical_id') or '—'} — {p.get('name', '')}**")
+
+    def _safe_date(s: Optional[str], fallback: date) -> date:
+        return _to_date(s) or fallback
+
+    admission_default  = _safe_date(p.get("admission_date"), TODAY)
+    discharge_default  = _safe_date(p.get("discharge_date"), TODAY) if p.get("discharge_date") else None
+
+    with st.form("form_edit_patient_full"):
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            medical_id = st.text_input("Mã bệnh án", value=p.get("medical_id") or "")
+            name       = st.text_input("Họ tên *", value=p.get("name") or "")
+        with col2:
+            ward       = st.text_input("Phòng", value=p.get("ward") or "")
+            bed        = st.text_input("Giường", value=p.get("bed") or "")
+        with col3:
+            surgery_needed = st.checkbox("Cần phẫu thuật?", value=bool(p.get("surgery_needed",0)))
+            operated       = st.checkbox("Đã phẫu thuật", value=bool(p.get("operated",0)))
+
+        try:
+            admission_date = st.date_input("Ngày nhập viện", value=admission_default, format="DD/MM/YYYY")
+        except TypeError:
+            admission_date = st.date_input("Ngày nhập viện", value=admission_default)
+
+        discharge_enable = st.checkbox("Có ngày xuất viện?", value=bool(discharge_default))
+        if discharge_enable:
+            try:
+                discharge_date = st.date_input("Ngày xuất viện", value=discharge_default or TODAY, format="DD/MM/YYYY")
+            except TypeError:
+                discharge_date = st.date_input("Ngày xuất viện", value=discharge_default or TODAY)
+        else:
+            discharge_date = None
+
+        diagnosis = st.text_input("📝 Chẩn đoán", value=p.get("diagnosis") or "")
+        notes     = st.text_area("Ghi chú", value=p.get("notes") or "")
+
+        c_save, c_dis, c_del = st.columns([1,1,1])
+        submitted = c_save.form_submit_button("💾 Lưu thay đổi")
+        do_discharge = c_dis.form_submit_button("🏁 Xuất viện (set active=0)")
+        do_delete = c_del.form_submit_button("🗑️ Xoá bệnh nhân")
+
+    if submitted:
+        if not name.strip():
+            st.error("Vui lòng nhập Họ tên."); st.stop()
+        update_patient(int(pid), {
+            "medical_id": medical_id.strip() or None,
+            "name": name.strip(),
+            "ward": ward.strip(),
+            "bed": bed.strip(),
+            "admission_date": admission_date.strftime(DATE_FMT),
+            "discharge_date": discharge_date.strftime(DATE_FMT) if discharge_date else None,
+            "surgery_needed": surgery_needed,
+            "operated": operated,
+            "diagnosis": diagnosis.strip(),
+            "notes": notes.strip(),
+        })
+        # toast vẫn hiện sau khi chạy lại; rerun để form/ô chọn BN đọc lại dữ liệu vừa ghi
+        st.toast("✅ Đã lưu thay đổi.")
+        safe_rerun()
+
+    if do_discharge:
+        discharge_patient(int(pid))
+        st.toast("✅ Đã xuất viện.")
+        safe_rerun()
+
+    if do_delete:
+        _exec("DELETE FROM patients WHERE id=?", (int(pid),))
+        # BN đã xoá không còn trong danh sách -> bỏ lựa chọn cũ để ô chọn về BN đầu tiên
+        st.session_state.pop("edit_patient_id", None)
+        st.toast("🗑️ Đã xoá bệnh nhân.")
+        safe_rerun()
+
+# ======================
+# Nhập viện mới
+# ======================
 elif page == "Nhập viện mới":
     st.title("🧾 Nhập bệnh nhân mới")
-    today_year = date.today().year
+    today_year = TODAY.year
     st.caption("Ưu tiên nhập nhanh: thông tin tối thiểu, chẩn đoán, hướng xử trí và CLS ban đầu.")
 
     with st.form("form_add_patient", clear_on_submit=True):
@@ -2019,9 +2594,9 @@ elif page == "Nhập viện mới":
                 dob_date = st.date_input("Ngày sinh", value=date(1980,1,1))
 
         try:
-            admission_date_ui = st.date_input("Ngày nhập viện", value=date.today(), format="DD/MM/YYYY")
+            admission_date_ui = st.date_input("Ngày nhập viện", value=TODAY, format="DD/MM/YYYY")
         except TypeError:
-            admission_date_ui = st.date_input("Ngày nhập viện", value=date.today())
+            admission_date_ui = st.date_input("Ngày nhập viện", value=TODAY)
 
         st.markdown("#### Chẩn đoán và hướng xử trí")
         disease_group = st.selectbox(
@@ -2051,18 +2626,17 @@ elif page == "Nhập viện mới":
         st.markdown("---")
         st.subheader("🧪 CLS ban đầu")
 
-        options = [f"{t[0]} — {t[1]}" for t in COMMON_TESTS]
         default_initial = []
         if treatment_mode in ["Chuẩn bị mổ", "Sau mổ"]:
             default_initial = ["XN máu — Tổng phân tích tế bào máu", "XN máu — Sinh hoá cơ bản", "XN máu — Đông máu"]
-        if disease_group in ["Chấn thương", "U não/cột sống"] and "CT — CT sọ não không cản quang" in options:
+        if disease_group in ["Chấn thương", "U não/cột sống"]:
             default_initial.append("CT — CT sọ não không cản quang")
-        default_initial = [x for x in default_initial if x in options]
-        selected = st.multiselect("Chọn nhanh các chỉ định cần làm", options, default=default_initial)
+        default_initial = [x for x in default_initial if x in COMMON_TESTS_BY_LABEL]
+        selected = st.multiselect("Chọn nhanh các chỉ định cần làm", COMMON_TESTS_LABELS, default=default_initial)
         try:
-            scheduled_all = st.date_input("Ngày dự kiến thực hiện (áp dụng cho tất cả mục đã chọn)", value=date.today(), format="DD/MM/YYYY")
+            scheduled_all = st.date_input("Ngày dự kiến thực hiện (áp dụng cho tất cả mục đã chọn)", value=TODAY, format="DD/MM/YYYY")
         except TypeError:
-            scheduled_all = st.date_input("Ngày dự kiến thực hiện (áp dụng cho tất cả mục đã chọn)", value=date.today())
+            scheduled_all = st.date_input("Ngày dự kiến thực hiện (áp dụng cho tất cả mục đã chọn)", value=TODAY)
 
         submitted = st.form_submit_button("Lưu BN và về màn hình buổi sáng")
         if submitted:
@@ -2085,10 +2659,10 @@ elif page == "Nhập viện mới":
                 patient = {
                     "medical_id": medical_id.strip() if medical_id else None,
                     "name": name.strip(),
-                    "dob": dob_final.strftime(DATE_FMT),
-                    "ward": ward.strip(),
-                    "bed": bed.strip(),
-                    "admission_date": admission_date_ui.strftime(DATE_FMT),
+                    "dob": dob_final.strftime(DATE_FMT),
+                    "ward": ward.strip(),
+                    "bed": bed.strip(),
+                    "admission_date": admission_date_ui.strftime(DATE_FMT),
                     "severity": None,
                     "surgery_needed": surgery_needed,
                     "planned_treatment_days": int(planned_treatment_days),
@@ -2097,76 +2671,79 @@ elif page == "Nhập viện mới":
                     "diagnosis": diagnosis.strip(),
                     "operated": operated,
                 }
-                new_id = add_patient(patient)
-
-                if selected:
-                    today_str = date.today().strftime(DATE_FMT)
-                    scheduled_str = scheduled_all.strftime(DATE_FMT)
-                    text_to_tuple = {f"{t[0]} — {t[1]}": t for t in COMMON_TESTS}
-                    for sel in selected:
-                        ot, desc = text_to_tuple[sel]
-                        add_order({
-                            "patient_id": new_id,
-                            "order_type": ot,
-                            "description": desc,
-                            "date_ordered": today_str,
-                            "scheduled_date": scheduled_str,
-                            "status": "scheduled"
-                        })
+                scheduled_str = scheduled_all.strftime(DATE_FMT)
+                new_orders = []
+                for sel in selected:
+                    ot, desc = COMMON_TESTS_BY_LABEL[sel]
+                    new_orders.append({
+                        "order_type": ot,
+                        "description": desc,
+                        "date_ordered": TODAY_STR,
+                        "scheduled_date": scheduled_str,
+                        "status": "scheduled"
+                    })
+                add_patient(patient, new_orders)
 
                 st.success(
                     f"Đã thêm BN • DOB: {dob_final.strftime('%d/%m/%Y')} • Nhập viện: {admission_date_ui.strftime('%d/%m/%Y')}"
                     + (f" • Đã tạo {len(selected)} CLS" if selected else "")
                 )
-                st.cache_data.clear()
                 st.session_state.active_page = "Buổi sáng"
                 safe_rerun()
-
-# ======================
-# Báo cáo
-# ======================
-elif page == "Báo cáo":
-    st.title("📑 Báo cáo")
-
-    st.subheader("Báo cáo nhanh theo ngày")
-    day = st.date_input("Chọn ngày báo cáo", value=date.today())
-    dstr = day.strftime(DATE_FMT)
-    patients_on_day = query_df("""
-        SELECT * FROM patients
-        WHERE admission_date <= ? AND (discharge_date IS NULL OR discharge_date >= ?)
-    """, (dstr, dstr))
-    orders_day = query_df("""
-        SELECT o.*, p.name FROM orders o
-        LEFT JOIN patients p ON o.patient_id=p.id
-        WHERE o.scheduled_date = ?
-    """, (dstr,))
-    st.write(f"BN có mặt ngày {dstr}: **{len(patients_on_day)}**")
-    st.write(f"Chỉ định scheduled cho ngày {dstr}: **{len(orders_day)}**")
-    st.dataframe(orders_day[["patient_id","name","order_type","description","status"]], use_container_width=True, hide_index=True)
-
-    if st.button("⬇️ Xuất báo cáo ngày (Excel)"):
-        xls = export_excel({"patients_on_day": patients_on_day, "orders_day": orders_day})
-        st.download_button("Tải file báo cáo ngày", data=xls.getvalue(),
-                           file_name=f"report_{dstr}.xlsx",
-                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-    st.markdown("---")
-    st.subheader("Báo cáo tháng")
-    ym = st.date_input("Chọn ngày thuộc tháng muốn báo cáo", value=date.today())
-    first = date(ym.year, ym.month, 1).strftime(DATE_FMT)
-    next_month = ym.replace(day=28) + timedelta(days=4)
-    last_day = (next_month - timedelta(days=next_month.day)).strftime(DATE_FMT)
-    patients_month = query_df("SELECT * FROM patients WHERE admission_date BETWEEN ? AND ?", (first, last_day))
-    st.write(f"Tổng BN nhập trong tháng {ym.month}/{ym.year}: **{len(patients_month)}**")
-    if st.button("⬇️ Xuất báo cáo tháng (Excel)"):
-        xls = export_excel({"patients_month": patients_month})
-        st.download_button("Tải file báo cáo tháng", data=xls.getvalue(),
-                           file_name=f"report_month_{ym.year}_{ym.month}.xlsx",
-                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-
-# ======================
-# Cài đặt / Demo
-# ======================
+
+# ======================
+# Báo cáo
+# ======================
+elif page == "Báo cáo":
+    st.title("📑 Báo cáo")
+
+    st.subheader("Báo cáo nhanh theo ngày")
+    day = st.date_input("Chọn ngày báo cáo", value=TODAY)
+    dstr = day.strftime(DATE_FMT)
+    n_pat = query_scalar(f"SELECT COUNT(*) FROM patients WHERE {PATIENTS_ON_DAY_WHERE}", (dstr, dstr))
+    st.write(f"BN có mặt ngày {dstr}: **{n_pat}**")
+    # Số liệu bằng COUNT, màn hình chỉ kéo 200 dòng đầu; đủ danh sách chỉ đọc khi xuất Excel (build_day_report)
+    n_orders = int(query_scalar("SELECT COUNT(*) FROM orders WHERE scheduled_date = ?", (dstr,)))
+    st.write(f"Chỉ định scheduled cho ngày {dstr}: **{n_orders}**")
+    # Bảng xem trước chỉ truy vấn khi mở expander; mở trang Báo cáo chỉ tốn các câu COUNT
+    orders_exp = st.expander("Xem danh sách chỉ định trong ngày", expanded=False,
+                             key="report_orders_exp", on_change="rerun")
+    if orders_exp.open and n_orders:
+        with orders_exp:
+            # Chỉ các cột hiển thị (file Excel vẫn xuất đủ cột qua orders_on_day)
+            orders_preview = query_df("""
+                SELECT o.patient_id, p.name AS patient_name, o.order_type, o.description, o.status
+                FROM orders o LEFT JOIN patients p ON o.patient_id=p.id
+                WHERE o.scheduled_date = ?""" + ORDERS_DAY_ORDER_BY + " LIMIT 200", (dstr,))
+            st.dataframe(orders_preview, use_container_width=True, hide_index=True)
+            if n_orders > len(orders_preview):
+                st.caption(f"Hiển thị {len(orders_preview)}/{n_orders} chỉ định — xuất Excel để xem đủ.")
+
+    # Như báo cáo tháng: 1 nút tải, file chỉ dựng khi bấm và cache theo ngày + phiên bản patients/orders
+    st.download_button("⬇️ Xuất báo cáo ngày (Excel)",
+                       data=functools.partial(build_day_report, dstr,
+                                              table_version("patients"), table_version("orders")),
+                       file_name=f"report_{dstr}.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+    st.markdown("---")
+    st.subheader("Báo cáo tháng")
+    ym = st.date_input("Chọn ngày thuộc tháng muốn báo cáo", value=TODAY)
+    # DATE_FMT là dạng ISO -> isoformat() cho cùng chuỗi, không qua strftime
+    first = ym.replace(day=1).isoformat()
+    last_day = ym.replace(day=calendar.monthrange(ym.year, ym.month)[1]).isoformat()
+    n_month = count_patients_month(first, last_day)
+    st.write(f"Tổng BN nhập trong tháng {ym.month}/{ym.year}: **{n_month}**")
+    # File chỉ được dựng khi người dùng bấm tải (data là callable), kết quả cache theo tháng + phiên bản patients
+    st.download_button("⬇️ Xuất báo cáo tháng (Excel)",
+                       data=functools.partial(build_month_report, first, last_day, table_version("patients")),
+                       file_name=f"report_month_{ym.year}_{ym.month}.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                       disabled=n_month == 0)
+
+# ======================
+# Cài đặt / Demo
+# ======================
 elif page == "Cài đặt / Demo":
     st.title("⚙️ Cài đặt & Demo")
     st.write("- Chạy ứng dụng: `streamlit run app.py --server.address 0.0.0.0 --server.port 8501`")
@@ -2179,7 +2756,6 @@ elif page == "Cài đặt / Demo":
     if st.button("Xóa toàn bộ dữ liệu bệnh nhân cũ"):
         if confirm_reset.strip().upper() == "XOA":
             reset_clinical_data()
-            st.cache_data.clear()
             st.success("Đã xóa sạch dữ liệu bệnh nhân cũ. Có thể bắt đầu nhập bệnh nhân mới.")
             safe_rerun()
         else:
@@ -2187,71 +2763,70 @@ elif page == "Cài đặt / Demo":
 
     # Banner upload / delete
     st.subheader("🖼️ Quản lý banner trang chủ")
-    st.markdown("Bạn có thể tải ảnh banner (PNG/JPG/GIF). Ảnh sẽ được lưu vào thư mục `static/` và tự động hiển thị trên Trang chủ.")
-
-    # Tạo thư mục static nếu chưa có
-    try:
-        os.makedirs("static", exist_ok=True)
-    except Exception:
-        pass
-
-    # Hiển thị banner hiện tại (nếu có)
-    banner_paths = [os.path.join("static", f) for f in ("banner.png", "banner.jpg", "banner.jpeg", "banner.gif")] 
-    current_banner = next((p for p in banner_paths if os.path.exists(p)), None)
-    if current_banner:
-        st.write("Banner hiện tại:")
-        try:
-            st.image(current_banner, use_container_width=True)
-        except Exception:
-            st.markdown(f"![banner]({current_banner})")
-
-    uploaded = st.file_uploader("Tải ảnh lên (PNG/JPG/GIF)", type=["png", "jpg", "jpeg", "gif"])
-    if uploaded is not None:
-        # lưu file với hậu tố gốc, nhưng tiêu chuẩn hóa tên là banner.ext
-        ext = os.path.splitext(uploaded.name)[1].lower() or ".png"
-        save_name = os.path.join("static", f"banner{ext}")
-        # xóa các banner cũ khác định dạng
-        for p in banner_paths:
-            try:
-                if os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
-        try:
-            with open(save_name, "wb") as f:
-                f.write(uploaded.getbuffer())
-            st.success("✅ Đã tải lên banner")
-            safe_rerun()
-        except Exception as e:
-            st.error(f"Không thể lưu file: {e}")
-
-    if current_banner:
-        if st.button("🗑️ Xóa banner hiện tại"):
-            removed = 0
-            for p in banner_paths:
-                try:
-                    if os.path.exists(p):
-                        os.remove(p); removed += 1
-                except Exception:
-                    pass
-            if removed:
-                st.success("Đã xóa banner")
-            else:
-                st.info("Không tìm thấy file để xóa")
-            safe_rerun()
-
-    c1, c2 = st.columns(2)
-    with c1:
-        if st.button("Tạo dữ liệu mẫu (demo)"):
-            load_sample_data()
-            st.success("✅ Đã thêm sample data")
-            safe_rerun()
-    with c2:
-        if st.button("Tạo backup ngay (tải file .db)"):
-            if not os.path.exists(DB_PATH):
-                st.error("Chưa có DB để tải.")
-            else:
-                with open(DB_PATH, "rb") as f:
-                    data = f.read()
-                st.download_button("Tải file DB", data=data, file_name=DB_PATH, mime="application/x-sqlite3")
-# kết thúc
+    st.markdown("Bạn có thể tải ảnh banner (PNG/JPG/GIF). Ảnh sẽ được lưu vào thư mục `static/` và tự động hiển thị trên Trang chủ.")
+
+    # Tạo thư mục static nếu chưa có
+    try:
+        os.makedirs("static", exist_ok=True)
+    except Exception:
+        pass
+
+    # Hiển thị banner hiện tại (nếu có)
+    banner_paths = [os.path.join("static", f) for f in ("banner.png", "banner.jpg", "banner.jpeg", "banner.gif")] 
+    current_banner = next((p for p in banner_paths if os.path.exists(p)), None)
+    if current_banner:
+        st.write("Banner hiện tại:")
+        try:
+            st.image(current_banner, use_container_width=True)
+        except Exception:
+            st.markdown(f"![banner]({current_banner})")
+
+    uploaded = st.file_uploader("Tải ảnh lên (PNG/JPG/GIF)", type=["png", "jpg", "jpeg", "gif"])
+    if uploaded is not None:
+        # lưu file với hậu tố gốc, nhưng tiêu chuẩn hóa tên là banner.ext
+        ext = os.path.splitext(uploaded.name)[1].lower() or ".png"
+        save_name = os.path.join("static", f"banner{ext}")
+        # xóa các banner cũ khác định dạng
+        for p in banner_paths:
+            try:
+                if os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                pass
+        try:
+            with open(save_name, "wb") as f:
+                f.write(uploaded.getbuffer())
+            st.success("✅ Đã tải lên banner")
+            safe_rerun()
+        except Exception as e:
+            st.error(f"Không thể lưu file: {e}")
+
+    if current_banner:
+        if st.button("🗑️ Xóa banner hiện tại"):
+            removed = 0
+            for p in banner_paths:
+                try:
+                    if os.path.exists(p):
+                        os.remove(p); removed += 1
+                except Exception:
+                    pass
+            if removed:
+                st.success("Đã xóa banner")
+            else:
+                st.info("Không tìm thấy file để xóa")
+            safe_rerun()
+
+    c1, c2 = st.columns(2)
+    with c1:
+        if st.button("Tạo dữ liệu mẫu (demo)"):
+            load_sample_data()
+            st.success("✅ Đã thêm sample data")
+            safe_rerun()
+    with c2:
+        if not os.path.exists(DB_PATH):
+            st.error("Chưa có DB để tải.")
+        else:
+            # data là hàm: file DB chỉ được đọc khi bấm tải, không nạp sẵn mỗi lần trang chạy lại
+            st.download_button("Tạo backup ngay (tải file .db)", data=_db_backup_bytes,
+                               file_name=DB_PATH, mime="application/x-sqlite3")
+# kết thúc